@@ -6,7 +6,11 @@
 # Imports
 # ------------------------------------------------------------------------------
 
-from time import sleep
+from Queue import Queue
+from threading import Condition, Thread
+from time import time
+
+from ScheduledCrawler import ScheduledCrawler
 
 
 # ------------------------------------------------------------------------------
@@ -18,33 +22,127 @@ class Armada(object):
     Manages a fleet of crawlers.
     """
 
-    def __init__(self, pause=900):
+    def __init__(self, pause=900, workers=4, profiler=None,
+            rate_limiter=None):
         """
         Creates a crawler manager.
 
         Arguments:
-            pause<int> -- Wait time between crawls in seconds.
+            pause<int>         -- Default wait time between crawls in seconds.
+            workers<int>       -- Max number of crawlers running at the same
+                                  time.
+            profiler<Profiler> -- Optional profiler crawls can be profiled
+                                  with on demand.
+            rate_limiter       -- Optional RateLimiter shared by the crawlers.
+                                  A crawler is held back while a host that
+                                  throttled its last crawl is backing off.
         """
+        if workers < 1:
+            raise Exception('Armada needs at least one worker.')
+
         self.crawlers = []
         self.crawl_wait = pause
+        self.worker_count = workers
+        self.profiler = profiler
+        self.rate_limiter = rate_limiter
+
+        self.queue = Queue()
+        self.condition = Condition()
+        self.workers = []
 
     def run(self):
         """
-        Begins indefinite crawling, sequentially calling each crawler, then
-        sleeps the pause time before starting over.
+        Begins indefinite crawling. Each crawler is started on the worker pool
+        whenever its own interval has passed, and is never started again while
+        its previous crawl is still running.
         """
+        self.start_workers()
+
         while True:
-            for crawler in self.crawlers:
-                crawler.crawl()
+            self.condition.acquire()
+            try:
+                now = time()
 
-            print 'Sleeping for %s seconds' % self.crawl_wait
-            sleep(self.crawl_wait)
+                for scheduled in self.crawlers:
+                    if scheduled.is_due(now):
+                        scheduled.running = True
+                        self.queue.put(scheduled)
 
-    def add_crawler(self, crawler):
+                self.condition.wait(self.next_wait(now))
+            finally:
+                self.condition.release()
+
+    def next_wait(self, now):
+        """
+        Finds how long the scheduler may sleep before a crawler becomes due.
+        Running crawlers wake the scheduler themselves when they finish.
+
+        Arguments:
+            now<float> -- Current time in seconds since the epoch.
+
+        Returns:
+            Seconds to wait. If every crawler is running, the default pause.
+        """
+        result = self.crawl_wait
+
+        waiting = [c.next_run for c in self.crawlers if not c.running]
+
+        if waiting:
+            result = max(min(waiting) - now, 0)
+
+        return result
+
+    def start_workers(self):
+        """
+        Starts the worker threads crawlers are run on.
+        """
+        while len(self.workers) < self.worker_count:
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        """
+        Worker loop. Runs crawlers off the queue and wakes the scheduler once
+        each crawl is done.
+        """
+        while True:
+            scheduled = self.queue.get()
+
+            try:
+                scheduled.run()
+            finally:
+                self.condition.acquire()
+                scheduled.running = False
+                self.condition.notify()
+                self.condition.release()
+
+    def add_crawler(self, crawler, interval=None, deadline=None,
+            min_interval=None, max_interval=None, target_fill=0.5):
         """
         Adds a crawler to the fleet.
+
+        Arguments:
+            crawler            -- Crawler to add.
+            interval<int>      -- Optional seconds between crawls. Defaults to
+                                  the Armada's pause time.
+            deadline<int>      -- Optional max seconds a single crawl may
+                                  take.
+            min_interval<int>  -- Optional shortest interval to adapt to.
+            max_interval<int>  -- Optional longest interval to adapt to.
+            target_fill<float> -- Share of each listing that should be new
+                                  when adapting the interval.
         """
-        self.crawlers.append(crawler)
+        interval = interval if interval else self.crawl_wait
+        scheduled = ScheduledCrawler(crawler, interval, deadline,
+            self.profiler, min_interval, max_interval, target_fill,
+            self.rate_limiter)
+
+        self.condition.acquire()
+        self.crawlers.append(scheduled)
+        self.condition.notify()
+        self.condition.release()
 
     def __repr__(self):
         return '<Armada>'
@@ -0,0 +1,207 @@
+# ==============================================================================
+# BackfillCrawler.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+import json
+import os
+import re
+from time import time
+
+from SubredditWallpaperCrawler import SubredditWallpaperCrawler
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class BackfillCrawler(SubredditWallpaperCrawler):
+    """
+    Works back through a subreddit's new or top listing a few pages per crawl,
+    to ingest what was posted before the hot crawler started.
+
+    The position in the listing is checkpointed to a JSON file after every
+    page, so a restart resumes from the last finished page. A page is only
+    checkpointed once the database writer has committed its records and none
+    of its submissions failed in a way worth retrying, such as being cut off
+    by the crawl deadline or turned away by a throttling host, or failing to
+    be stored. Otherwise the page is crawled again; what was already stored
+    is then skipped by the seen index, which is why one is required. Sharing the seen index with the hot crawler
+    of the same subreddit keeps the two from downloading the same
+    submissions.
+
+    Reddit lists at most about a thousand submissions of any listing, so the
+    backfill finishes there. Crawling top of several windows reaches further.
+    """
+
+    def __init__(self, subreddit_name, db_connector, wallpaper_path,
+            thumbnail_path, checkpoint_path, listing='new', window='all',
+            pages=4, limit=50, **options):
+        """
+        Creates a backfill crawler, resuming from its checkpoint if there is
+        one.
+
+        Arguments:
+            subreddit_name<string>  -- Name of the subreddit to crawl.
+            db_connector            -- Write-behind database writer.
+            wallpaper_path<string>  -- Filesystem path to where wallpapers are
+                                       saved.
+            thumbnail_path<string>  -- Filesystem path to where thumbnails are
+                                       saved.
+            checkpoint_path<string> -- Directory checkpoint files are kept in.
+            listing<string>         -- Listing to page through, new or top.
+            window<string>          -- Time window of the top listing: hour,
+                                       day, week, month, year, or all.
+            pages<int>              -- Max pages crawled per crawl.
+            limit<int>              -- Submissions per page.
+            options                 -- Any further SubredditWallpaperCrawler
+                                       arguments. seen_index is required.
+        """
+        self.LISTINGS = ('new', 'top')
+        self.WINDOWS = ('hour', 'day', 'week', 'month', 'year', 'all')
+
+        if not checkpoint_path:
+            raise Exception('Checkpoint path cannot be empty.')
+        if listing not in self.LISTINGS:
+            raise Exception('Unknown backfill listing: %s' % listing)
+        if listing == 'top' and window not in self.WINDOWS:
+            raise Exception('Unknown backfill window: %s' % window)
+        if pages < 1:
+            raise Exception('Backfill pages per crawl must be positive.')
+        if not options.get('seen_index'):
+            raise Exception('Backfill needs a seen index to resume.')
+
+        options.setdefault('cache_size', pages * limit)
+
+        SubredditWallpaperCrawler.__init__(self, subreddit_name, db_connector,
+            wallpaper_path, thumbnail_path, limit, **options)
+
+        self.listing = listing
+        self.window = window if listing == 'top' else None
+        self.pages = pages
+
+        self.file_writer.make_directory(checkpoint_path)
+        name = '-'.join(n for n in [subreddit_name, listing, self.window] if n)
+        self.checkpoint_file = os.path.join(checkpoint_path,
+            re.sub('[^\w.-]+', '_', name) + '.json')
+        self.checkpoint = self.load_checkpoint()
+
+    def crawl(self, deadline=None):
+        """
+        Crawls the next pages of the listing, checkpointing after each one
+        once its records have been committed. Stops at a page with submissions
+        to retry, which the next crawl starts from. Does nothing once the end
+        of the listing has been reached.
+
+        Arguments:
+            deadline<float> -- Optional time in seconds since the epoch. No new
+                               pages or downloads are started once it has
+                               passed.
+        """
+        if self.checkpoint['done']:
+            return
+
+        crawl_start = time()
+        self.throttled_until = None
+        self.throttled_hosts = set()
+
+        for i in range(self.pages):
+            if deadline and time() >= deadline:
+                break
+
+            with self.metrics.timer('stage_seconds', self.labels('listing')):
+                listing = list(self.get_listing())
+
+            retry = self.handle_listing(listing, deadline)
+            self.db_connector.sync()
+
+            if retry:
+                print 'Backfill of %s will retry %d submissions of the ' \
+                    'page.' % (self.subreddit_name, len(retry))
+                break
+
+            self.checkpoint['pages'] += 1
+            self.checkpoint['items'] += len(listing)
+
+            if len(listing) < self.item_limit:
+                self.checkpoint['done'] = True
+            else:
+                self.checkpoint['after'] = 't3_%s' % listing[-1].id
+
+            self.save_checkpoint()
+
+            if self.checkpoint['done']:
+                print 'Backfill of %s finished after %d submissions.' % (
+                    self.subreddit_name, self.checkpoint['items'])
+                break
+
+        self.metrics.observe('crawl_seconds', time() - crawl_start,
+            self.labels(None))
+
+    def get_listing(self):
+        """
+        Gets the page of the listing after the checkpoint.
+
+        Returns:
+            Iterable of submissions.
+        """
+        if self.listing == 'new':
+            get_page = self.subreddit.get_new
+        else:
+            get_page = getattr(self.subreddit, 'get_top_from_' + self.window)
+
+        params = {}
+
+        if self.checkpoint['after']:
+            params['after'] = self.checkpoint['after']
+
+        return get_page(limit=self.item_limit, params=params)
+
+    def crawler_name(self):
+        """
+        Names this crawler in metrics and profiles, told apart from the hot
+        crawler and any other backfill of the same subreddit.
+
+        Returns:
+            The subreddit name followed by the listing and window.
+        """
+        return '%s/backfill-%s' % (self.subreddit_name,
+            '-'.join(n for n in [self.listing, self.window] if n))
+
+    def load_checkpoint(self):
+        """
+        Reads the checkpoint file. A missing file starts from the top of the
+        listing.
+
+        Returns:
+            Dictionary of after, the fullname of the last submission crawled,
+            the pages and items crawled so far, and whether the backfill is
+            done.
+        """
+        result = {'after': None, 'pages': 0, 'items': 0, 'done': False}
+
+        if os.path.isfile(self.checkpoint_file):
+            handler = open(self.checkpoint_file)
+            result.update(json.load(handler))
+            handler.close()
+
+        return result
+
+    def save_checkpoint(self):
+        """
+        Writes the checkpoint file, replacing it in one step so a crash never
+        leaves it half written.
+        """
+        self.checkpoint['updated'] = int(time())
+
+        temp_path = self.checkpoint_file + '.tmp'
+        handler = open(temp_path, 'w')
+        json.dump(self.checkpoint, handler)
+        handler.close()
+        os.rename(temp_path, self.checkpoint_file)
+
+    def __repr__(self):
+        return '<BackfillCrawler: %s>' % os.path.basename(self.checkpoint_file)
@@ -0,0 +1,80 @@
+# ==============================================================================
+# ByteBudget.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from threading import Condition
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class ByteBudget(object):
+    """
+    Caps the bytes of image data held at once across every concurrent
+    download. A download reserves its expected size before reading its body
+    and releases it once the wallpaper has been stored, waiting meanwhile if
+    the budget is spent.
+
+    A download larger than the whole budget is let through when nothing else
+    is in flight, so it is slowed down rather than refused.
+    """
+
+    def __init__(self, limit):
+        """
+        Creates a byte budget.
+
+        Arguments:
+            limit<int> -- Max bytes in flight.
+        """
+        if limit < 1:
+            raise Exception('Byte budget must be positive.')
+
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.condition = Condition()
+
+    def reserve(self, size):
+        """
+        Takes bytes from the budget, waiting until they fit.
+
+        Arguments:
+            size<int> -- Bytes to reserve.
+        """
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.limit:
+                self.condition.wait()
+
+            self.add(size)
+
+    def add(self, size):
+        """
+        Takes bytes from the budget without waiting, such as when a download
+        turns out larger than it said.
+
+        Arguments:
+            size<int> -- Bytes to take.
+        """
+        with self.condition:
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+
+    def release(self, size):
+        """
+        Hands bytes back to the budget and wakes any waiting downloads.
+
+        Arguments:
+            size<int> -- Bytes to hand back.
+        """
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+    def __repr__(self):
+        return '<ByteBudget: %d of %d bytes in flight>' % (self.in_flight,
+            self.limit)
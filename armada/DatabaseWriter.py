@@ -0,0 +1,209 @@
+# ==============================================================================
+# DatabaseWriter.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from Queue import Empty, Queue
+from threading import Event, Thread
+from time import time
+
+from Metrics import Metrics
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class DatabaseWriter(object):
+    """
+    Write-behind stage in front of a database connector. Crawlers queue image
+    metadata and carry on, while a background thread stores it in batches with
+    one commit per batch.
+    """
+
+    def __init__(self, db_connector, batch_size=50, flush_interval=5,
+            max_queued=0, metrics=None):
+        """
+        Creates a database writer and starts its background thread.
+
+        Arguments:
+            db_connector<MySQLConnector> -- Database to write to.
+            batch_size<int>              -- Max number of records committed
+                                            together.
+            flush_interval<float>        -- Max seconds a record waits for its
+                                            batch to fill.
+            max_queued<int>              -- Max number of records waiting to be
+                                            written. 0 means no limit.
+            metrics<Metrics>             -- Optional shared metrics registry.
+                                            Defaults to a private one.
+        """
+        if not db_connector:
+            raise Exception('Database connector must be initialized.')
+        if batch_size < 1:
+            raise Exception('Batch size must be positive.')
+        if flush_interval <= 0:
+            raise Exception('Flush interval must be positive.')
+
+        self.db_connector = db_connector
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.metrics = metrics if metrics else Metrics()
+
+        self.STOP = object()
+        self.SYNC = object()
+        self.queue = Queue(max_queued)
+
+        self.writer = Thread(target=self.write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def store(self, path, name, keywords, source, size, phash=None,
+            thumbnails=None, on_failure=None, on_success=None):
+        """
+        Queues image metadata to be stored. Takes the same arguments as the
+        connector's store(), and fails straight away if they are incomplete.
+
+        Arguments:
+            on_failure<function> -- Optional function called with no arguments,
+                                    on the writer thread, if the record could
+                                    not be stored.
+            on_success<function> -- Optional function called with no arguments,
+                                    on the writer thread, once the record has
+                                    been committed.
+        """
+        record = (path, name, keywords, source, size, phash, thumbnails)
+        self.db_connector.check_record(*record)
+        self.queue.put((record, on_success, on_failure))
+
+    def write(self):
+        """
+        Writer loop. Collects records into a batch until it is full or the
+        oldest record has waited the flush interval, then stores the batch.
+        A sync marker stores the batch straight away and is then set. Stops
+        once the stop marker has been reached.
+        """
+        stopping = False
+
+        while not stopping:
+            first = self.queue.get()
+
+            if first is self.STOP:
+                break
+
+            if first[0] is self.SYNC:
+                first[1].set()
+                continue
+
+            batch = [first]
+            synced = None
+            flush_at = time() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                remaining = flush_at - time()
+
+                if remaining <= 0:
+                    break
+
+                try:
+                    item = self.queue.get(True, remaining)
+                except Empty:
+                    break
+
+                if item is self.STOP:
+                    stopping = True
+                    break
+
+                if item[0] is self.SYNC:
+                    synced = item[1]
+                    break
+
+                batch.append(item)
+
+            self.flush(batch)
+
+            if synced:
+                synced.set()
+
+    def flush(self, batch):
+        """
+        Stores a batch of records in one transaction. If the batch fails, each
+        record is retried on its own so one bad record cannot sink the rest.
+
+        Arguments:
+            batch<[tuple]> -- Tuples of a record and its success and failure
+                              callbacks.
+        """
+        labels = {'stage': 'db_write'}
+
+        try:
+            with self.metrics.timer('stage_seconds', labels):
+                self.db_connector.store_batch([item[0] for item in batch])
+
+            self.metrics.increment('db_records_total', {'result': 'written'},
+                len(batch))
+            print 'Wrote batch of %d wallpapers to database.' % len(batch)
+
+            for record, on_success, on_failure in batch:
+                self.notify(on_success, record)
+
+            return
+        except Exception as error:
+            self.metrics.increment('errors_total', labels)
+            print 'Unable to write batch, retrying singly. Details: %s' % error
+
+        for record, on_success, on_failure in batch:
+            try:
+                with self.metrics.timer('stage_seconds', labels):
+                    self.db_connector.store_batch([record])
+
+                self.metrics.increment('db_records_total',
+                    {'result': 'written'})
+            except Exception as error:
+                self.metrics.increment('db_records_total',
+                    {'result': 'failed'})
+                print 'Unable to write %s. Details: %s' % (record[1], error)
+
+                self.notify(on_failure, record)
+                continue
+
+            self.notify(on_success, record)
+
+    def notify(self, callback, record):
+        """
+        Calls a record's callback, if it has one. A failing callback is
+        reported rather than stopping the writer thread.
+
+        Arguments:
+            callback<function> -- Callback to call with no arguments, or None.
+            record<tuple>      -- Record the callback belongs to.
+        """
+        if not callback:
+            return
+
+        try:
+            callback()
+        except Exception as error:
+            print 'Callback failed for %s. Details: %s' % (record[1], error)
+
+    def sync(self):
+        """
+        Waits until every record queued so far has been committed or has
+        failed, and its callbacks have been called. Records waiting for their
+        batch to fill are written straight away.
+        """
+        synced = Event()
+        self.queue.put((self.SYNC, synced))
+        synced.wait()
+
+    def close(self):
+        """
+        Writes everything still queued, then stops the writer thread.
+        """
+        self.queue.put(self.STOP)
+        self.writer.join()
+
+    def __repr__(self):
+        return '<DatabaseWriter: %s>' % self.db_connector
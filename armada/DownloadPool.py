@@ -0,0 +1,210 @@
+# ==============================================================================
+# DownloadPool.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from collections import deque
+from Queue import Queue
+from threading import Lock, Thread, current_thread
+from time import time
+from urlparse import urlparse
+
+
+# ------------------------------------------------------------------------------
+# Classes
+# ------------------------------------------------------------------------------
+
+class DeadlinePassed(Exception):
+    """
+    Raised for a job that was not started because its deadline had passed.
+    """
+
+    def __init__(self):
+        Exception.__init__(self, 'Deadline passed.')
+
+
+class DownloadPool(object):
+    """
+    A fixed pool of download threads shared by every crawler. Limits both the
+    total number of downloads in flight and the number in flight to any single
+    host. Timeouts are left to the HTTP client doing the download.
+
+    A worker never waits for a busy host. A job for a host already at its
+    limit is parked, and the next worker to finish a job for that host takes
+    it, so jobs for other hosts are not stuck behind it.
+    """
+
+    def __init__(self, workers=8, host_limit=4):
+        """
+        Creates a download pool and starts its worker threads.
+
+        Arguments:
+            workers<int>    -- Max number of downloads in flight.
+            host_limit<int> -- Max number of downloads in flight per host.
+        """
+        if workers < 1:
+            raise Exception('Download pool needs at least one worker.')
+        if host_limit < 1:
+            raise Exception('Per host download limit must be positive.')
+
+        self.worker_count = workers
+        self.host_limit = host_limit
+
+        self.tasks = Queue()
+        self.host_active = {}
+        self.host_waiting = {}
+        self.host_lock = Lock()
+
+        self.workers = []
+        for i in range(self.worker_count):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def run(self, jobs, fetch, deadline=None):
+        """
+        Downloads every job on the pool and yields the results in the order
+        they finish.
+
+        Arguments:
+            jobs<[(string, object)]> -- URL to download and the item it
+                                        belongs to.
+            fetch<function>          -- Called as fetch(url) on a worker
+                                        thread. Its return value is the result
+                                        of the job.
+            deadline<float>          -- Optional time in seconds since the
+                                        epoch after which no new jobs start.
+
+        Returns:
+            Generator of (item, result, error) tuples. Exactly one of result
+            and error is set. Jobs not started by the deadline get a
+            DeadlinePassed error.
+        """
+        results = Queue()
+        owner = current_thread().ident
+
+        for url, item in jobs:
+            self.tasks.put((url, item, fetch, deadline, results, owner))
+
+        for i in range(len(jobs)):
+            yield results.get()
+
+    def work(self):
+        """
+        Worker loop. Takes jobs off the queue and runs those whose host has a
+        free download slot, parking the rest. Once a job is done, the worker
+        runs the next parked job of the same host, if there is one.
+        """
+        worker = current_thread()
+
+        while True:
+            task = self.tasks.get()
+            host = urlparse(task[0]).netloc.lower()
+
+            if self.is_late(task) or not self.take_slot(host, task):
+                continue
+
+            while task:
+                if not self.is_late(task):
+                    self.run_task(worker, task)
+
+                task = self.release_slot(host)
+
+    def run_task(self, worker, task):
+        """
+        Runs a job and hands over its result. While it runs, the worker
+        thread's owner_ident is the thread that submitted it, so a profiler
+        can tell which crawl the work belongs to.
+
+        Arguments:
+            worker<Thread> -- Worker thread running the job.
+            task<tuple>    -- URL, item, fetch, deadline, results queue, and
+                              owner of the job.
+        """
+        url, item, fetch, deadline, results, owner = task
+        worker.owner_ident = owner
+
+        try:
+            results.put((item, fetch(url), None))
+        except Exception as error:
+            results.put((item, None, error))
+        finally:
+            worker.owner_ident = None
+
+    def is_late(self, task):
+        """
+        Checks if a job's deadline has passed, handing over a DeadlinePassed
+        error for it if so.
+
+        Arguments:
+            task<tuple> -- Job to check.
+
+        Returns:
+            True if the job must not be started, else False.
+        """
+        url, item, fetch, deadline, results, owner = task
+
+        if deadline and time() > deadline:
+            results.put((item, None, DeadlinePassed()))
+            return True
+
+        return False
+
+    def take_slot(self, host, task):
+        """
+        Takes a download slot for a host, or parks the job if the host is at
+        its limit.
+
+        Arguments:
+            host<string> -- Host of the job.
+            task<tuple>  -- Job wanting the slot.
+
+        Returns:
+            True if the slot was taken, else False if the job was parked.
+        """
+        with self.host_lock:
+            active = self.host_active.get(host, 0)
+
+            if active < self.host_limit:
+                self.host_active[host] = active + 1
+                return True
+
+            self.host_waiting.setdefault(host, deque()).append(task)
+
+        return False
+
+    def release_slot(self, host):
+        """
+        Gives up a download slot for a host, unless a job is parked for the
+        host, in which case the slot passes to that job.
+
+        Arguments:
+            host<string> -- Host of the finished job.
+
+        Returns:
+            The parked job to run next, or None if the slot was given up.
+        """
+        with self.host_lock:
+            waiting = self.host_waiting.get(host)
+
+            if waiting:
+                task = waiting.popleft()
+
+                if not waiting:
+                    del self.host_waiting[host]
+
+                return task
+
+            self.host_active[host] -= 1
+
+            if not self.host_active[host]:
+                del self.host_active[host]
+
+        return None
+
+    def __repr__(self):
+        return '<DownloadPool: %d workers>' % self.worker_count
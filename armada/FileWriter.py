@@ -6,7 +6,10 @@
 # Imports
 # ------------------------------------------------------------------------------
 
+import errno
 import os
+import shutil
+import tempfile
 
 
 # ------------------------------------------------------------------------------
@@ -16,20 +19,70 @@ import os
 class FileWriter(object):
     """
     Manages writing image files to the filesystem.
+
+    Files are sharded into subdirectories named after the first characters of
+    the file name, so a name like 3fa9c01d2e.jpg is stored at
+    <path>/3f/3fa9c01d2e.jpg. Image names are hashes, so the shards fill
+    evenly and no directory grows too large to search quickly.
+
+    Writes go to a temporary file that is hard linked into place once it is
+    complete. A file at its final name is therefore always whole, and linking
+    fails if the name is taken, so two writers can never both create it.
     """
 
-    def __init__(self):
+    def __init__(self, shard_length=2):
         """
         Creates a file writer.
+
+        Arguments:
+            shard_length<int> -- Number of name characters in a shard
+                                 directory name. Zero stores files flat.
+        """
+        if shard_length < 0:
+            raise Exception('Shard length cannot be negative.')
+
+        self.FILE_MODE = 0644
+
+        self.shard_length = shard_length
+
+    def locate(self, path, name):
+        """
+        Finds where a file is stored.
+
+        Arguments:
+            path<string> -- Absolute filesystem path.
+            name<string> -- File name, including extension.
+
+        Returns:
+            Absolute path including the shard directory and file name.
+        """
+        return os.path.join(self.shard_path(path, name), name)
+
+    def shard_path(self, path, name):
+        """
+        Finds the shard directory a file belongs in.
+
+        Arguments:
+            path<string> -- Absolute filesystem path.
+            name<string> -- File name, including extension.
+
+        Returns:
+            Absolute path of the shard directory.
         """
-        pass
+        result = path
 
-    def file_exists(self, path):
+        if self.shard_length:
+            result = os.path.join(path, name[:self.shard_length])
+
+        return result
+
+    def file_exists(self, path, name):
         """
-        Checks if a file exists given the absolute path.
+        Checks if a file exists.
 
         Arguments:
-            path<string> -- Absolute path including filename.
+            path<string> -- Absolute filesystem path.
+            name<string> -- File name, including extension.
 
         Returns:
             True if the file exists, else False.
@@ -37,17 +90,18 @@ class FileWriter(object):
         result = False
 
         try:
-            result = os.path.isfile(path)
+            result = os.path.isfile(self.locate(path, name))
         except Exception as error:
-            print 'Unable to check if file exists: %s. Details: %s' % (path,
+            print 'Unable to check if file exists: %s. Details: %s' % (name,
                 error)
 
         return result
 
     def write(self, content, path, name):
         """
-        Write the content to the given file. Silently continues without writing
-        if the file already exists.
+        Write the content to the given file, unless it already exists. The
+        check and the write are one step, so the file is only ever created
+        once.
 
         Arguments:
             content<string> -- Blob content to write to file.
@@ -55,25 +109,121 @@ class FileWriter(object):
             name<string>    -- File name, including extension.
 
         Returns:
-            True if the file was written, else False.
+            True if the file was written, else False if it already existed.
+        """
+        return self.write_with(lambda handler: handler.write(content), path,
+            name)
+
+    def write_file(self, source_path, path, name):
+        """
+        Stores a finished file, such as a streamed download, unless the name
+        already exists. The file is hard linked into place when it is on the
+        same filesystem, and copied otherwise. The source file is left for the
+        caller to remove.
+
+        Arguments:
+            source_path<string> -- Filesystem path of the file to store.
+            path<string>        -- Absolute filesystem path.
+            name<string>        -- File name, including extension.
+
+        Returns:
+            True if the file was written, else False if it already existed.
         """
         result = False
 
-        if not self.file_exists(path + name):
-            handler = open(path + name, 'w')
-            handler.write(content)
+        shard = self.shard_path(path, name)
+        self.make_directory(shard)
+
+        source = open(source_path, 'rb')
+
+        try:
+            os.fsync(source.fileno())
+            os.chmod(source_path, self.FILE_MODE)
+            os.link(source_path, os.path.join(shard, name))
+            result = True
+        except OSError as error:
+            if error.errno == errno.EXDEV:
+                result = self.write_with(
+                    lambda handler: shutil.copyfileobj(source, handler),
+                    path, name)
+            elif error.errno != errno.EEXIST:
+                raise
+        finally:
+            source.close()
+
+        return result
+
+    def write_with(self, fill, path, name):
+        """
+        Creates a file through a temporary file that is hard linked into place
+        once it is complete, unless the name already exists.
+
+        Arguments:
+            fill<function> -- Called as fill(handler) to write the content.
+            path<string>   -- Absolute filesystem path.
+            name<string>   -- File name, including extension.
+
+        Returns:
+            True if the file was written, else False if it already existed.
+        """
+        result = False
+
+        shard = self.shard_path(path, name)
+        self.make_directory(shard)
+
+        descriptor, temp_path = tempfile.mkstemp(prefix='.' + name,
+            suffix='.tmp', dir=shard)
+
+        try:
+            handler = os.fdopen(descriptor, 'wb')
+            fill(handler)
+            handler.flush()
+            os.fsync(handler.fileno())
             handler.close()
+
+            os.chmod(temp_path, self.FILE_MODE)
+            os.link(temp_path, os.path.join(shard, name))
             result = True
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        finally:
+            os.remove(temp_path)
 
         return result
 
     def unwrite(self, path, name):
         """
-        Rolls back a write at the given path if the file exists. If the file
-        does not exist, fails silently.
+        Rolls back a write if the file exists. If the file does not exist,
+        fails silently.
 
         Arguments:
-            path<string> -- Absolute path including filename.
+            path<string> -- Absolute filesystem path.
+            name<string> -- File name, including extension.
+
+        Returns:
+            True if the file was removed, else False.
         """
-        if self.file_exists(path + name):
-            handler = os.remove(path + name)
+        result = False
+
+        try:
+            os.remove(self.locate(path, name))
+            result = True
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+        return result
+
+    def make_directory(self, path):
+        """
+        Creates a directory and its parents, if they do not already exist.
+
+        Arguments:
+            path<string> -- Absolute filesystem path.
+        """
+        try:
+            os.makedirs(path)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
@@ -0,0 +1,393 @@
+# ==============================================================================
+# HttpClient.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+import httplib
+import socket
+from threading import Lock
+from urlparse import urljoin, urlparse
+import zlib
+
+from RateLimiter import RateLimited, TransientError
+
+
+# ------------------------------------------------------------------------------
+# Classes
+# ------------------------------------------------------------------------------
+
+class HttpResponse(object):
+    """
+    A response from the HttpClient. Reads are capped at the client's max
+    response size and gzip bodies are decoded as they are read. Closing a
+    fully read response hands its connection back to the client for reuse.
+    """
+
+    def __init__(self, client, key, connection, response, url):
+        """
+        Wraps an httplib response.
+
+        Arguments:
+            client<HttpClient>         -- Client the connection belongs to.
+            key<tuple>                 -- Pool key of the connection.
+            connection<HTTPConnection> -- Connection the response came on.
+            response<HTTPResponse>     -- Response to wrap.
+            url<string>                -- Absolute URL that was requested.
+        """
+        self.client = client
+        self.key = key
+        self.connection = connection
+        self.response = response
+
+        self.url = url
+        self.status = response.status
+        self.headers = dict(response.getheaders())
+
+        self.bytes_read = 0
+        self.decoder = None
+
+        if self.headers.get('content-encoding', '').lower() == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=None):
+        """
+        Reads up to size bytes of the body, or all of it if size is None.
+
+        Arguments:
+            size<int> -- Optional max number of bytes to return.
+
+        Returns:
+            Body bytes. An empty string once the body has been read.
+        """
+        if size is None:
+            chunks = []
+
+            while True:
+                chunk = self.read(self.client.CHUNK_SIZE)
+
+                if not chunk:
+                    return ''.join(chunks)
+
+                chunks.append(chunk)
+
+        while True:
+            raw = self.response.read(size)
+
+            if not raw:
+                data = self.decoder.flush() if self.decoder else ''
+                self.decoder = None
+            elif self.decoder:
+                data = self.decoder.decompress(raw)
+            else:
+                data = raw
+
+            self.bytes_read += len(data)
+
+            if self.bytes_read > self.client.max_size:
+                self.close()
+                raise Exception('Response from %s is over %d bytes.' % (
+                    self.url, self.client.max_size))
+
+            if data or not raw:
+                return data
+
+    def close(self):
+        """
+        Finishes with the response. The connection is reused if the body was
+        read to the end and the server keeps connections alive, else closed.
+        """
+        if not self.connection:
+            return
+
+        if self.response.isclosed() and not self.response.will_close:
+            self.client.release(self.key, self.connection)
+        else:
+            self.connection.close()
+
+        self.connection = None
+
+    def __repr__(self):
+        return '<HttpResponse: %d %s>' % (self.status, self.url)
+
+
+class HttpClient(object):
+    """
+    HTTP client shared by wallpapers and crawlers. Keeps a pool of keep-alive
+    connections for each host, so repeat requests skip the TCP and TLS
+    handshakes.
+    """
+
+    def __init__(self, connect_timeout=10, read_timeout=30,
+            max_size=52428800, max_idle=8,
+            user_agent='cutter -- Wallpaper Scraper 0.1 -- /u/expat_one',
+            rate_limiter=None):
+        """
+        Creates an HTTP client.
+
+        Arguments:
+            connect_timeout<int>      -- Seconds to wait for a connection.
+            read_timeout<int>         -- Seconds to wait on each read.
+            max_size<int>             -- Max bytes in a response body.
+            max_idle<int>             -- Max idle connections kept for each
+                                         host.
+            user_agent<string>        -- User agent sent with every request.
+            rate_limiter<RateLimiter> -- Optional limiter every request waits
+                                         its turn with. Throttling responses
+                                         then raise RateLimited, and server
+                                         errors and dropped connections raise
+                                         TransientError until the URL has
+                                         used up its retries.
+        """
+        self.CHUNK_SIZE = 16384
+        self.MAX_REDIRECTS = 5
+        self.REDIRECTS = (301, 302, 303, 307, 308)
+
+        if max_size < 1:
+            raise Exception('Max response size must be positive.')
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.user_agent = user_agent
+        self.rate_limiter = rate_limiter
+
+        self.idle = {}
+        self.lock = Lock()
+
+    def open(self, url, headers=None, accept_gzip=False):
+        """
+        Requests a URL, following redirects. The caller must close() the
+        response.
+
+        Arguments:
+            url<string>       -- Absolute http or https URL.
+            headers<dict>     -- Optional extra request headers.
+            accept_gzip<bool> -- If True, ask for a gzip body. Use for pages,
+                                 not images.
+
+        Returns:
+            HttpResponse for the final URL.
+        """
+        request_headers = {'User-Agent': self.user_agent}
+
+        if accept_gzip:
+            request_headers['Accept-Encoding'] = 'gzip'
+        if headers:
+            request_headers.update(headers)
+
+        for i in range(self.MAX_REDIRECTS + 1):
+            response = self.request(url, request_headers)
+
+            if response.status not in self.REDIRECTS:
+                return response
+
+            location = response.headers.get('location')
+            self.drain(response)
+
+            if not location:
+                raise Exception('Redirect from %s has no location.' % url)
+
+            url = urljoin(url, location)
+
+        raise Exception('Too many redirects from %s.' % url)
+
+    def get(self, url, headers=None, accept_gzip=False):
+        """
+        Requests a URL and reads the whole body.
+
+        Arguments:
+            url<string>       -- Absolute http or https URL.
+            headers<dict>     -- Optional extra request headers.
+            accept_gzip<bool> -- If True, ask for a gzip body.
+
+        Returns:
+            Body of the response.
+        """
+        response = self.open(url, headers, accept_gzip)
+
+        try:
+            if response.status != 200:
+                raise Exception('HTTP %d from %s.' % (response.status, url))
+
+            return response.read()
+        finally:
+            response.close()
+
+    def request(self, url, headers):
+        """
+        Sends a single GET request on a pooled connection. With a rate
+        limiter, the request waits its turn, RateLimited is raised if the host
+        is throttling, and TransientError if the URL failed in a way worth
+        retrying later.
+
+        Arguments:
+            url<string>   -- Absolute http or https URL.
+            headers<dict> -- Request headers.
+
+        Returns:
+            HttpResponse for the URL.
+        """
+        parts = urlparse(url)
+
+        if parts.scheme not in ('http', 'https'):
+            raise Exception('Unsupported URL: %s' % url)
+
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+
+        if parts.query:
+            path += '?' + parts.query
+
+        if self.rate_limiter:
+            self.rate_limiter.acquire(parts.hostname)
+
+        try:
+            result = self.send(key, path, headers, url)
+        except (httplib.HTTPException, socket.error) as error:
+            if self.rate_limiter and self.rate_limiter.retry_url(url):
+                raise TransientError(url, error)
+
+            raise
+
+        if self.rate_limiter:
+            blocked = self.rate_limiter.record(parts.hostname, result.status,
+                result.headers.get('retry-after'), url)
+
+            if blocked:
+                self.drain(result)
+                raise RateLimited(parts.hostname, blocked)
+
+            if result.status in self.rate_limiter.SERVER_ERRORS and \
+                    self.rate_limiter.retry_url(url):
+                self.drain(result)
+                raise TransientError(url, 'HTTP %d' % result.status)
+
+        return result
+
+    def send(self, key, path, headers, url):
+        """
+        Sends a GET request on a pooled connection. A reused connection the
+        server has since closed is replaced and the request resent once.
+
+        Arguments:
+            key<tuple>    -- Scheme, host, and port.
+            path<string>  -- Path and query to request.
+            headers<dict> -- Request headers.
+            url<string>   -- Absolute URL being requested.
+
+        Returns:
+            HttpResponse for the URL.
+        """
+        connection, reused = self.acquire(key)
+
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+
+            if not reused:
+                raise
+
+            connection, reused = self.connect(key), False
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+
+        return HttpResponse(self, key, connection, response, url)
+
+    def acquire(self, key):
+        """
+        Takes an idle connection to a host, or opens a new one.
+
+        Arguments:
+            key<tuple> -- Scheme, host, and port.
+
+        Returns:
+            Tuple of the connection and whether it was reused.
+        """
+        with self.lock:
+            idle = self.idle.get(key)
+
+            if idle:
+                return idle.pop(), True
+
+        return self.connect(key), False
+
+    def connect(self, key):
+        """
+        Opens a new connection using the connect timeout, then switches the
+        socket to the read timeout.
+
+        Arguments:
+            key<tuple> -- Scheme, host, and port.
+
+        Returns:
+            Connected HTTPConnection.
+        """
+        scheme, host, port = key
+
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port,
+                timeout=self.connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port,
+                timeout=self.connect_timeout)
+
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+
+        return connection
+
+    def release(self, key, connection):
+        """
+        Keeps a connection for reuse, unless the host already has enough idle
+        connections.
+
+        Arguments:
+            key<tuple>                 -- Scheme, host, and port.
+            connection<HTTPConnection> -- Connection with no pending response.
+        """
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    def drain(self, response):
+        """
+        Reads and discards a small body, such as a redirect's, so the
+        connection can be reused. Larger bodies are not worth reading.
+
+        Arguments:
+            response<HttpResponse> -- Response to finish with.
+        """
+        try:
+            length = int(response.headers.get('content-length', -1))
+
+            if 0 <= length <= self.CHUNK_SIZE:
+                response.read()
+        except Exception:
+            pass
+
+        response.close()
+
+    def close(self):
+        """
+        Closes every idle connection.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def __repr__(self):
+        return '<HttpClient>'
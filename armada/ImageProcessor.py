@@ -0,0 +1,238 @@
+# ==============================================================================
+# ImageProcessor.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from multiprocessing import Pool, cpu_count
+from PIL import Image
+import StringIO
+from time import time
+
+
+# ------------------------------------------------------------------------------
+# Helper functions
+# ------------------------------------------------------------------------------
+
+def difference_hash(image_data, hash_size=8):
+    """
+    Creates a perceptual difference hash (dHash) of an image. Each bit records
+    whether a pixel of a small greyscale copy is brighter than its right hand
+    neighbour, so resized or recompressed copies hash to nearby values.
+
+    Arguments:
+        image_data<Image> -- Decoded image.
+        hash_size<int>    -- Hash is hash_size squared bits long.
+
+    Returns:
+        Integer hash.
+    """
+    small = image_data.convert('L').resize((hash_size + 1, hash_size),
+        Image.ANTIALIAS)
+    pixels = list(small.getdata())
+
+    result = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            result = (result << 1) | (left > right)
+
+    return result
+
+def check_thumbnail_specs(thumbnail_specs):
+    """
+    Checks a list of thumbnail specs can be made, so a bad config fails at
+    start up rather than on every image.
+
+    Arguments:
+        thumbnail_specs<[tuple]> -- (name, width, height, format, quality)
+                                    tuples. A format of None keeps the
+                                    source format, and a quality of None
+                                    uses the encoder's default.
+    """
+    Image.init()
+    names = set()
+
+    if not thumbnail_specs:
+        raise Exception('At least one thumbnail size is needed.')
+
+    for name, width, height, image_format, quality in thumbnail_specs:
+        if not name or name in names:
+            raise Exception('Thumbnail names must be unique and not empty.')
+        if width < 1 or height < 1:
+            raise Exception('Thumbnail %s must have a positive size.' % name)
+        if image_format and image_format not in Image.SAVE:
+            raise Exception('Unable to save thumbnails as %s.' % image_format)
+        if quality is not None and not 1 <= quality <= 100:
+            raise Exception('Thumbnail %s quality must be 1 to 100.' % name)
+
+        names.add(name)
+
+def encode_thumbnail(image_data, image_format, quality):
+    """
+    Encodes a thumbnail, converting its colour mode if the format needs it.
+
+    Arguments:
+        image_data<Image>    -- Resized image.
+        image_format<string> -- PIL format name to save as.
+        quality<int>         -- Optional encoder quality, 1 to 100.
+
+    Returns:
+        Encoded thumbnail blob.
+    """
+    if image_format == 'JPEG' and image_data.mode not in ('RGB', 'L'):
+        image_data = image_data.convert('RGB')
+    elif image_format == 'WEBP' and image_data.mode not in ('RGB', 'RGBA'):
+        image_data = image_data.convert('RGBA')
+
+    options = {'quality': quality} if quality is not None else {}
+
+    out_buffer = StringIO.StringIO()
+    image_data.save(out_buffer, image_format, **options)
+
+    return out_buffer.getvalue()
+
+def process_image(image_blob, thumbnail_specs, image_path=None):
+    """
+    Decodes an image and creates its thumbnails. Defined at module level so it
+    can be sent to worker processes; only the blob goes in and only encoded
+    bytes and metadata come out.
+
+    JPEGs are decoded in draft mode, straight to the smallest scale still
+    larger than the biggest thumbnail, rather than at full resolution. Each
+    smaller thumbnail is then scaled down from the one before it rather than
+    from the full image.
+
+    Arguments:
+        image_blob<string>       -- Full image blob, or None if the image is
+                                    in a file.
+        thumbnail_specs<[tuple]> -- (name, width, height, format, quality)
+                                    tuples, as checked by
+                                    check_thumbnail_specs().
+        image_path<string>       -- Optional file to decode the image from
+                                    instead of the blob.
+
+    Returns:
+        Dictionary with the image's width, height, format, and perceptual
+        hash, a list of thumbnails in spec order, and the seconds spent
+        decoding and thumbnailing. Each thumbnail is a dictionary with its
+        name, width, height, format, and blob.
+    """
+    start = time()
+
+    if image_path:
+        image_data = Image.open(image_path)
+    else:
+        image_data = Image.open(StringIO.StringIO(image_blob))
+
+    width, height = image_data.size
+    image_format = image_data.format
+
+    largest = (max(spec[1] for spec in thumbnail_specs),
+        max(spec[2] for spec in thumbnail_specs))
+    image_data.draft(image_data.mode, largest)
+    image_data.load()
+    decoded = time()
+
+    by_size = sorted(thumbnail_specs, key=lambda spec: spec[1] * spec[2],
+        reverse=True)
+    thumbnails = {}
+    source = image_data
+    phash = None
+
+    for name, max_width, max_height, thumbnail_format, quality in by_size:
+        if source.size[0] < max_width or source.size[1] < max_height:
+            source = image_data
+
+        thumbnail_data = source.copy()
+        thumbnail_data.thumbnail((max_width, max_height), Image.ANTIALIAS)
+
+        if phash is None:
+            phash = difference_hash(thumbnail_data)
+
+        thumbnail_format = thumbnail_format or image_format
+        thumbnails[name] = {
+            'name': name,
+            'width': thumbnail_data.size[0],
+            'height': thumbnail_data.size[1],
+            'format': thumbnail_format,
+            'blob': encode_thumbnail(thumbnail_data, thumbnail_format,
+                quality)
+        }
+        source = thumbnail_data
+
+    return {
+        'width': width,
+        'height': height,
+        'format': image_format,
+        'phash': phash,
+        'thumbnails': [thumbnails[spec[0]] for spec in thumbnail_specs],
+        'decode_seconds': decoded - start,
+        'thumbnail_seconds': time() - decoded
+    }
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class ImageProcessor(object):
+    """
+    Runs image decoding and thumbnailing, either inline on the calling thread
+    or on a pool of worker processes so resizing does not hold the GIL.
+    """
+
+    def __init__(self, processes=None, timeout=300):
+        """
+        Creates an image processor. Create it before starting any threads, as
+        the worker processes are forked from the current process.
+
+        Arguments:
+            processes<int> -- Number of worker processes. None uses one per
+                              core, and 0 processes images inline.
+            timeout<int>   -- Max seconds to wait on a single image.
+        """
+        if processes is not None and processes < 0:
+            raise Exception('Number of image processes cannot be negative.')
+
+        self.processes = cpu_count() if processes is None else processes
+        self.timeout = timeout
+        self.pool = Pool(self.processes) if self.processes else None
+
+    def process(self, image_blob, thumbnail_specs, image_path=None):
+        """
+        Decodes an image and creates its thumbnails.
+
+        Arguments:
+            image_blob<string>       -- Full image blob, or None if the image
+                                        is in a file.
+            thumbnail_specs<[tuple]> -- (name, width, height, format, quality)
+                                        tuples.
+            image_path<string>       -- Optional file to decode the image
+                                        from instead of the blob.
+
+        Returns:
+            Dictionary with the image's width, height, format, perceptual
+            hash, and thumbnails.
+        """
+        if not self.pool:
+            return process_image(image_blob, thumbnail_specs, image_path)
+
+        pending = self.pool.apply_async(process_image,
+            (image_blob, thumbnail_specs, image_path))
+
+        return pending.get(self.timeout)
+
+    def close(self):
+        """
+        Stops the worker processes, if any.
+        """
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+    def __repr__(self):
+        return '<ImageProcessor: %d processes>' % self.processes
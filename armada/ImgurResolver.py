@@ -0,0 +1,237 @@
+# ==============================================================================
+# ImgurResolver.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+import json
+import os
+import re
+from threading import Lock
+from time import time
+from urlparse import urlparse
+
+
+# ------------------------------------------------------------------------------
+# Helper functions
+# ------------------------------------------------------------------------------
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def is_direct_image(url):
+    """
+    Checks if a URL links straight to an image file, going by the extension
+    of its path. Any query string or fragment is ignored.
+
+    Arguments:
+        url<string> -- Absolute URL.
+
+    Returns:
+        True if the URL is a direct image link, else False.
+    """
+    return urlparse(url).path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class ImgurResolver(object):
+    """
+    Turns submission URLs into direct image URLs. Direct image links resolve to
+    themselves, imgur pages to the image they show, and imgur albums and
+    galleries to every image in them.
+
+    Page lookups are cached, optionally in a file that survives restarts. A
+    cached page is trusted for max_age seconds, then revalidated with a
+    conditional request so an unchanged page is not downloaded again.
+    """
+
+    def __init__(self, http_client, cache_path=None, max_age=86400,
+            max_images=20, max_entries=100000):
+        """
+        Creates a resolver, loading the cache file if there is one.
+
+        Arguments:
+            http_client<HttpClient> -- Client to fetch pages with.
+            cache_path<string>      -- Optional file to keep the cache in.
+            max_age<int>            -- Seconds a cached page is trusted before
+                                       it is revalidated.
+            max_images<int>         -- Max images taken from one album.
+            max_entries<int>        -- Max pages kept in the cache.
+        """
+        if not http_client:
+            raise Exception('HTTP client must be initialized.')
+
+        self.image_re = re.compile(
+            '(?P<link>i\.imgur\.com/\w+\.(?:jpe?g|png))')
+
+        self.http_client = http_client
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.max_images = max_images
+        self.max_entries = max_entries
+
+        self.lock = Lock()
+        self.cache = {}
+        self.changed = False
+
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                self.cache = json.load(open(cache_path))
+            except Exception as error:
+                print 'Unable to load resolver cache: %s. Details: %s' % (
+                    cache_path, error)
+
+    def resolve(self, url):
+        """
+        Finds the image URLs behind a submission URL.
+
+        Arguments:
+            url<string> -- Absolute URL of an image or page.
+
+        Returns:
+            List of direct image URLs. Empty if none could be found.
+        """
+        if is_direct_image(url):
+            return [url]
+
+        parts = urlparse(url)
+
+        if not parts.netloc.lower().endswith('imgur.com'):
+            return []
+
+        return self.resolve_page(url, self.is_album(parts.path))
+
+    def is_album(self, path):
+        """
+        Checks if an imgur path is an album or gallery, which may hold several
+        images.
+
+        Arguments:
+            path<string> -- Path part of an imgur URL.
+
+        Returns:
+            True for albums and galleries, else False.
+        """
+        return path.startswith('/a/') or path.startswith('/gallery/')
+
+    def resolve_page(self, url, album):
+        """
+        Finds the images on an imgur page, using the cache where it is fresh
+        and revalidating it where it is not.
+
+        Arguments:
+            url<string> -- Absolute URL of the page.
+            album<bool> -- If True, keep every image, else only the first.
+
+        Returns:
+            List of direct image URLs.
+        """
+        with self.lock:
+            entry = self.cache.get(url)
+
+        if entry and time() - entry['checked'] < self.max_age:
+            return entry['images']
+
+        headers = {}
+
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.http_client.open(url, headers, accept_gzip=True)
+
+        try:
+            if response.status == 304 and entry:
+                images = entry['images']
+            elif response.status == 200:
+                images = self.find_images(response.read(), album)
+            else:
+                raise Exception('HTTP %d from %s.' % (response.status, url))
+
+            etag = response.headers.get('etag')
+            last_modified = response.headers.get('last-modified')
+        finally:
+            response.close()
+
+        self.remember(url, {
+            'images': images,
+            'etag': etag,
+            'last_modified': last_modified,
+            'checked': time()
+        })
+
+        return images
+
+    def find_images(self, page_source, album):
+        """
+        Looks through an imgur page for image URLs.
+
+        Arguments:
+            page_source<string> -- HTML of the page.
+            album<bool>         -- If True, keep every image, else only the
+                                   first.
+
+        Returns:
+            List of direct image URLs, in page order without repeats.
+        """
+        result = []
+        limit = self.max_images if album else 1
+
+        for match in self.image_re.finditer(page_source):
+            image_url = 'http://' + match.group('link')
+
+            if image_url not in result:
+                result.append(image_url)
+
+            if len(result) == limit:
+                break
+
+        return result
+
+    def remember(self, url, entry):
+        """
+        Caches a page lookup, dropping the longest unchecked pages if the cache
+        is full.
+
+        Arguments:
+            url<string>  -- Absolute URL of the page.
+            entry<dict>  -- Images and validators of the page.
+        """
+        with self.lock:
+            self.cache[url] = entry
+            self.changed = True
+
+            if len(self.cache) > self.max_entries:
+                by_age = sorted(self.cache,
+                    key=lambda k: self.cache[k]['checked'])
+
+                for stale in by_age[:len(self.cache) - self.max_entries]:
+                    del self.cache[stale]
+
+    def flush(self):
+        """
+        Writes the cache to its file, if it has one and it has changed. The
+        file is replaced in one step so a crash never leaves it half written.
+        """
+        if not self.cache_path:
+            return
+
+        with self.lock:
+            if not self.changed:
+                return
+
+            temp_path = self.cache_path + '.tmp'
+            handler = open(temp_path, 'w')
+            json.dump(self.cache, handler)
+            handler.close()
+            os.rename(temp_path, self.cache_path)
+
+            self.changed = False
+
+    def __repr__(self):
+        return '<ImgurResolver: %d cached pages>' % len(self.cache)
@@ -0,0 +1,171 @@
+# ==============================================================================
+# KeywordExtractor.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from nltk.corpus import stopwords
+import re
+from threading import Lock
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class KeywordExtractor(object):
+    """
+    Turns submission titles into keywords and phrases. Stopwords and patterns
+    are loaded once and shared by every crawler.
+
+    Every meaningful word is a keyword. Two and three word phrases are kept
+    only if they are known from the corpus of stored keywords, or recur across
+    the titles of a batch, so one-off word pairs do not flood the index.
+    """
+
+    def __init__(self, corpus_counts=None, min_phrase_count=2, max_length=32):
+        """
+        Creates a keyword extractor.
+
+        Arguments:
+            corpus_counts<{string: int}> -- Optional number of wallpapers each
+                                            stored keyword describes.
+            min_phrase_count<int>        -- Times a phrase must be seen, in the
+                                            corpus or in one batch, to be kept.
+            max_length<int>              -- Max characters in a keyword, as
+                                            allowed by the Keywords table.
+        """
+        if min_phrase_count < 1:
+            raise Exception('Min phrase count must be positive.')
+
+        self.MAX_PHRASE_WORDS = 3
+
+        self.stopwords = frozenset(stopwords.words('english'))
+        self.word_re = re.compile("[a-z0-9]+(?:['-][a-z0-9]+)*")
+        self.noise_re = re.compile('^(\d+|\d+x\d+)$')
+
+        self.counts = dict(corpus_counts) if corpus_counts else {}
+        self.min_phrase_count = min_phrase_count
+        self.max_length = max_length
+        self.lock = Lock()
+
+    def extract(self, text):
+        """
+        Create a list of keywords and phrases using the given text.
+
+        Arguments:
+            text<string> -- Text to make keywords out of.
+
+        Returns:
+            List of strings, each string being a keyword or phrase.
+        """
+        return self.extract_batch([text])[0]
+
+    def extract_batch(self, texts):
+        """
+        Create keywords and phrases for several texts at once, such as every
+        title in a listing. Phrases recurring within the batch are kept even if
+        the corpus has not seen them yet.
+
+        Arguments:
+            texts<[string]> -- Texts to make keywords out of.
+
+        Returns:
+            List of keyword lists, one for each text.
+        """
+        candidates = [self.candidates(text) for text in texts]
+
+        batch_counts = {}
+        for words, phrases in candidates:
+            for phrase in phrases:
+                batch_counts[phrase] = batch_counts.get(phrase, 0) + 1
+
+        result = []
+
+        with self.lock:
+            for words, phrases in candidates:
+                kept = set(words)
+
+                for phrase in phrases:
+                    seen = max(self.counts.get(phrase, 0),
+                        batch_counts[phrase])
+
+                    if seen >= self.min_phrase_count:
+                        kept.add(phrase)
+
+                for keyword in kept:
+                    self.counts[keyword] = self.counts.get(keyword, 0) + 1
+
+                result.append(sorted(kept))
+
+        return result
+
+    def candidates(self, text):
+        """
+        Splits text into its meaningful words and candidate phrases. Phrases
+        never cross punctuation, and never start or end with a stopword.
+
+        Arguments:
+            text<string> -- Text to split.
+
+        Returns:
+            Tuple of the set of words and the set of candidate phrases.
+        """
+        words = set()
+        phrases = set()
+
+        for clause in re.split("[^\w\s'-]+", text.lower()):
+            tokens = [self.clean(t) for t in self.word_re.findall(clause)]
+
+            for token in tokens:
+                if self.is_meaningful(token):
+                    words.add(token)
+
+            for size in range(2, self.MAX_PHRASE_WORDS + 1):
+                for start in range(len(tokens) - size + 1):
+                    gram = tokens[start:start + size]
+
+                    if self.is_meaningful(gram[0]) and \
+                            self.is_meaningful(gram[-1]):
+                        phrase = ' '.join(gram)
+
+                        if len(phrase) <= self.max_length:
+                            phrases.add(phrase)
+
+        return words, phrases
+
+    def clean(self, token):
+        """
+        Normalises a token, dropping any possessive ending.
+
+        Arguments:
+            token<string> -- Lowercase token.
+
+        Returns:
+            Cleaned token.
+        """
+        if token.endswith("'s"):
+            token = token[:-2]
+
+        return token
+
+    def is_meaningful(self, token):
+        """
+        Checks if a token is worth keeping as a keyword: not a stopword, not a
+        bare number or resolution, and not too long.
+
+        Arguments:
+            token<string> -- Cleaned token.
+
+        Returns:
+            True if the token is meaningful, else False.
+        """
+        return bool(token) and \
+            token not in self.stopwords and \
+            not self.noise_re.match(token) and \
+            len(token) <= self.max_length
+
+    def __repr__(self):
+        return '<KeywordExtractor: %d known keywords>' % len(self.counts)
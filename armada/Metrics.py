@@ -0,0 +1,286 @@
+# ==============================================================================
+# Metrics.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+from threading import Event, Lock, Thread
+from time import time
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class Metrics(object):
+    """
+    A registry of counters and latency histograms, shared by every crawler and
+    the database writer. Each value is keyed by a metric name and a set of
+    labels, such as the crawler and the stage.
+
+    The registry renders in the Prometheus text format, and can serve it over
+    a local HTTP endpoint and dump it to a file.
+    """
+
+    def __init__(self, prefix='cutter',
+            buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                30, 60)):
+        """
+        Creates an empty metrics registry.
+
+        Arguments:
+            prefix<string>    -- Prefix added to every metric name.
+            buckets<[float]>  -- Upper bounds in seconds of the histogram
+                                 buckets.
+        """
+        self.prefix = prefix
+        self.buckets = sorted(buckets)
+
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+
+        self.server = None
+        self.dumper = None
+        self.stopped = Event()
+
+    def describe(self, name, help_text):
+        """
+        Sets the help text shown for a metric.
+
+        Arguments:
+            name<string>      -- Metric name, without the prefix.
+            help_text<string> -- One line description.
+        """
+        with self.lock:
+            self.help[name] = help_text
+
+    def increment(self, name, labels=None, amount=1):
+        """
+        Adds to a counter.
+
+        Arguments:
+            name<string>   -- Metric name, without the prefix.
+            labels<dict>   -- Optional label names and values.
+            amount<number> -- Amount to add.
+        """
+        key = self.make_key(labels)
+
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None):
+        """
+        Records a value, usually a duration in seconds, in a histogram.
+
+        Arguments:
+            name<string>  -- Metric name, without the prefix.
+            value<float>  -- Value to record.
+            labels<dict>  -- Optional label names and values.
+        """
+        key = self.make_key(labels)
+        bucket = bisect_left(self.buckets, value)
+
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+
+            if key not in series:
+                series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            counts = series[key]
+            counts[0][bucket] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """
+        Times the body of a with statement into a histogram. The time is
+        recorded even if the body raises.
+
+        Arguments:
+            name<string> -- Metric name, without the prefix.
+            labels<dict> -- Optional label names and values.
+        """
+        start = time()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time() - start, labels)
+
+    def make_key(self, labels):
+        """
+        Turns labels into a hashable key.
+
+        Arguments:
+            labels<dict> -- Label names and values, or None.
+
+        Returns:
+            Sorted tuple of (name, value) pairs.
+        """
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def format_labels(self, key, extra=None):
+        """
+        Formats a label key as Prometheus label text.
+
+        Arguments:
+            key<tuple>    -- Sorted tuple of (name, value) pairs.
+            extra<tuple>  -- Optional extra (name, value) pair, such as a
+                             histogram bucket's le label.
+
+        Returns:
+            Label text including braces, or an empty string.
+        """
+        pairs = list(key) + ([extra] if extra else [])
+
+        if not pairs:
+            return ''
+
+        escaped = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in pairs]
+
+        return '{%s}' % ','.join(escaped)
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text format.
+
+        Returns:
+            Metrics text.
+        """
+        lines = []
+
+        with self.lock:
+            for name in sorted(self.counters):
+                full_name = '%s_%s' % (self.prefix, name)
+                self.render_header(lines, name, full_name, 'counter')
+
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append('%s%s %s' % (full_name,
+                        self.format_labels(key), value))
+
+            for name in sorted(self.histograms):
+                full_name = '%s_%s' % (self.prefix, name)
+                self.render_header(lines, name, full_name, 'histogram')
+
+                for key, counts in sorted(self.histograms[name].items()):
+                    cumulative = 0
+                    bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+
+                    for bound, count in zip(bounds, counts[0]):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (full_name,
+                            self.format_labels(key, ('le', bound)),
+                            cumulative))
+
+                    lines.append('%s_sum%s %r' % (full_name,
+                        self.format_labels(key), counts[1]))
+                    lines.append('%s_count%s %d' % (full_name,
+                        self.format_labels(key), counts[2]))
+
+        return '\n'.join(lines) + '\n'
+
+    def render_header(self, lines, name, full_name, kind):
+        """
+        Adds the help and type lines of a metric. Must hold the lock.
+
+        Arguments:
+            lines<[string]>   -- Lines rendered so far.
+            name<string>      -- Metric name, without the prefix.
+            full_name<string> -- Metric name, with the prefix.
+            kind<string>      -- Prometheus metric type.
+        """
+        if name in self.help:
+            lines.append('# HELP %s %s' % (full_name, self.help[name]))
+
+        lines.append('# TYPE %s %s' % (full_name, kind))
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serves the metrics over HTTP on a background thread. Every path
+        returns the full metrics text.
+
+        Arguments:
+            port<int>    -- Port to listen on.
+            host<string> -- Address to listen on. Defaults to local only.
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                    'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((host, port), MetricsHandler)
+
+        server_thread = Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def dump(self, path):
+        """
+        Writes the metrics text to a file, replacing it in one step so readers
+        never see it half written.
+
+        Arguments:
+            path<string> -- Filesystem path to write to.
+        """
+        temp_path = path + '.tmp'
+        handler = open(temp_path, 'w')
+        handler.write(self.render())
+        handler.close()
+        os.rename(temp_path, path)
+
+    def dump_every(self, path, interval):
+        """
+        Dumps the metrics to a file every interval seconds on a background
+        thread, until close() is called.
+
+        Arguments:
+            path<string>   -- Filesystem path to write to.
+            interval<int>  -- Seconds between dumps.
+        """
+        def dump_loop():
+            while not self.stopped.wait(interval):
+                try:
+                    self.dump(path)
+                except Exception as error:
+                    print 'Unable to dump metrics. Details: %s' % error
+
+        self.dumper = Thread(target=dump_loop)
+        self.dumper.daemon = True
+        self.dumper.start()
+
+    def close(self):
+        """
+        Stops the HTTP endpoint and the dump thread, if running.
+        """
+        self.stopped.set()
+
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __repr__(self):
+        return '<Metrics: %d counters, %d histograms>' % (len(self.counters),
+            len(self.histograms))
@@ -7,7 +7,10 @@
 # ------------------------------------------------------------------------------
 
 import mysql.connector
-from mysql.connector import errorcode, IntegrityError
+from mysql.connector import errorcode
+from Queue import Empty, Queue
+from threading import Lock
+from time import time
 
 
 # ------------------------------------------------------------------------------
@@ -16,7 +19,8 @@ from mysql.connector import errorcode, IntegrityError
 
 class MySQLConnector(object):
     """
-    Creates a database connection to a MySQL database.  
+    Creates a pool of database connections to a MySQL database. Each call
+    borrows its own connection, so concurrent crawlers write in parallel.
 
     For the sake of documentation, here is the Wallpapers table:
 
@@ -26,9 +30,25 @@ class MySQLConnector(object):
             img_height INT NOT NULL,
             img_width INT NOT NULL,
             path VARCHAR(256) NOT NULL,
+            phash BIGINT UNSIGNED,
+            id INT UNSIGNED NOT NULL AUTO_INCREMENT UNIQUE,
             PRIMARY KEY (name)
         );
 
+    The phash column holds the perceptual hash used to skip near duplicates,
+    and the id column numbers wallpapers in the order they were added so the
+    search index can load only new rows. Older tables can add them with:
+
+        ALTER TABLE Wallpapers ADD COLUMN phash BIGINT UNSIGNED;
+        ALTER TABLE Wallpapers
+            ADD COLUMN id INT UNSIGNED NOT NULL AUTO_INCREMENT UNIQUE;
+
+    The table keeps no record of when a wallpaper was added, so the ALTER
+    numbers the existing rows in primary key order, which is the order of
+    their hashed names, not the order they were added. Search ranks those
+    rows newest first by that arbitrary order among equals. Only rows added
+    after the ALTER are numbered, and ranked, in the order they were added.
+
     And the Keywords table:
 
         CREATE TABLE IF NOT EXISTS Keywords (
@@ -37,6 +57,20 @@ class MySQLConnector(object):
             PRIMARY KEY (word, name),
             FOREIGN KEY (name) REFERENCES Wallpapers(name)
         );
+
+    And the Thumbnails table, listing the sizes made of each wallpaper so the
+    front end can pick one:
+
+        CREATE TABLE IF NOT EXISTS Thumbnails (
+            name VARCHAR(32),
+            size VARCHAR(16),
+            file VARCHAR(64) NOT NULL,
+            width INT NOT NULL,
+            height INT NOT NULL,
+            format VARCHAR(8) NOT NULL,
+            PRIMARY KEY (name, size),
+            FOREIGN KEY (name) REFERENCES Wallpapers(name)
+        );
     """
 
     def __init__(self,
@@ -45,9 +79,13 @@ class MySQLConnector(object):
             password,
             wallpaper_table,
             keyword_table,
-            host='127.0.0.1'):
+            host='127.0.0.1',
+            pool_size=4,
+            idle_check=60,
+            thumbnail_table='Thumbnails'):
         """
-        Creates a connection to a MySQL database.
+        Creates a pool of connections to a MySQL database. One connection is
+        opened straight away to check the settings, and the rest as needed.
 
         Arguments:
             database_name<string>   -- Name of the database to use.
@@ -56,6 +94,10 @@ class MySQLConnector(object):
             wallpaper_table<string> -- Table to write wallpapers to.
             keyword_table<string>   -- Table to write keywords to.
             host<string>            -- Optional host address.
+            pool_size<int>          -- Max number of open connections.
+            idle_check<int>         -- Seconds a connection may sit idle
+                                       before it is checked on borrowing.
+            thumbnail_table<string> -- Table to write thumbnail sizes to.
         """
         if not database_name:
             raise Exception('Database name must not be empty.')
@@ -67,21 +109,29 @@ class MySQLConnector(object):
             raise Exception('Wallpaper table name must not be empty.')
         if not keyword_table:
             raise Exception('Keyword table name must not be empty.')
+        if not thumbnail_table:
+            raise Exception('Thumbnail table name must not be empty.')
         if not host:
             raise Exception('Host name must not be empty.')
+        if pool_size < 1:
+            raise Exception('Connection pool size must be positive.')
 
         self.db_name = database_name
         self.wallpaper_table = wallpaper_table
         self.keyword_table = keyword_table
+        self.thumbnail_table = thumbnail_table
 
         self.username = username
         self.password = password
         self.host = host
 
-        self.connection = self.get_connection()
+        self.pool_size = pool_size
+        self.idle_check = idle_check
+        self.idle = Queue()
+        self.opened = 0
+        self.lock = Lock()
 
-        if self.connection == None:
-            raise Exception('Unable to connect to database.')
+        self.release(self.acquire())
 
     def get_connection(self):
         """
@@ -109,16 +159,123 @@ class MySQLConnector(object):
 
         return result
 
-    def store(self, path, name, keywords, source, size):
+    def acquire(self):
+        """
+        Borrows a connection from the pool, opening a new one if the pool is
+        not full, or else waiting for one to be released. A connection that has
+        been idle a while is pinged first, and reconnected if the server has
+        dropped it.
+
+        Returns:
+            Database connection. Must be handed back with release().
+        """
+        connection, last_used = None, None
+
+        try:
+            connection, last_used = self.idle.get(False)
+        except Empty:
+            with self.lock:
+                can_open = self.opened < self.pool_size
+
+                if can_open:
+                    self.opened += 1
+
+            if can_open:
+                connection = self.open_connection()
+            else:
+                connection, last_used = self.idle.get()
+
+        if last_used and time() - last_used > self.idle_check:
+            connection = self.check_connection(connection)
+
+        return connection
+
+    def release(self, connection, broken=False):
+        """
+        Hands a borrowed connection back to the pool.
+
+        Arguments:
+            connection   -- Connection from acquire().
+            broken<bool> -- If True, the connection is closed and dropped from
+                            the pool instead.
+        """
+        if not broken:
+            self.idle.put((connection, time()))
+            return
+
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+        with self.lock:
+            self.opened -= 1
+
+    def open_connection(self):
+        """
+        Opens a new pooled connection. The pool slot must already be taken.
+
+        Returns:
+            Database connection.
+        """
+        connection = self.get_connection()
+
+        if connection == None:
+            with self.lock:
+                self.opened -= 1
+
+            raise Exception('Unable to connect to database.')
+
+        return connection
+
+    def check_connection(self, connection):
         """
-        Stores the image metadata.
+        Pings a connection, reconnecting if the server has dropped it. If it
+        cannot be revived, a new connection takes its place.
 
         Arguments:
-            path<string>       -- Filesystem path to image.
-            name<string>       -- Hashed name of image, including extension.
-            keywords<[string]> -- Keywords describing the image.
-            source<string>     -- Absolute URL to the source of the image.
-            size<(int, int)>   -- Contains width and height of image.
+            connection -- Connection to check.
+
+        Returns:
+            Working database connection.
+        """
+        try:
+            connection.ping(reconnect=True, attempts=3, delay=1)
+            return connection
+        except mysql.connector.Error as error:
+            print 'Replacing dropped database connection. Details: %s' % error
+
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+        return self.open_connection()
+
+    def store(self, path, name, keywords, source, size, phash=None,
+            thumbnails=None):
+        """
+        Stores the image metadata on a connection borrowed from the pool.
+
+        Arguments:
+            path<string>        -- Filesystem path to image.
+            name<string>        -- Hashed name of image, including extension.
+            keywords<[string]>  -- Keywords describing the image.
+            source<string>      -- Absolute URL to the source of the image.
+            size<(int, int)>    -- Contains width and height of image.
+            phash<int>          -- Optional perceptual hash of the image.
+            thumbnails<[tuple]> -- Optional (size name, file name, width,
+                                   height, format) tuples, one for each
+                                   thumbnail of the image.
+        """
+        self.store_batch([(path, name, keywords, source, size, phash,
+            thumbnails)])
+
+    def check_record(self, path, name, keywords, source, size, phash=None,
+            thumbnails=None):
+        """
+        Checks image metadata is complete enough to store. Takes the same
+        arguments as store().
         """
         if not path:
             raise Exception('Cannot write empty filesystem path to DB.')
@@ -131,25 +288,55 @@ class MySQLConnector(object):
         if not size or len(size) != 2:
             raise Exception('Cannot write image to DB without size data.')
 
-        cursor = self.connection.cursor()
-
-        wrote = self.write_wallpaper(cursor,
-            name,
-            source,
-            size[0],
-            size[1],
-            path)
+    def store_batch(self, records):
+        """
+        Stores the metadata of several images in a single transaction, with
+        one commit for the whole batch. Duplicate wallpapers are skipped
+        without failing the rest of the batch.
 
-        if wrote:
-            self.write_keywords(cursor, name, keywords)
+        Arguments:
+            records<[tuple]> -- Tuples of the arguments to store().
+        """
+        for record in records:
+            self.check_record(*record)
 
-        self.connection.commit()
-        cursor.close()
+        connection = self.acquire()
+        broken = False
 
-    def write_wallpaper(self, cursor, name, source, width, height, path):
+        try:
+            cursor = connection.cursor()
+
+            for path, name, keywords, source, size, phash, thumbnails in \
+                    records:
+                wrote = self.write_wallpaper(cursor,
+                    name,
+                    source,
+                    size[0],
+                    size[1],
+                    path,
+                    phash)
+
+                if wrote:
+                    self.write_keywords(cursor, name, keywords)
+
+                if wrote and thumbnails:
+                    self.write_thumbnails(cursor, name, thumbnails)
+
+            connection.commit()
+            cursor.close()
+        except mysql.connector.Error:
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def write_wallpaper(self, cursor, name, source, width, height, path,
+            phash=None):
         """
-        Write the wallpaper metadata to the wallpapers table. Return False if
-        the add failed, otherwise return True.
+        Write the wallpaper metadata to the wallpapers table. A wallpaper
+        already in the table is left as it is, so a record queued again after
+        a crash is safe to store. Return False if the add failed or the
+        wallpaper was already there, otherwise return True.
 
         Arguments:
             cursor         -- Database cursor.
@@ -158,22 +345,27 @@ class MySQLConnector(object):
             width<int>     -- Pixel width of the image.
             height<int>    -- Pixel height of the image.
             path<string>   -- Filesystem path to image.
+            phash<int>     -- Optional perceptual hash of the image.
 
         Returns:
             True if wallpaper was successfuly added, else False.
         """
         result = False
 
-        insert_line = 'INSERT INTO %s ' % self.wallpaper_table
-        wallpaper_query = (insert_line + 'VALUES (%s, %s, %s, %s, %s)')
-        wallpaper_args = (name, source, height, width, path)
+        insert_line = 'INSERT IGNORE INTO %s ' % self.wallpaper_table
+        columns = '(name, source, img_height, img_width, path, phash) '
+        wallpaper_query = (insert_line + columns +
+            'VALUES (%s, %s, %s, %s, %s, %s)')
+        wallpaper_args = (name, source, height, width, path, phash)
 
         try:
             cursor.execute(wallpaper_query, wallpaper_args)
-            result = True
-            print 'Wrote %s to database.' % name
-        except IntegrityError as error:
-            print 'Unable to add %s to Wallpapers, duplicate entry.' % name
+
+            if cursor.rowcount > 0:
+                result = True
+                print 'Wrote %s to database.' % name
+            else:
+                print 'Unable to add %s to Wallpapers, duplicate entry.' % name
         except Exception as error:
             print 'Unable to add %s to Wallpapers. Details: %s' % (name, error)
 
@@ -181,33 +373,159 @@ class MySQLConnector(object):
 
     def write_keywords(self, cursor, name, keywords): 
         """
-        Write the keywords to the keyword table.
+        Write the keywords to the keyword table. All keywords go in a single
+        multi-row insert, and keywords already stored for the wallpaper are
+        ignored.
 
         Arguments:
             cursor           -- Database cursor.
             name<string>     -- Hashed name of image.
             keywords[string] -- Keywords for the wallpaper.
 
+        Returns:
+            True if writes succeeded, else False.
+        """
+        unique_keywords = sorted(set(keywords))
+
+        if not unique_keywords:
+            return True
+
+        result = False
+        rows = ', '.join(['(%s, %s)'] * len(unique_keywords))
+
+        insert_line = 'INSERT IGNORE INTO %s ' % self.keyword_table
+        keyword_query = (insert_line + '(word, name) VALUES ' + rows)
+        keyword_args = []
+
+        for keyword in unique_keywords:
+            keyword_args.extend((keyword, name))
+
+        try:
+            cursor.execute(keyword_query, keyword_args)
+            result = True
+            print 'Wrote %d keywords for %s to database.' % (
+                len(unique_keywords), name)
+        except Exception as error:
+            print 'Unable to add keywords for %s. Details: %s.' % (name, error)
+
+        return result
+
+    def write_thumbnails(self, cursor, name, thumbnails):
+        """
+        Write the thumbnail sizes of a wallpaper to the thumbnail table, in a
+        single multi-row insert.
+
+        Arguments:
+            cursor              -- Database cursor.
+            name<string>        -- Hashed name of image.
+            thumbnails<[tuple]> -- (size name, file name, width, height,
+                                   format) tuples.
+
         Returns:
             True if writes succeeded, else False.
         """
         result = False
+        rows = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(thumbnails))
+
+        insert_line = 'INSERT IGNORE INTO %s ' % self.thumbnail_table
+        columns = '(name, size, file, width, height, format) '
+        thumbnail_query = (insert_line + columns + 'VALUES ' + rows)
+        thumbnail_args = []
+
+        for thumbnail in thumbnails:
+            thumbnail_args.append(name)
+            thumbnail_args.extend(thumbnail)
+
+        try:
+            cursor.execute(thumbnail_query, thumbnail_args)
+            result = True
+        except Exception as error:
+            print 'Unable to add thumbnails for %s. Details: %s.' % (name,
+                error)
+
+        return result
+
+    def load_hashes(self):
+        """
+        Reads the perceptual hash of every stored wallpaper that has one.
+
+        Returns:
+            List of (name, phash) tuples.
+        """
+        query = 'SELECT name, phash FROM %s WHERE phash IS NOT NULL' % \
+            self.wallpaper_table
 
-        insert_line = 'INSERT INTO %s ' % self.keyword_table
-        keyword_query = (insert_line + 'VALUES (%s, %s)')
-
-        failed = False
-        for keyword in keywords:
-            try:
-                keyword_args = (keyword, name)
-                cursor.execute(keyword_query, keyword_args)
-                print 'Wrote %s for %s to database' % (keyword, name)
-            except Exception as error:
-                print 'Unable to add %s as keyword. Details: %s.' % (keyword,
-                    error)
-                failed = True
-
-        result = not failed
+        return self.read(query)
+
+    def load_wallpapers(self, since_id=0):
+        """
+        Reads the wallpapers added after the given id, oldest first.
+
+        Arguments:
+            since_id<int> -- Only wallpapers with a greater id are read.
+
+        Returns:
+            List of (id, name, width, height) tuples.
+        """
+        query = ('SELECT id, name, img_width, img_height FROM %s ' % \
+            self.wallpaper_table) + 'WHERE id > %s ORDER BY id'
+
+        return self.read(query, (since_id,))
+
+    def load_keywords(self, since_id=0):
+        """
+        Reads the keywords of the wallpapers added after the given id, ordered
+        by wallpaper id.
+
+        Arguments:
+            since_id<int> -- Only keywords of wallpapers with a greater id are
+                             read.
+
+        Returns:
+            List of (word, id) tuples.
+        """
+        query = ('SELECT k.word, w.id FROM %s k JOIN %s w ON k.name = w.name ' %
+            (self.keyword_table, self.wallpaper_table)) + \
+            'WHERE w.id > %s ORDER BY w.id'
+
+        return self.read(query, (since_id,))
+
+    def load_keyword_counts(self):
+        """
+        Counts the wallpapers each stored keyword describes.
+
+        Returns:
+            Dictionary of keyword to number of wallpapers.
+        """
+        query = 'SELECT word, COUNT(*) FROM %s GROUP BY word' % \
+            self.keyword_table
+
+        return dict(self.read(query))
+
+    def read(self, query, args=()):
+        """
+        Runs a query on a connection borrowed from the pool.
+
+        Arguments:
+            query<string> -- SQL query.
+            args<tuple>   -- Query arguments.
+
+        Returns:
+            List of result rows.
+        """
+        connection = self.acquire()
+        broken = False
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query, args)
+            result = cursor.fetchall()
+            cursor.close()
+        except mysql.connector.Error:
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken)
 
         return result
 
@@ -0,0 +1,506 @@
+# ==============================================================================
+# PackStore.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+import errno
+import mmap
+import os
+import re
+import struct
+from threading import Lock
+import zlib
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class PackStore(object):
+    """
+    Stores many small blobs, such as thumbnails, appended one after another to
+    a few large segment files instead of one file each. An index of where each
+    blob lives is kept in memory and rebuilt by scanning the segments when the
+    store is opened. Reads come straight out of memory mapped segments, so
+    serving a page of thumbnails touches a handful of files.
+
+    Each record is a header, the blob's name, and the blob:
+
+        magic<4s> kind<B> name length<H> data length<I> crc32<I>
+
+    Deleting a blob appends a tombstone record. The space is reclaimed by
+    compact(), which copies the live blobs of mostly dead segments to the end
+    of the store and removes the old segments.
+
+    Stands in for a FileWriter, so its write, file_exists, and unwrite take
+    the same arguments. The path argument is ignored since the store has its
+    own directory.
+    """
+
+    def __init__(self, path, segment_size=268435456, read_only=False):
+        """
+        Opens a pack store, creating its directory if needed.
+
+        Arguments:
+            path<string>       -- Filesystem path of the store's directory.
+            segment_size<int>  -- Bytes a segment may grow to before a new one
+                                  is started.
+            read_only<bool>    -- If True, never write. Use for processes that
+                                  only serve blobs while a crawler writes.
+        """
+        self.MAGIC = 'WPK1'
+        self.PUT = 1
+        self.DELETE = 2
+        self.HEADER = struct.Struct('<4sBHII')
+        self.SEGMENT_RE = re.compile('^(\d{8})\.pack$')
+
+        if segment_size < 1:
+            raise Exception('Segment size must be positive.')
+
+        self.path = path
+        self.segment_size = segment_size
+        self.read_only = read_only
+
+        self.lock = Lock()
+        self.index = {}
+        self.scanned = {}
+        self.sizes = {}
+        self.live = {}
+        self.maps = {}
+
+        self.active_id = None
+        self.active = None
+
+        if not read_only and not os.path.isdir(path):
+            os.makedirs(path)
+
+        with self.lock:
+            self.scan()
+
+            if not read_only:
+                self.open_active()
+
+    def write(self, content, path, name):
+        """
+        Appends a blob, unless one with the same name is already stored.
+
+        Arguments:
+            content<string> -- Blob to store.
+            path<string>    -- Unused.
+            name<string>    -- Name of the blob.
+
+        Returns:
+            True if the blob was written, else False if it already existed.
+        """
+        if self.read_only:
+            raise Exception('Pack store is read only.')
+
+        with self.lock:
+            if name in self.index:
+                return False
+
+            self.append(self.PUT, name, content)
+
+        return True
+
+    def file_exists(self, path, name):
+        """
+        Checks if a blob is stored.
+
+        Arguments:
+            path<string> -- Unused.
+            name<string> -- Name of the blob.
+
+        Returns:
+            True if the blob is stored, else False.
+        """
+        with self.lock:
+            return name in self.index
+
+    def unwrite(self, path, name):
+        """
+        Deletes a blob if it is stored. If it is not, fails silently.
+
+        Arguments:
+            path<string> -- Unused.
+            name<string> -- Name of the blob.
+
+        Returns:
+            True if the blob was deleted, else False.
+        """
+        if self.read_only:
+            raise Exception('Pack store is read only.')
+
+        with self.lock:
+            if name not in self.index:
+                return False
+
+            self.append(self.DELETE, name, '')
+
+        return True
+
+    def read(self, name):
+        """
+        Reads a blob.
+
+        Arguments:
+            name<string> -- Name of the blob.
+
+        Returns:
+            The blob, or None if it is not stored.
+        """
+        return self.read_many([name]).get(name)
+
+    def read_many(self, names):
+        """
+        Reads several blobs, such as every thumbnail on a page.
+
+        Arguments:
+            names<[string]> -- Names of the blobs.
+
+        Returns:
+            Dictionary of name to blob. Names not stored are left out.
+        """
+        result = {}
+
+        with self.lock:
+            for name in names:
+                location = self.index.get(name)
+
+                if location:
+                    segment_id, offset, length = location
+                    data_map = self.get_map(segment_id, offset + length)
+                    result[name] = data_map[offset:offset + length]
+
+        return result
+
+    def refresh(self):
+        """
+        Picks up blobs written by another process since the store was opened
+        or last refreshed. Only needed by read only stores.
+        """
+        with self.lock:
+            self.scan()
+
+    def compact(self, min_dead_ratio=0.5):
+        """
+        Reclaims the space of deleted blobs. Every full segment with at least
+        the given share of dead bytes has its live blobs appended to the end
+        of the store, then is removed.
+
+        Arguments:
+            min_dead_ratio<float> -- Share of a segment that must be dead for
+                                     it to be compacted.
+
+        Returns:
+            Number of bytes reclaimed: the size of the store before, less its
+            size after, so the live blobs copied forward are not counted.
+        """
+        if self.read_only:
+            raise Exception('Pack store is read only.')
+
+        result = 0
+
+        with self.lock:
+            old_size = sum(self.sizes.values())
+            chosen = []
+
+            for segment_id in sorted(self.sizes):
+                size = self.sizes[segment_id]
+                dead = size - self.live[segment_id]
+
+                if segment_id != self.active_id and size and \
+                        float(dead) / size >= min_dead_ratio:
+                    chosen.append(segment_id)
+
+            for segment_id in chosen:
+                kept = [s for s in self.sizes if s < segment_id and
+                    s not in chosen]
+
+                for kind, name, offset, length in self.records(segment_id):
+                    location = self.index.get(name)
+
+                    if kind == self.PUT and location == (segment_id, offset,
+                            length):
+                        data_map = self.get_map(segment_id, offset + length)
+                        self.append(self.PUT, name,
+                            data_map[offset:offset + length])
+                    elif kind == self.DELETE and kept and \
+                            location is None:
+                        self.append(self.DELETE, name, '')
+
+            self.active.flush()
+            os.fsync(self.active.fileno())
+
+            for segment_id in chosen:
+                self.remove_segment(segment_id)
+
+            result = old_size - sum(self.sizes.values())
+
+        return result
+
+    def close(self):
+        """
+        Flushes the active segment and releases every open file and map.
+        """
+        with self.lock:
+            if self.active:
+                self.active.flush()
+                os.fsync(self.active.fileno())
+                self.active.close()
+                self.active = None
+
+            for data_map in self.maps.values():
+                data_map.close()
+
+            self.maps = {}
+
+    def append(self, kind, name, content):
+        """
+        Appends a record to the active segment and updates the index. Starts a
+        new segment first if the record would not fit. Must hold the lock.
+
+        Arguments:
+            kind<int>       -- PUT or DELETE.
+            name<string>    -- Name of the blob.
+            content<string> -- Blob, empty for a tombstone.
+        """
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+
+        record_size = self.record_size(name, len(content))
+
+        if self.sizes[self.active_id] and \
+                self.sizes[self.active_id] + record_size > self.segment_size:
+            self.roll_segment()
+
+        crc = zlib.crc32(name + content) & 0xffffffff
+        header = self.HEADER.pack(self.MAGIC, kind, len(name), len(content),
+            crc)
+
+        start = self.sizes[self.active_id]
+        self.active.write(header + name + content)
+        self.active.flush()
+
+        self.sizes[self.active_id] += record_size
+        self.scanned[self.active_id] = self.sizes[self.active_id]
+        self.apply(kind, name, self.active_id, start, len(content))
+
+    def apply(self, kind, name, segment_id, start, length):
+        """
+        Updates the index and live byte counts for one record. Must hold the
+        lock.
+
+        Arguments:
+            kind<int>       -- PUT or DELETE.
+            name<string>    -- Name of the blob.
+            segment_id<int> -- Segment the record is in.
+            start<int>      -- Offset of the record's header.
+            length<int>     -- Length of the blob.
+        """
+        old = self.index.pop(name, None)
+
+        if old:
+            self.live[old[0]] -= self.record_size(name, old[2])
+
+        if kind == self.PUT:
+            offset = start + self.HEADER.size + len(name)
+            self.index[name] = (segment_id, offset, length)
+            self.live[segment_id] += self.record_size(name, length)
+
+    def record_size(self, name, length):
+        """
+        Finds the full size of a record on disk.
+
+        Arguments:
+            name<string> -- Name of the blob.
+            length<int>  -- Length of the blob.
+
+        Returns:
+            Size of the record in bytes.
+        """
+        return self.HEADER.size + len(name) + length
+
+    def scan(self):
+        """
+        Brings the index up to date with the segments on disk, reading only
+        records added since the last scan. If another process has removed a
+        segment, the index is rebuilt from scratch. Must hold the lock.
+        """
+        segment_ids = self.list_segments()
+
+        if any(s not in segment_ids for s in self.scanned):
+            for data_map in self.maps.values():
+                data_map.close()
+
+            self.index, self.scanned, self.sizes, self.live, self.maps = \
+                {}, {}, {}, {}, {}
+
+        for segment_id in segment_ids:
+            self.sizes.setdefault(segment_id, 0)
+            self.live.setdefault(segment_id, 0)
+            start = self.scanned.get(segment_id, 0)
+
+            for kind, name, offset, length in self.records(segment_id, start):
+                header_start = offset - self.HEADER.size - len(name)
+                self.apply(kind, name, segment_id, header_start, length)
+                self.scanned[segment_id] = offset + length
+
+            self.scanned.setdefault(segment_id, 0)
+            self.sizes[segment_id] = self.scanned[segment_id]
+
+    def records(self, segment_id, start=0):
+        """
+        Reads the records of a segment in order. Stops at a torn or corrupt
+        record, such as one cut short by a crash.
+
+        Arguments:
+            segment_id<int> -- Segment to read.
+            start<int>      -- Offset of the first record to read.
+
+        Returns:
+            Generator of (kind, name, data offset, data length) tuples.
+        """
+        handler = open(self.segment_path(segment_id), 'rb')
+
+        try:
+            handler.seek(start)
+
+            while True:
+                header = handler.read(self.HEADER.size)
+
+                if len(header) < self.HEADER.size:
+                    break
+
+                magic, kind, name_length, length, crc = \
+                    self.HEADER.unpack(header)
+
+                if magic != self.MAGIC:
+                    break
+
+                body = handler.read(name_length + length)
+
+                if len(body) < name_length + length or \
+                        zlib.crc32(body) & 0xffffffff != crc:
+                    break
+
+                offset = start + self.HEADER.size + name_length
+                yield kind, body[:name_length], offset, length
+                start = offset + length
+        finally:
+            handler.close()
+
+    def open_active(self):
+        """
+        Opens the newest segment for appending, cutting off any torn record
+        at its end, or starts the first segment. Must hold the lock.
+        """
+        if not self.sizes:
+            self.roll_segment()
+            return
+
+        self.active_id = max(self.sizes)
+        self.active = open(self.segment_path(self.active_id), 'r+b')
+        self.active.truncate(self.sizes[self.active_id])
+        self.active.seek(0, os.SEEK_END)
+
+    def roll_segment(self):
+        """
+        Seals the active segment and starts a new, empty one. Must hold the
+        lock.
+        """
+        if self.active:
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            self.active.close()
+
+        self.active_id = max(self.sizes) + 1 if self.sizes else 1
+        self.active = open(self.segment_path(self.active_id), 'ab')
+        self.sizes[self.active_id] = 0
+        self.live[self.active_id] = 0
+        self.scanned[self.active_id] = 0
+
+    def remove_segment(self, segment_id):
+        """
+        Deletes a segment whose live blobs have been copied elsewhere. Must
+        hold the lock.
+
+        Arguments:
+            segment_id<int> -- Segment to remove.
+        """
+        data_map = self.maps.pop(segment_id, None)
+
+        if data_map:
+            data_map.close()
+
+        try:
+            os.remove(self.segment_path(segment_id))
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+        del self.sizes[segment_id]
+        del self.live[segment_id]
+        del self.scanned[segment_id]
+
+    def get_map(self, segment_id, end):
+        """
+        Finds the memory map of a segment, mapping it again if the segment has
+        grown past the given offset since it was mapped. Must hold the lock.
+
+        Arguments:
+            segment_id<int> -- Segment to map.
+            end<int>        -- Offset that must be inside the map.
+
+        Returns:
+            Read only memory map of the segment.
+        """
+        data_map = self.maps.get(segment_id)
+
+        if not data_map or len(data_map) < end:
+            if data_map:
+                data_map.close()
+
+            handler = open(self.segment_path(segment_id), 'rb')
+            data_map = mmap.mmap(handler.fileno(), 0, access=mmap.ACCESS_READ)
+            handler.close()
+            self.maps[segment_id] = data_map
+
+        return data_map
+
+    def list_segments(self):
+        """
+        Finds the segments in the store's directory.
+
+        Returns:
+            Sorted list of segment ids.
+        """
+        result = []
+
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                match = self.SEGMENT_RE.match(name)
+
+                if match:
+                    result.append(int(match.group(1)))
+
+        return sorted(result)
+
+    def segment_path(self, segment_id):
+        """
+        Finds the file a segment is stored in.
+
+        Arguments:
+            segment_id<int> -- Segment id.
+
+        Returns:
+            Filesystem path of the segment.
+        """
+        return os.path.join(self.path, '%08d.pack' % segment_id)
+
+    def __repr__(self):
+        return '<PackStore: %d blobs in %d segments>' % (len(self.index),
+            len(self.sizes))
@@ -0,0 +1,131 @@
+# ==============================================================================
+# PerceptualIndex.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from threading import Lock
+
+
+# ------------------------------------------------------------------------------
+# Helper functions
+# ------------------------------------------------------------------------------
+
+def hamming_distance(first, second):
+    """
+    Counts the bits that differ between two hashes.
+
+    Arguments:
+        first<int>  -- First hash.
+        second<int> -- Second hash.
+
+    Returns:
+        Number of differing bits.
+    """
+    return bin(first ^ second).count('1')
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class PerceptualIndex(object):
+    """
+    Finds stored wallpapers whose perceptual hash is close to a new one, so
+    reposts of the same image from another URL can be skipped.
+
+    Hashes are kept in a BK-tree: each child hangs off its parent at their
+    Hamming distance, so a query only visits children whose distance is within
+    the threshold of the query's own distance to the parent.
+    """
+
+    def __init__(self, max_distance=4):
+        """
+        Creates an empty index.
+
+        Arguments:
+            max_distance<int> -- Max Hamming distance at which two hashes are
+                                 considered the same image.
+        """
+        if max_distance < 0:
+            raise Exception('Max hash distance cannot be negative.')
+
+        self.max_distance = max_distance
+        self.root = None
+        self.count = 0
+        self.lock = Lock()
+
+    def add(self, phash, name):
+        """
+        Adds a wallpaper's hash to the index.
+
+        Arguments:
+            phash<int>   -- Perceptual hash of the wallpaper.
+            name<string> -- Name of the wallpaper.
+        """
+        node = (phash, name, {})
+
+        with self.lock:
+            self.count += 1
+
+            if self.root is None:
+                self.root = node
+                return
+
+            current = self.root
+            while True:
+                distance = hamming_distance(phash, current[0])
+                children = current[2]
+
+                if distance not in children:
+                    children[distance] = node
+                    return
+
+                current = children[distance]
+
+    def find(self, phash):
+        """
+        Finds the closest indexed wallpaper within the max distance.
+
+        Arguments:
+            phash<int> -- Perceptual hash to look up.
+
+        Returns:
+            Tuple of the name and distance of the closest wallpaper, or None if
+            none is close enough.
+        """
+        result = None
+
+        with self.lock:
+            pending = [self.root] if self.root else []
+
+            while pending:
+                node_hash, node_name, children = pending.pop()
+                distance = hamming_distance(phash, node_hash)
+
+                if distance <= self.max_distance:
+                    if result is None or distance < result[1]:
+                        result = (node_name, distance)
+
+                low = distance - self.max_distance
+                high = distance + self.max_distance
+
+                for child_distance, child in children.iteritems():
+                    if low <= child_distance <= high:
+                        pending.append(child)
+
+        return result
+
+    def size(self):
+        """
+        Returns the number of hashes in the index.
+
+        Returns:
+            Number of hashes in the index.
+        """
+        return self.count
+
+    def __repr__(self):
+        return '<PerceptualIndex: %d hashes>' % self.count
@@ -0,0 +1,278 @@
+# ==============================================================================
+# Profiler.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+import cProfile
+import json
+import os
+import re
+import sys
+from threading import Event, Lock, Thread, current_thread, \
+    enumerate as all_threads
+from time import localtime, strftime, time
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class Profiler(object):
+    """
+    Profiles crawl cycles on demand. Once requested, by a signal handler
+    calling request() or by creating the control file, the next few crawls of
+    every crawler are profiled and written to the output directory. While no
+    profile is requested, starting a crawl costs a single flag check.
+
+    Two modes are supported. cprofile profiles the crawler's own thread and
+    writes a pstats file. sample writes collapsed stacks for flame graph
+    tools. One sampler thread serves every session, and each sampled stack is
+    given to the session whose crawl owns the thread: the crawl's own thread,
+    and download pool threads while they run one of its jobs.
+
+    The control file may be empty, or hold JSON such as
+    {"cycles": 3, "mode": "sample"}. It is removed once read.
+    """
+
+    def __init__(self, output_path, cycles=1, mode='cprofile',
+            control_path=None, sample_interval=0.01):
+        """
+        Creates a profiler, idle until a profile is requested.
+
+        Arguments:
+            output_path<string>    -- Directory profiles are written to.
+            cycles<int>            -- Default number of crawls to profile for
+                                      each crawler.
+            mode<string>           -- Default mode, cprofile or sample.
+            control_path<string>   -- Optional file whose appearance requests
+                                      a profile. Checked when a crawl starts.
+            sample_interval<float> -- Seconds between stack samples.
+        """
+        self.MODES = ('cprofile', 'sample')
+
+        if not output_path:
+            raise Exception('Profile output path cannot be empty.')
+        if cycles < 1:
+            raise Exception('Profile cycles must be positive.')
+        if mode not in self.MODES:
+            raise Exception('Unknown profile mode: %s' % mode)
+
+        self.output_path = output_path
+        self.cycles = cycles
+        self.mode = mode
+        self.control_path = control_path
+        self.sample_interval = sample_interval
+
+        self.lock = Lock()
+        self.active = False
+        self.generation = 0
+        self.armed_cycles = 0
+        self.armed_mode = mode
+        self.remaining = {}
+
+        self.sessions = {}
+        self.sampler = None
+        self.sampler_stop = None
+
+        if not os.path.isdir(output_path):
+            os.makedirs(output_path)
+
+    def request(self, cycles=None, mode=None):
+        """
+        Requests a profile of the next crawls of every crawler. Safe to call
+        from a signal handler.
+
+        Arguments:
+            cycles<int>  -- Optional number of crawls for each crawler.
+            mode<string> -- Optional mode, cprofile or sample.
+        """
+        mode = mode if mode else self.mode
+
+        if mode not in self.MODES:
+            print 'Unknown profile mode: %s. Ignoring request.' % mode
+            return
+
+        self.armed_cycles = cycles if cycles else self.cycles
+        self.armed_mode = mode
+        self.generation += 1
+        self.active = True
+
+        print 'Profiling the next %d crawls of each crawler (%s).' % (
+            self.armed_cycles, mode)
+
+    def cancel(self):
+        """
+        Stops profiling further crawls. Crawls already being profiled are
+        finished and written. Safe to call from a signal handler.
+        """
+        self.active = False
+        print 'Profiling cancelled.'
+
+    def check_control(self):
+        """
+        Requests a profile if the control file has appeared, then removes it.
+        """
+        if not os.path.exists(self.control_path):
+            return
+
+        try:
+            content = open(self.control_path).read().strip()
+            options = json.loads(content) if content else {}
+            os.remove(self.control_path)
+        except Exception as error:
+            print 'Unable to read profile control file. Details: %s' % error
+            return
+
+        self.request(options.get('cycles'), options.get('mode'))
+
+    def start(self, name):
+        """
+        Starts profiling a crawl, if a profile has been requested and the
+        crawler still has crawls left to profile.
+
+        Arguments:
+            name<string> -- Name of the crawler.
+
+        Returns:
+            Profile session to hand to finish(), or None if not profiling.
+        """
+        if self.control_path:
+            self.check_control()
+
+        if not self.active:
+            return None
+
+        with self.lock:
+            generation, left = self.remaining.get(name, (None, 0))
+
+            if generation != self.generation:
+                left = self.armed_cycles
+
+            if left < 1:
+                return None
+
+            self.remaining[name] = (self.generation, left - 1)
+            mode = self.armed_mode
+
+        session = {'name': name, 'mode': mode, 'start': time(),
+            'thread': current_thread().ident}
+
+        if mode == 'cprofile':
+            session['profile'] = cProfile.Profile()
+            session['profile'].enable()
+        else:
+            session['stacks'] = {}
+
+            with self.lock:
+                self.sessions[session['thread']] = session
+
+                if not self.sampler:
+                    self.sampler_stop = Event()
+                    self.sampler = Thread(target=self.sample,
+                        args=(self.sampler_stop,))
+                    self.sampler.daemon = True
+                    self.sampler.start()
+
+        return session
+
+    def finish(self, session):
+        """
+        Stops a profile session and writes it to the output directory.
+
+        Arguments:
+            session<dict> -- Session from start().
+        """
+        if session['mode'] == 'cprofile':
+            session['profile'].disable()
+        else:
+            sampler = None
+
+            with self.lock:
+                del self.sessions[session['thread']]
+
+                if not self.sessions:
+                    sampler, self.sampler = self.sampler, None
+                    self.sampler_stop.set()
+
+            if sampler:
+                sampler.join()
+
+        try:
+            path = self.write(session)
+            print 'Wrote profile of %s to %s.' % (session['name'], path)
+        except Exception as error:
+            print 'Unable to write profile. Details: %s' % error
+
+    def write(self, session):
+        """
+        Writes a finished session as a pstats or collapsed stacks file.
+
+        Arguments:
+            session<dict> -- Finished session.
+
+        Returns:
+            Path of the file written.
+        """
+        safe_name = re.sub('[^\w.-]+', '_', session['name'])
+        stamp = strftime('%Y%m%d-%H%M%S', localtime(session['start']))
+        base = os.path.join(self.output_path, '%s-%s-%03d' % (safe_name,
+            stamp, int(session['start'] * 1000) % 1000))
+
+        if session['mode'] == 'cprofile':
+            path = base + '.pstats'
+            session['profile'].dump_stats(path)
+        else:
+            path = base + '.collapsed'
+            handler = open(path, 'w')
+
+            for stack, count in sorted(session['stacks'].items()):
+                handler.write('%s %d\n' % (stack, count))
+
+            handler.close()
+
+        return path
+
+    def sample(self, stop):
+        """
+        Sampler loop. Each interval, records the stack of every thread that
+        belongs to a session in that session, until stopped. A download pool
+        thread belongs to the thread that submitted its current job, which the
+        pool keeps in the thread's owner_ident. Threads idling in a wait are
+        left out.
+
+        Arguments:
+            stop<Event> -- Set to stop sampling.
+        """
+        while not stop.wait(self.sample_interval):
+            threads = dict((t.ident, t) for t in all_threads())
+
+            with self.lock:
+                for thread_id, frame in sys._current_frames().items():
+                    thread = threads.get(thread_id)
+                    owner = getattr(thread, 'owner_ident', None)
+                    session = self.sessions.get(thread_id) or \
+                        self.sessions.get(owner)
+
+                    if not session or frame.f_code.co_name == 'wait':
+                        continue
+
+                    functions = []
+
+                    while frame:
+                        code = frame.f_code
+                        functions.append('%s:%s' % (
+                            os.path.basename(code.co_filename),
+                            code.co_name))
+                        frame = frame.f_back
+
+                    functions.append(thread.name if thread else str(thread_id))
+                    stack = ';'.join(reversed(functions))
+                    session['stacks'][stack] = \
+                        session['stacks'].get(stack, 0) + 1
+
+    def __repr__(self):
+        return '<Profiler: %s>' % ('active' if self.active else 'idle')
+
@@ -0,0 +1,307 @@
+# ==============================================================================
+# RateLimiter.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from email.utils import mktime_tz, parsedate_tz
+from threading import Lock
+from time import sleep, time
+
+
+# ------------------------------------------------------------------------------
+# Classes
+# ------------------------------------------------------------------------------
+
+class RateLimited(Exception):
+    """
+    Raised when a host is throttling requests, or is expected to, and the
+    request has not been sent.
+    """
+
+    def __init__(self, host, retry_in):
+        """
+        Arguments:
+            host<string>    -- Host being throttled.
+            retry_in<float> -- Seconds until the host may be tried again.
+        """
+        Exception.__init__(self, 'Rate limited by %s for %d seconds.' % (host,
+            retry_in))
+        self.host = host
+        self.retry_in = retry_in
+
+
+class TransientError(Exception):
+    """
+    Raised when a single URL failed in a way worth retrying later, such as a
+    server error or a dropped connection, and has not used up its retries.
+    The host is not backed off.
+    """
+
+    def __init__(self, url, details):
+        """
+        Arguments:
+            url<string> -- URL that failed.
+            details     -- Status or error the URL failed with.
+        """
+        Exception.__init__(self, 'Transient failure of %s: %s' % (url,
+            details))
+        self.url = url
+
+
+class RateLimiter(object):
+    """
+    Limits the request rate to each host, shared by every crawler through the
+    HTTP client.
+
+    Each host has a token bucket refilled at its rate, so short bursts are
+    allowed but the long run rate is capped. A 429 or 503 response, or any
+    server error with a Retry-After header, blocks the host for as long as the
+    header asks, or else for a backoff that doubles with each failure in a
+    row. A request that would have to wait longer than max_wait is refused
+    with RateLimited without being sent, so workers are not tied up and
+    requests bound to fail are not made.
+
+    Other server errors and dropped connections only count against the URL
+    that failed, so one broken URL cannot hold back its whole host. A URL is
+    retried up to max_retries times, after which its failure is final.
+    """
+
+    def __init__(self, rate=2.0, burst=10, max_wait=30, base_backoff=5,
+            max_backoff=900, host_rates=None, max_retries=3):
+        """
+        Creates a rate limiter.
+
+        Arguments:
+            rate<float>           -- Default requests per second to a host.
+            burst<int>            -- Requests that may be made at once after
+                                     a quiet spell.
+            max_wait<float>       -- Max seconds a request waits for its turn.
+            base_backoff<float>   -- Seconds a host is first blocked for.
+            max_backoff<float>    -- Max seconds a host is blocked for.
+            host_rates<dict>      -- Optional requests per second for
+                                     particular hosts.
+            max_retries<int>      -- Times a URL that failed transiently is
+                                     retried before its failure is final.
+        """
+        self.THROTTLE_STATUSES = (429, 503)
+        self.SERVER_ERRORS = (500, 502, 504)
+        self.MAX_URLS = 10000
+
+        if rate <= 0:
+            raise Exception('Request rate must be positive.')
+        if burst < 1:
+            raise Exception('Request burst must be at least one.')
+        if max_retries < 0:
+            raise Exception('URL retries cannot be negative.')
+
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.host_rates = host_rates if host_rates else {}
+        self.max_retries = max_retries
+
+        self.hosts = {}
+        self.url_failures = {}
+        self.lock = Lock()
+
+    def acquire(self, host):
+        """
+        Waits for a turn to send a request to a host. Raises RateLimited
+        instead if the turn is more than max_wait away.
+
+        Arguments:
+            host<string> -- Host about to be requested.
+        """
+        with self.lock:
+            state = self.refill(host)
+            now = time()
+            rate = self.host_rates.get(host, self.rate)
+
+            wait = max(state['blocked_until'] - now, 0)
+
+            if state['tokens'] < 1:
+                wait = max(wait, (1 - state['tokens']) / rate)
+
+            if wait > self.max_wait:
+                raise RateLimited(host, wait)
+
+            state['tokens'] -= 1
+
+        if wait:
+            sleep(wait)
+
+    def record(self, host, status, retry_after=None, url=None):
+        """
+        Records the status of a response from a host. A throttling response
+        blocks the host. Any response but a server error clears the host's
+        backoff and the failures of the URL.
+
+        Arguments:
+            host<string>        -- Host that responded.
+            status<int>         -- HTTP status of the response.
+            retry_after<string> -- Optional Retry-After header of the
+                                   response.
+            url<string>         -- Optional URL that was requested.
+
+        Returns:
+            Seconds the host is blocked for, or 0 if the response was not
+            throttled.
+        """
+        result = 0
+        throttled = status in self.THROTTLE_STATUSES or \
+            (status >= 500 and retry_after)
+
+        with self.lock:
+            state = self.refill(host)
+
+            if not throttled:
+                if status < 500:
+                    state['failures'] = 0
+                    self.url_failures.pop(url, None)
+
+                return result
+
+            state['failures'] += 1
+            result = self.parse_retry_after(retry_after)
+
+            if result is None:
+                result = min(self.base_backoff * 2 ** (state['failures'] - 1),
+                    self.max_backoff)
+
+            state['blocked_until'] = max(state['blocked_until'],
+                time() + result)
+            state['tokens'] = 0
+
+        print 'Backing off %s for %d seconds after HTTP %d.' % (host, result,
+            status)
+
+        return result
+
+    def retry_url(self, url):
+        """
+        Counts a transient failure of a URL, such as a server error that did
+        not throttle its host or a dropped connection.
+
+        Arguments:
+            url<string> -- URL that failed.
+
+        Returns:
+            True if the URL may be retried later, else False once it has used
+            up its retries.
+        """
+        with self.lock:
+            failures = self.url_failures.get(url, (0, 0))[0] + 1
+
+            if failures > self.max_retries:
+                self.url_failures.pop(url, None)
+                return False
+
+            self.url_failures[url] = (failures, time())
+
+            if len(self.url_failures) > self.MAX_URLS:
+                by_age = sorted(self.url_failures,
+                    key=lambda k: self.url_failures[k][1])
+
+                for stale in by_age[:len(self.url_failures) - self.MAX_URLS]:
+                    del self.url_failures[stale]
+
+        return True
+
+    def wait_time(self, host):
+        """
+        Finds how long a host is blocked for.
+
+        Arguments:
+            host<string> -- Host to check.
+
+        Returns:
+            Seconds until the host may be requested, or 0 if it is not
+            blocked.
+        """
+        with self.lock:
+            state = self.hosts.get(host)
+
+            if not state:
+                return 0
+
+            return max(state['blocked_until'] - time(), 0)
+
+    def state(self):
+        """
+        Reports the state of every host requested so far.
+
+        Returns:
+            Dictionary of host to a dictionary of tokens, blocked_for in
+            seconds, and failures in a row.
+        """
+        now = time()
+
+        with self.lock:
+            return dict((host, {
+                'tokens': round(state['tokens'], 2),
+                'blocked_for': round(max(state['blocked_until'] - now, 0), 1),
+                'failures': state['failures']
+            }) for host, state in self.hosts.items())
+
+    def refill(self, host):
+        """
+        Adds the tokens a host has earned since it was last checked. Must hold
+        the lock.
+
+        Arguments:
+            host<string> -- Host to refill.
+
+        Returns:
+            The host's state.
+        """
+        now = time()
+        state = self.hosts.get(host)
+
+        if not state:
+            state = {'tokens': self.burst, 'updated': now, 'blocked_until': 0,
+                'failures': 0}
+            self.hosts[host] = state
+
+        rate = self.host_rates.get(host, self.rate)
+        state['tokens'] = min(state['tokens'] + (now - state['updated']) *
+            rate, self.burst)
+        state['updated'] = now
+
+        return state
+
+    def parse_retry_after(self, retry_after):
+        """
+        Reads a Retry-After header, given either as seconds or as a date.
+
+        Arguments:
+            retry_after<string> -- Header value, or None.
+
+        Returns:
+            Seconds to wait, capped at the max backoff, or None if the header
+            is missing or unreadable.
+        """
+        result = None
+
+        if not retry_after:
+            return result
+
+        try:
+            result = float(retry_after)
+        except ValueError:
+            date = parsedate_tz(retry_after)
+
+            if date:
+                result = mktime_tz(date) - time()
+
+        if result is not None:
+            result = min(max(result, 1), self.max_backoff)
+
+        return result
+
+    def __repr__(self):
+        return '<RateLimiter: %d hosts>' % len(self.hosts)
@@ -0,0 +1,224 @@
+# ==============================================================================
+# ScheduledCrawler.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from time import time
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class ScheduledCrawler(object):
+    """
+    Wraps a crawler with its own crawl interval, deadline, and run state so the
+    Armada can schedule it independently of the rest of the fleet.
+
+    Given interval bounds, the interval adapts to how busy the subreddit is.
+    After each crawl the rate of new submissions is estimated from how many
+    of the listing had not been seen before, smoothed over recent crawls. The
+    interval is then set so that about target_fill of the next listing is
+    new: long enough not to waste requests relisting old submissions, short
+    enough that new ones do not roll off the listing unseen.
+    """
+
+    def __init__(self, crawler, interval, deadline=None, profiler=None,
+            min_interval=None, max_interval=None, target_fill=0.5,
+            rate_limiter=None):
+        """
+        Creates a scheduled crawler, due to run immediately.
+
+        Arguments:
+            crawler            -- Crawler to run. Must provide
+                                  crawl(deadline).
+            interval<int>      -- Seconds between the starts of two crawls.
+            deadline<int>      -- Optional max seconds a single crawl may take.
+            profiler<Profiler> -- Optional profiler asked before each crawl
+                                  whether to profile it.
+            min_interval<int>  -- Optional shortest interval to adapt to.
+            max_interval<int>  -- Optional longest interval to adapt to. The
+                                  interval only adapts if both bounds are set
+                                  and the crawler provides listing_counts.
+            target_fill<float> -- Share of each listing that should be new.
+            rate_limiter       -- Optional RateLimiter of the crawler's HTTP
+                                  client, asked before each crawl whether the
+                                  hosts that throttled the last one are still
+                                  backing off.
+        """
+        self.RATE_WEIGHT = 0.3
+
+        if not crawler:
+            raise Exception('Cannot schedule an empty crawler.')
+        if interval <= 0:
+            raise Exception('Crawl interval must be positive.')
+        if deadline is not None and deadline <= 0:
+            raise Exception('Crawl deadline must be positive.')
+        if bool(min_interval) != bool(max_interval):
+            raise Exception('Adaptive intervals need both bounds.')
+        if min_interval and not 0 < min_interval <= max_interval:
+            raise Exception('Interval bounds must be positive and ordered.')
+        if not 0 < target_fill <= 1:
+            raise Exception('Target fill must be between 0 and 1.')
+
+        self.crawler = crawler
+        self.interval = interval
+        self.deadline = deadline
+        self.profiler = profiler
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_fill = target_fill
+        self.rate_limiter = rate_limiter
+        self.rate = None
+
+        if min_interval:
+            self.interval = min(max(interval, min_interval), max_interval)
+
+        self.running = False
+        self.next_run = time()
+        self.last_start = None
+        self.last_duration = None
+
+    def is_due(self, now):
+        """
+        Checks if the crawler should be started. A crawler which is still
+        running is never due. If a host that throttled the last crawl is still
+        backing off, the crawler is not due either, and its next run is pushed
+        past the backoff.
+
+        Arguments:
+            now<float> -- Current time in seconds since the epoch.
+
+        Returns:
+            True if the crawler should be started, else False.
+        """
+        if self.running or now < self.next_run:
+            return False
+
+        wait = self.backoff_wait()
+
+        if wait > 0:
+            self.next_run = now + wait
+            return False
+
+        return True
+
+    def backoff_wait(self):
+        """
+        Finds how long the hosts that throttled the last crawl are still
+        backing off for.
+
+        Returns:
+            Seconds until every such host may be requested again, or 0 if none
+            is blocked or there is no rate limiter.
+        """
+        hosts = getattr(self.crawler, 'throttled_hosts', None)
+
+        if not self.rate_limiter or not hosts:
+            return 0
+
+        return max(self.rate_limiter.wait_time(host) for host in hosts)
+
+    def run(self):
+        """
+        Runs a single crawl and schedules the next one. If the crawl took
+        longer than the interval, the next crawl is due immediately. If a host
+        throttled the crawl, the next one waits until the host reopens.
+        """
+        session = None
+
+        if self.profiler:
+            session = self.profiler.start(self.name())
+
+        start = time()
+        deadline = start + self.deadline if self.deadline else None
+
+        crawled = False
+
+        try:
+            self.crawler.crawl(deadline)
+            crawled = True
+        except Exception as error:
+            print 'Crawl failed for %s. Details: %s' % (self.crawler, error)
+        finally:
+            finish = time()
+
+            if session:
+                self.profiler.finish(session)
+
+            if crawled and self.min_interval:
+                self.adapt(start)
+
+            self.last_start = start
+            self.last_duration = finish - start
+            self.next_run = max(start + self.interval, finish)
+
+            throttled_until = getattr(self.crawler, 'throttled_until', None)
+
+            if throttled_until and throttled_until > self.next_run:
+                self.next_run = throttled_until
+
+        if deadline and finish > deadline:
+            print '%s overran its deadline by %.1f seconds' % (self.crawler,
+                finish - deadline)
+
+    def adapt(self, start):
+        """
+        Updates the estimated rate of new submissions from the crawl that just
+        finished, and sets the interval from it. If the whole listing was new,
+        submissions were probably missed, so the interval is at least halved.
+        A throttled crawl leaves the estimate alone, as its deferred
+        submissions will be counted as new again.
+
+        Arguments:
+            start<float> -- Time the crawl started in seconds since the epoch.
+        """
+        counts = getattr(self.crawler, 'listing_counts', None)
+
+        if not counts or not counts[0] or self.last_start is None:
+            return
+
+        if getattr(self.crawler, 'throttled_until', None):
+            return
+
+        listed, new = counts
+        elapsed = max(start - self.last_start, 1)
+        sample = new / float(elapsed)
+
+        if self.rate is None:
+            self.rate = sample
+        else:
+            self.rate = self.RATE_WEIGHT * sample + \
+                (1 - self.RATE_WEIGHT) * self.rate
+
+        if self.rate > 0:
+            interval = self.target_fill * listed / self.rate
+        else:
+            interval = self.interval * 2
+
+        if new >= listed:
+            interval = min(interval, self.interval / 2.0)
+
+        self.interval = min(max(interval, self.min_interval),
+            self.max_interval)
+
+    def name(self):
+        """
+        Finds a name for the crawler, used to name its profiles and keep their
+        budgets apart. Unique per crawler kind, so the hot and backfill
+        crawlers of one subreddit are not mixed up.
+
+        Returns:
+            The crawler's own name if it has one, else its class name.
+        """
+        if hasattr(self.crawler, 'crawler_name'):
+            return self.crawler.crawler_name()
+
+        return self.crawler.__class__.__name__
+
+    def __repr__(self):
+        return '<ScheduledCrawler: %s every %ss>' % (self.crawler,
+            self.interval)
@@ -0,0 +1,511 @@
+# ==============================================================================
+# SearchIndex.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heapreplace
+from math import log
+from threading import Lock
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class SearchIndex(object):
+    """
+    In-memory inverted index over the Keywords and Wallpapers tables.
+
+    Wallpapers are numbered densely in the order they were added, and each
+    keyword maps to a sorted array of the numbers it describes. Each wallpaper
+    also falls in a size bucket by the classes of its width, height, and width
+    to height ratio, and each keyword keeps a second array per bucket. A search
+    with size filters only walks the buckets the filters can pass, and checks
+    single wallpapers only in buckets that pass in part.
+
+    Posting lists are walked newest first in windows of numbers that double in
+    size, so a search stops after the windows holding its results. Queries
+    matching any keyword skip lists too common to lift a wallpaper into the
+    results found so far (max score).
+    """
+
+    def __init__(self, db_connector):
+        """
+        Creates an empty search index. Call refresh() to load it.
+
+        Arguments:
+            db_connector<MySQLConnector> -- Database to load from.
+        """
+        self.WIDTH_STEPS = (1024, 1280, 1600, 1920, 2560, 3840, 5120)
+        self.HEIGHT_STEPS = (768, 900, 1080, 1200, 1440, 1600, 2160, 2880)
+        self.RATIO_STEPS = (1.25, 1.3, 1.4, 1.5, 1.6, 1.7, 1.8, 1.9, 2.0)
+        self.FIRST_WINDOW = 4096
+
+        if not db_connector:
+            raise Exception('Database connector must be initialized.')
+
+        self.db_connector = db_connector
+        self.lock = Lock()
+
+        self.last_id = 0
+        self.names = []
+        self.widths = array('I')
+        self.heights = array('I')
+        self.buckets = array('H')
+        self.bucket_ranges = {}
+        self.postings = {}
+        self.bucket_postings = {}
+
+    def refresh(self):
+        """
+        Loads the wallpapers and keywords added since the last refresh. The
+        first refresh loads everything.
+
+        Returns:
+            Number of wallpapers added to the index.
+        """
+        wallpapers = self.db_connector.load_wallpapers(self.last_id)
+
+        if not wallpapers:
+            return 0
+
+        keywords = self.db_connector.load_keywords(self.last_id)
+
+        with self.lock:
+            numbers = {}
+
+            for wallpaper_id, name, width, height in wallpapers:
+                numbers[wallpaper_id] = len(self.names)
+                self.names.append(name)
+                self.widths.append(width)
+                self.heights.append(height)
+                self.buckets.append(self.bucket(width, height))
+
+            for word, wallpaper_id in keywords:
+                number = numbers.get(wallpaper_id)
+
+                if number is None:
+                    continue
+
+                if word not in self.postings:
+                    self.postings[word] = array('I')
+                    self.bucket_postings[word] = {}
+
+                self.postings[word].append(number)
+
+                buckets = self.bucket_postings[word]
+                bucket = self.buckets[number]
+
+                if bucket not in buckets:
+                    buckets[bucket] = array('I')
+
+                buckets[bucket].append(number)
+
+            self.last_id = wallpapers[-1][0]
+
+        return len(wallpapers)
+
+    def bucket(self, width, height):
+        """
+        Finds the size bucket of a wallpaper, widening the ranges of sizes
+        seen in the bucket to take it in.
+
+        Arguments:
+            width<int>  -- Pixel width of the wallpaper.
+            height<int> -- Pixel height of the wallpaper.
+
+        Returns:
+            Bucket number.
+        """
+        ratio = float(width) / height if height else 0.0
+        values = (width, height, ratio)
+        classes = [bisect_right(steps, value) for steps, value in
+            zip((self.WIDTH_STEPS, self.HEIGHT_STEPS, self.RATIO_STEPS),
+                values)]
+
+        result = (classes[0] * (len(self.HEIGHT_STEPS) + 1) + classes[1]) * \
+            (len(self.RATIO_STEPS) + 1) + classes[2]
+
+        ranges = self.bucket_ranges.get(result)
+
+        if ranges is None:
+            self.bucket_ranges[result] = [[value, value] for value in values]
+        else:
+            for value_range, value in zip(ranges, values):
+                value_range[0] = min(value_range[0], value)
+                value_range[1] = max(value_range[1], value)
+
+        return result
+
+    def select_buckets(self, filters):
+        """
+        Sorts the buckets in use by how the sizes seen in them fare against
+        the size filters.
+
+        Arguments:
+            filters<tuple> -- Min width, min height, min ratio, and max ratio.
+
+        Returns:
+            Dictionary of the buckets holding wallpapers that pass, each to
+            True if all of its wallpapers pass, else False.
+        """
+        min_width, min_height, min_ratio, max_ratio = filters
+        result = {}
+
+        for bucket, ranges in self.bucket_ranges.iteritems():
+            (lowest_width, highest_width), (lowest_height, highest_height), \
+                (lowest_ratio, highest_ratio) = ranges
+
+            if highest_width < min_width or highest_height < min_height:
+                continue
+            if min_ratio is not None and highest_ratio < min_ratio:
+                continue
+            if max_ratio is not None and lowest_ratio > max_ratio:
+                continue
+
+            result[bucket] = lowest_width >= min_width and \
+                lowest_height >= min_height and \
+                (min_ratio is None or lowest_ratio >= min_ratio) and \
+                (max_ratio is None or highest_ratio <= max_ratio)
+
+        return result
+
+    def search(self, words, match_all=True, min_width=0, min_height=0,
+            min_ratio=None, max_ratio=None, limit=20):
+        """
+        Finds wallpapers by keyword. Results are ranked by the summed rarity of
+        the keywords they match, newest first among equals.
+
+        Arguments:
+            words<[string]>  -- Keywords or phrases to search for.
+            match_all<bool>  -- If True, results match every keyword, else any.
+            min_width<int>   -- Minimum pixel width of results.
+            min_height<int>  -- Minimum pixel height of results.
+            min_ratio<float> -- Optional minimum width to height ratio.
+            max_ratio<float> -- Optional maximum width to height ratio.
+            limit<int>       -- Max number of results.
+
+        Returns:
+            List of dictionaries with the name, width, height, and score of each
+            result, best first.
+        """
+        words = set(word.lower() for word in words)
+
+        if not words or limit < 1:
+            return []
+
+        filters = (min_width, min_height, min_ratio, max_ratio)
+
+        with self.lock:
+            selected = self.select_buckets(filters)
+
+            if len(selected) == len(self.bucket_ranges) and \
+                    all(selected.itervalues()):
+                selected = None
+
+            if match_all:
+                return self.search_all(words, filters, selected, limit)
+            else:
+                return self.search_any(words, filters, selected, limit)
+
+    def search_all(self, words, filters, selected, limit):
+        """
+        Finds wallpapers matching every keyword. Every result scores the same,
+        so the windows are walked newest first until enough results are found,
+        intersecting the slices of the posting lists of each bucket that fall
+        in the window.
+
+        Arguments:
+            words<set>       -- Keywords to match.
+            filters<tuple>   -- Size filters, as given to search().
+            selected<dict>   -- Buckets to search, from select_buckets(), or
+                                None if every wallpaper passes the filters.
+            limit<int>       -- Max number of results.
+
+        Returns:
+            List of result dictionaries.
+        """
+        if not all(word in self.postings for word in words):
+            return []
+
+        score = sum(self.rarity(word) for word in words)
+        groups = []
+
+        if selected is None:
+            groups.append(([self.postings[word] for word in words], True))
+        else:
+            for bucket, passes_all in selected.iteritems():
+                lists = [self.bucket_postings[word].get(bucket)
+                    for word in words]
+
+                if all(lists):
+                    groups.append((lists, passes_all))
+
+        ends = [[len(postings) for postings in lists]
+            for lists, passes_all in groups]
+        high = len(self.names)
+        window = self.FIRST_WINDOW
+        result = []
+
+        while groups and len(result) < limit and high > 0:
+            low = max(high - window, 0)
+            found = []
+
+            for g, (lists, passes_all) in enumerate(groups):
+                slices = []
+
+                for j, postings in enumerate(lists):
+                    start = bisect_left(postings, low, 0, ends[g][j])
+                    slices.append(postings[start:ends[g][j]])
+                    ends[g][j] = start
+
+                matches = set(min(slices, key=len)).intersection(*slices)
+                found.extend(number for number in matches
+                    if passes_all or self.passes(number, filters))
+
+            found.sort(reverse=True)
+            result.extend(self.describe(number, score)
+                for number in found[:limit - len(result)])
+
+            high = low
+            window *= 2
+
+        return result
+
+    def search_any(self, words, filters, selected, limit):
+        """
+        Finds wallpapers matching any keyword, scoring each by the rarity of
+        the keywords it matches.
+
+        The windows are walked newest first, keeping the best results in a
+        heap. Keywords are ordered from most to least common. Once the heap is
+        full, the most common keywords whose rarities add up to no more than
+        the worst result cannot lift a wallpaper matching only them into the
+        results, so their lists are no longer walked, only probed for
+        wallpapers found in the others. The walk ends once no keyword is left
+        to walk.
+
+        Arguments:
+            words<set>       -- Keywords to match.
+            filters<tuple>   -- Size filters, as given to search().
+            selected<dict>   -- Buckets to search, from select_buckets(), or
+                                None if every wallpaper passes the filters.
+            limit<int>       -- Max number of results.
+
+        Returns:
+            List of result dictionaries.
+        """
+        terms = []
+
+        for word in words:
+            if word not in self.postings:
+                continue
+
+            if selected is None:
+                lists = [self.postings[word]]
+            else:
+                buckets = self.bucket_postings[word]
+                lists = [buckets[b] for b in selected if b in buckets]
+
+            if lists:
+                terms.append((self.rarity(word), self.postings[word], lists))
+
+        terms.sort(key=lambda term: term[0])
+
+        # Scores are summed in keyword order and kept by the set of keywords
+        # matched, so the same keywords always score exactly the same as
+        # their bound.
+        scores = {0: 0.0}
+        bounds = [0.0]
+
+        for i, term in enumerate(terms):
+            bounds.append(bounds[-1] + term[0])
+            scores[(1 << (i + 1)) - 1] = bounds[-1]
+
+        ends = [[len(postings) for postings in term[2]] for term in terms]
+        first_walked = 0
+        high = len(self.names)
+        window = self.FIRST_WINDOW
+        heap = []
+
+        while first_walked < len(terms) and high > 0:
+            low = max(high - window, 0)
+            groups = {}
+
+            for i in range(first_walked, len(terms)):
+                bit = 1 << i
+                numbers = set()
+
+                for j, postings in enumerate(terms[i][2]):
+                    start = bisect_left(postings, low, 0, ends[i][j])
+                    numbers.update(postings[start:ends[i][j]])
+                    ends[i][j] = start
+
+                for matched in groups.keys():
+                    both = groups[matched] & numbers
+
+                    if both:
+                        groups[matched] -= both
+                        groups[matched | bit] = both
+                        numbers -= both
+
+                if numbers:
+                    groups[bit] = numbers
+
+            unwalked = (1 << first_walked) - 1
+            group_bounds = dict((matched, self.mask_score(terms,
+                matched | unwalked, scores)) for matched in groups)
+
+            for matched in sorted(groups, key=group_bounds.get, reverse=True):
+                bound = group_bounds[matched]
+
+                for number in sorted(groups[matched], reverse=True):
+                    if len(heap) == limit and (bound, number) < heap[0]:
+                        break
+
+                    if selected is not None and \
+                            not selected[self.buckets[number]] and \
+                            not self.passes(number, filters):
+                        continue
+
+                    found = matched
+
+                    for i in range(first_walked):
+                        if self.has_posting(terms[i][1], number):
+                            found |= 1 << i
+
+                    result = (self.mask_score(terms, found, scores), number)
+
+                    if len(heap) < limit:
+                        heappush(heap, result)
+                    elif result > heap[0]:
+                        heapreplace(heap, result)
+
+            if len(heap) == limit:
+                while first_walked < len(terms) and \
+                        bounds[first_walked + 1] <= heap[0][0]:
+                    first_walked += 1
+
+            high = low
+            window *= 2
+
+        ranked = sorted(heap, reverse=True)
+
+        return [self.describe(number, score) for score, number in ranked]
+
+    def mask_score(self, terms, matched, scores):
+        """
+        Adds up the rarity of a set of keywords, in keyword order.
+
+        Arguments:
+            terms<list>   -- Rarity, posting list, and walked lists of each
+                             keyword, in order.
+            matched<int>  -- Bit mask of the keywords matched.
+            scores<dict>  -- Scores summed so far, by bit mask.
+
+        Returns:
+            Summed rarity of the keywords.
+        """
+        result = scores.get(matched)
+
+        if result is None:
+            result = 0.0
+
+            for i, term in enumerate(terms):
+                if matched >> i & 1:
+                    result += term[0]
+
+            scores[matched] = result
+
+        return result
+
+    def has_posting(self, postings, number):
+        """
+        Checks if a posting list holds a wallpaper.
+
+        Arguments:
+            postings<array> -- Sorted posting list of a keyword.
+            number<int>     -- Index number of the wallpaper.
+
+        Returns:
+            True if the wallpaper is in the posting list, else False.
+        """
+        position = bisect_left(postings, number)
+
+        return position < len(postings) and postings[position] == number
+
+    def rarity(self, word):
+        """
+        Scores how rare a keyword is across the index (inverse document
+        frequency).
+
+        Arguments:
+            word<string> -- Keyword in the index.
+
+        Returns:
+            Rarity score, higher for rarer keywords.
+        """
+        return log(float(len(self.names) + 1) /
+            (len(self.postings[word]) + 1)) + 1.0
+
+    def passes(self, number, filters):
+        """
+        Checks a wallpaper against the size filters.
+
+        Arguments:
+            number<int>    -- Index number of the wallpaper.
+            filters<tuple> -- Min width, min height, min ratio, and max ratio.
+
+        Returns:
+            True if the wallpaper passes every filter, else False.
+        """
+        min_width, min_height, min_ratio, max_ratio = filters
+        width, height = self.widths[number], self.heights[number]
+
+        if width < min_width or height < min_height:
+            return False
+
+        if min_ratio is not None or max_ratio is not None:
+            ratio = float(width) / height if height else 0.0
+
+            if min_ratio is not None and ratio < min_ratio:
+                return False
+            if max_ratio is not None and ratio > max_ratio:
+                return False
+
+        return True
+
+    def describe(self, number, score):
+        """
+        Creates a search result for a wallpaper.
+
+        Arguments:
+            number<int>  -- Index number of the wallpaper.
+            score<float> -- Ranking score of the wallpaper.
+
+        Returns:
+            Dictionary of the wallpaper's name, width, height, and score.
+        """
+        return {
+            'name': self.names[number],
+            'width': self.widths[number],
+            'height': self.heights[number],
+            'score': score
+        }
+
+    def size(self):
+        """
+        Returns the number of wallpapers in the index.
+
+        Returns:
+            Number of wallpapers in the index.
+        """
+        return len(self.names)
+
+    def __repr__(self):
+        return '<SearchIndex: %d wallpapers>' % len(self.names)
@@ -0,0 +1,153 @@
+# ==============================================================================
+# SeenIndex.py
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+import hashlib
+from math import ceil, log
+import mmap
+import os
+import struct
+from threading import Lock
+
+
+# ------------------------------------------------------------------------------
+# Class
+# ------------------------------------------------------------------------------
+
+class SeenIndex(object):
+    """
+    A persistent set of everything the crawlers have already handled, kept as
+    a Bloom filter in a memory-mapped file so it survives restarts.
+
+    Items are never reported unseen once added. With the configured error rate
+    an unseen item is occasionally reported as seen, and is then skipped.
+    """
+
+    def __init__(self, path, capacity=1000000, error_rate=0.001):
+        """
+        Opens the index file, creating it if it does not exist. An existing
+        file keeps the capacity and error rate it was created with.
+
+        Arguments:
+            path<string>      -- Filesystem path of the index file.
+            capacity<int>     -- Number of items the index is sized for.
+            error_rate<float> -- Chance an unseen item is reported as seen
+                                 once the index holds capacity items.
+        """
+        self.MAGIC = 'CUTSEEN1'
+        self.HEADER_FORMAT = '>8sQI'
+        self.HEADER_SIZE = struct.calcsize(self.HEADER_FORMAT)
+
+        if not path:
+            raise Exception('Seen index path cannot be empty.')
+        if capacity < 1:
+            raise Exception('Seen index capacity must be positive.')
+        if not 0 < error_rate < 1:
+            raise Exception('Seen index error rate must be between 0 and 1.')
+
+        self.path = path
+        self.lock = Lock()
+
+        if not os.path.isfile(path):
+            self.create(capacity, error_rate)
+
+        self.handle = open(path, 'r+b')
+        magic, self.bit_count, self.hash_count = struct.unpack(
+            self.HEADER_FORMAT, self.handle.read(self.HEADER_SIZE))
+
+        if magic != self.MAGIC:
+            raise Exception('Not a seen index file: %s' % path)
+
+        self.map = mmap.mmap(self.handle.fileno(), 0)
+
+    def create(self, capacity, error_rate):
+        """
+        Writes an empty index file sized for the capacity and error rate.
+
+        Arguments:
+            capacity<int>     -- Number of items the index is sized for.
+            error_rate<float> -- Chance of a false positive at capacity.
+        """
+        bit_count = int(ceil(-capacity * log(error_rate) / log(2) ** 2))
+        hash_count = max(1, int(round(float(bit_count) / capacity * log(2))))
+        byte_count = (bit_count + 7) // 8
+
+        header = struct.pack(self.HEADER_FORMAT,
+            self.MAGIC,
+            bit_count,
+            hash_count)
+
+        handle = open(self.path, 'wb')
+        handle.write(header)
+        handle.truncate(self.HEADER_SIZE + byte_count)
+        handle.close()
+
+    def positions(self, item):
+        """
+        Finds the bits that represent an item.
+
+        Arguments:
+            item<string> -- Item to hash.
+
+        Returns:
+            List of bit positions.
+        """
+        digest = hashlib.sha1(item).digest()
+        first, second = struct.unpack('>QQ', digest[:16])
+
+        return [(first + i * second) % self.bit_count
+            for i in range(self.hash_count)]
+
+    def has_item(self, item):
+        """
+        Checks if the item has been seen.
+
+        Arguments:
+            item<string> -- Item to check.
+
+        Returns:
+            True if the item has probably been seen, False if it has not.
+        """
+        with self.lock:
+            for position in self.positions(item):
+                offset = self.HEADER_SIZE + position // 8
+
+                if not ord(self.map[offset]) & (1 << position % 8):
+                    return False
+
+        return True
+
+    def add(self, item):
+        """
+        Marks the item as seen.
+
+        Arguments:
+            item<string> -- Item to add.
+        """
+        with self.lock:
+            for position in self.positions(item):
+                offset = self.HEADER_SIZE + position // 8
+                byte = ord(self.map[offset]) | (1 << position % 8)
+                self.map[offset] = chr(byte)
+
+    def flush(self):
+        """
+        Writes any changes through to the index file.
+        """
+        with self.lock:
+            self.map.flush()
+
+    def close(self):
+        """
+        Flushes and closes the index file.
+        """
+        self.flush()
+        self.map.close()
+        self.handle.close()
+
+    def __repr__(self):
+        return '<SeenIndex: %s>' % self.path
@@ -6,7 +6,8 @@
 # Imports
 # ------------------------------------------------------------------------------
 
-from collections import deque
+from collections import OrderedDict
+from time import time
 
 
 # ------------------------------------------------------------------------------
@@ -15,22 +16,38 @@ from collections import deque
 
 class SubmissionCache(object):
     """
-    Stores and manages the most recently crawled submissions.
+    Stores and manages the most recently crawled submissions. Lookups are hash
+    based, the least recently seen item is evicted once the cache is full, and
+    items may optionally expire after a time to live.
     """
 
-    def __init__(self, size):
+    def __init__(self, size, ttl=None):
         """
         Create an empty submission cache.
 
         Arguments:
             size<int> -- Size of the cache.
+            ttl<int>  -- Optional seconds an item stays cached after it was
+                         added.
         """
-        self.cache = deque()
+        if size < 1:
+            raise Exception('Cache size must be positive.')
+        if ttl is not None and ttl <= 0:
+            raise Exception('Cache time to live must be positive.')
+
+        self.cache = OrderedDict()
         self.max_size = size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
     def has_item(self, item):
         """
-        Checks if the item is in the cache.
+        Checks if the item is in the cache. A cached item counts as recently
+        seen, while an expired item is dropped.
 
         Arguments:
             item<string> -- Item to check.
@@ -38,7 +55,20 @@ class SubmissionCache(object):
         Returns:
             True if the item is in the cache, else False.
         """
-        return item in self.cache
+        added = self.cache.pop(item, None)
+
+        if added is not None and self.ttl and time() - added > self.ttl:
+            self.expirations += 1
+            added = None
+
+        if added is None:
+            self.misses += 1
+            return False
+
+        self.cache[item] = added
+        self.hits += 1
+
+        return True
 
     def add(self, item):
         """
@@ -48,13 +78,24 @@ class SubmissionCache(object):
         Arguments:
             item<string> -- Item to cache.
         """
-        if self.has_item(item):
+        if item in self.cache:
             return
 
-        self.cache.append(item)
+        self.cache[item] = time()
 
         if self.size() > self.max_size:
-            self.cache.popleft()
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+    def remove(self, item):
+        """
+        Removes an item from the cache, such as one that should be crawled
+        again. If the item is not present, silently return.
+
+        Arguments:
+            item<string> -- Item to remove.
+        """
+        self.cache.pop(item, None)
 
     def size(self):
         """
@@ -64,3 +105,21 @@ class SubmissionCache(object):
             Number of items in cache.
         """
         return len(self.cache)
+
+    def stats(self):
+        """
+        Returns the cache's lookup and eviction counters.
+
+        Returns:
+            Dictionary of hits, misses, evictions, expirations, and hit rate.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.0
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': hit_rate
+        }
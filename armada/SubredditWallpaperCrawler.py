@@ -6,17 +6,20 @@
 # Imports
 # ------------------------------------------------------------------------------
 
-import hashlib
-from nltk.corpus import stopwords
-from PIL import Image
+from functools import partial
 import praw
-import re
-import StringIO
-import urllib2
+from threading import Lock
+from time import time
 
+from DownloadPool import DeadlinePassed, DownloadPool
 from FileWriter import FileWriter
+from HttpClient import HttpClient
+from ImgurResolver import ImgurResolver
+from KeywordExtractor import KeywordExtractor
+from Metrics import Metrics
+from RateLimiter import RateLimited, TransientError
 from SubmissionCache import SubmissionCache
-from Wallpaper import Wallpaper
+from Wallpaper import ImageRejected, make_name_stem, Wallpaper
 
 
 # ------------------------------------------------------------------------------
@@ -34,24 +37,90 @@ class SubredditWallpaperCrawler(object):
             wallpaper_path,
             thumbnail_path,
             limit=25,
-            cache_size=50):
+            cache_size=50,
+            download_pool=None,
+            image_processor=None,
+            cache_ttl=None,
+            seen_index=None,
+            duplicate_index=None,
+            keyword_extractor=None,
+            http_client=None,
+            resolver=None,
+            thumbnail_store=None,
+            thumbnail_specs=None,
+            stream_path=None,
+            byte_budget=None,
+            metrics=None,
+            subreddit=None):
         """
         Creates a subreddit wallpaper crawler.
 
         Arguments:
-            subreddit_name<string>       -- Name of the subreddit to crawl.
-            db_connector<MySQLConnector> -- Database connection object.
-            wallpaper_path<string>       -- Filesystem path to where wallpapers
-                                            are saved.
-            limit<int>                   -- Max number of items to get during
-                                            crawl.
-            cache_size<int>              -- Size of previously crawled items
-                                            cache.
+            subreddit_name<string>              -- Name of the subreddit to
+                                                   crawl.
+            db_connector<DatabaseWriter>        -- Write-behind database writer.
+            wallpaper_path<string>              -- Filesystem path to where
+                                                   wallpapers are saved.
+            thumbnail_path<string>              -- Filesystem path to where
+                                                   thumbnails are saved.
+            limit<int>                          -- Max number of items to get
+                                                   during crawl.
+            cache_size<int>                     -- Size of previously crawled
+                                                   items cache.
+            download_pool<DownloadPool>         -- Optional pool to download
+                                                   images on. Defaults to a
+                                                   private pool.
+            image_processor<ImageProcessor>     -- Optional processor to decode
+                                                   and thumbnail images on.
+                                                   Defaults to processing
+                                                   inline.
+            cache_ttl<int>                      -- Optional seconds a crawled
+                                                   item stays cached.
+            seen_index<SeenIndex>               -- Optional persistent index of
+                                                   handled submissions and
+                                                   images, checked before
+                                                   downloading.
+            duplicate_index<PerceptualIndex>    -- Optional index of stored
+                                                   wallpapers' perceptual
+                                                   hashes, used to skip near
+                                                   duplicates.
+            keyword_extractor<KeywordExtractor> -- Optional shared keyword
+                                                   extractor. Defaults to a
+                                                   private one with no corpus.
+            http_client<HttpClient>             -- Optional shared HTTP client.
+                                                   Defaults to a private
+                                                   client.
+            resolver<ImgurResolver>             -- Optional shared resolver of
+                                                   submission URLs to image
+                                                   URLs. Defaults to a private
+                                                   resolver with no cache file.
+            thumbnail_store<PackStore>          -- Optional pack store to keep
+                                                   thumbnails in. Defaults to
+                                                   a file each under the
+                                                   thumbnail path.
+            thumbnail_specs<[tuple]>            -- Optional (name, width,
+                                                   height, format, quality)
+                                                   tuples of the thumbnails
+                                                   to make of each wallpaper.
+            stream_path<string>                 -- Optional directory to stream
+                                                   downloads into rather than
+                                                   holding them in memory.
+            byte_budget<ByteBudget>             -- Optional budget of image
+                                                   bytes held at once, shared
+                                                   by every crawler.
+            metrics<Metrics>                    -- Optional shared metrics
+                                                   registry. Defaults to a
+                                                   private one.
+            subreddit                           -- Optional subreddit object to
+                                                   crawl, such as a stand-in
+                                                   for benchmarks. Defaults to
+                                                   connecting to Reddit.
         """
         self.ITEM_LIMIT = 50
         self.NAME_LENGTH = 10
         self.MIN_IMAGE_WIDTH = 1024
         self.MIN_IMAGE_HEIGHT = 768
+        self.RETRY_ERRORS = (DeadlinePassed, RateLimited, TransientError)
 
         if not subreddit_name:
             raise Exception('Subreddit name cannot be empty.')
@@ -67,104 +136,714 @@ class SubredditWallpaperCrawler(object):
         self.db_connector = db_connector
         self.wallpaper_path = wallpaper_path
         self.thumbnail_path = thumbnail_path
-        self.submission_cache = SubmissionCache(cache_size)
+        self.file_writer = FileWriter()
+        self.thumbnail_writer = thumbnail_store if thumbnail_store else \
+            self.file_writer
+        self.thumbnail_specs = thumbnail_specs
+        self.stream_path = stream_path
+        self.byte_budget = byte_budget
+        self.metrics = metrics if metrics else Metrics()
+
+        if stream_path:
+            self.file_writer.make_directory(stream_path)
+        self.submission_cache = SubmissionCache(cache_size, cache_ttl)
         self.item_limit = limit
+        self.listing_counts = None
+        self.progress_lock = Lock()
+        self.retry_ids = set()
+        self.throttled_until = None
+        self.throttled_hosts = set()
+        self.download_pool = download_pool if download_pool else DownloadPool()
+        self.image_processor = image_processor
+        self.http_client = http_client if http_client else HttpClient()
+        self.resolver = resolver if resolver else \
+            ImgurResolver(self.http_client)
+        self.seen_index = seen_index
+        self.duplicate_index = duplicate_index
+
+        if keyword_extractor:
+            self.keyword_extractor = keyword_extractor
+        else:
+            self.keyword_extractor = KeywordExtractor()
 
         self.known_extensions = ['jpg', 'png']
 
         self.user_agent = 'cutter -- Wallpaper Scraper 0.1 -- /u/expat_one'
 
-        try:
-            reddit = praw.Reddit(user_agent=self.user_agent)
-            self.subreddit = reddit.get_subreddit(self.subreddit_name)
-        except Exception as error:
-            print 'Unable to connect to Reddit. Details: %s' % error
-            raise error
+        if subreddit:
+            self.subreddit = subreddit
+        else:
+            try:
+                reddit = praw.Reddit(user_agent=self.user_agent)
+                self.subreddit = reddit.get_subreddit(self.subreddit_name)
+            except Exception as error:
+                print 'Unable to connect to Reddit. Details: %s' % error
+                raise error
 
-    def crawl(self):
+    def crawl(self, deadline=None):
         """
-        Crawls the subreddit, saving wallpapers as it goes.
+        Crawls the subreddit, saving wallpapers as it goes. Keywords for the
+        whole listing are made in one batch, and each submission URL is
+        resolved to its images, several for an album. Images are then
+        downloaded concurrently on the download pool and stored as each
+        download finishes.
+
+        A submission is marked seen once all of its images have been handled.
+
+        Arguments:
+            deadline<float> -- Optional time in seconds since the epoch. No new
+                               downloads are started once it has passed.
         """
-        submissions = self.subreddit.get_hot(limit=self.item_limit)
+        crawl_start = time()
+        self.throttled_until = None
+        self.throttled_hosts = set()
 
-        for submission in submissions:
-            try:
-                self.handle_submission(submission)
-            except Exception as error:
+        with self.metrics.timer('stage_seconds', self.labels('listing')):
+            listing = list(self.get_listing())
+
+        self.handle_listing(listing, deadline)
+
+        self.metrics.observe('crawl_seconds', time() - crawl_start,
+            self.labels(None))
+
+    def get_listing(self):
+        """
+        Gets the submissions to crawl.
+
+        Returns:
+            Iterable of the subreddit's hot submissions.
+        """
+        return self.subreddit.get_hot(limit=self.item_limit)
+
+    def handle_listing(self, listing, deadline=None):
+        """
+        Saves the wallpapers of a listing's new submissions, then flushes the
+        resolver cache and the seen index. The number of submissions listed and
+        the number new are kept in listing_counts, for the scheduler to adapt
+        the crawl interval to.
+
+        Submissions not handled because the deadline passed, a host was
+        throttling, or a URL failed in a way worth retrying are left to be
+        crawled again, and are not counted as new.
+        throttled_until is set to when the first throttling host reopens.
+
+        Arguments:
+            listing<list>   -- Subreddit submissions.
+            deadline<float> -- Optional time in seconds since the epoch. No new
+                               downloads are started once it has passed.
+
+        Returns:
+            Set of the ids of submissions that failed in a way worth retrying:
+            deferred, or not stored. Records still queued for the database
+            add to it on the writer thread once they fail.
+        """
+        self.forget_retries()
+        submissions = [s for s in listing if self.is_new_submission(s)]
+
+        self.metrics.increment('submissions_total', self.labels(None,
+            result='listed'), len(listing))
+        self.metrics.increment('submissions_total', self.labels(None,
+            result='new'), len(submissions))
+
+        titles = [s.title for s in submissions]
+        keywords = self.keyword_extractor.extract_batch(titles)
+        jobs = [(s.url, (s, k)) for s, k in zip(submissions, keywords)]
+
+        progress = {'pending': {}, 'failed': set(), 'retry': set()}
+        deferred = set()
+        image_jobs = []
+        resolved = self.download_pool.run(jobs, self.resolve, deadline)
+
+        for (submission, keywords), image_urls, error in resolved:
+            if isinstance(error, self.RETRY_ERRORS):
+                self.defer(submission, 'resolve', error)
+                deferred.add(submission.id)
+                progress['retry'].add(submission.id)
+                continue
+            elif error:
+                self.metrics.increment('errors_total', self.labels('resolve'))
+                print 'Unable to resolve %s. Details: %s' % (submission.url,
+                    error)
+                continue
+
+            image_urls = [u for u in image_urls if self.is_new_image(u)]
+
+            if not image_urls:
+                self.mark_seen(submission)
+                continue
+
+            progress['pending'][submission.id] = len(image_urls)
+
+            for image_url in image_urls:
+                image_jobs.append((image_url,
+                    (submission, keywords, image_url)))
+
+        downloads = self.download_pool.run(image_jobs, self.download,
+            deadline)
+
+        for (submission, keywords, image_url), wallpaper, error in downloads:
+            done = False
+            retry = True
+
+            if isinstance(error, ImageRejected):
+                self.count_rejection(error.reason)
+                print 'Skipped %s. %s' % (image_url, error)
+                done = True
+            elif isinstance(error, self.RETRY_ERRORS):
+                self.defer(submission, 'download', error)
+                deferred.add(submission.id)
+            elif error:
+                self.metrics.increment('errors_total', self.labels('download'))
                 print 'Unable to handle submission. Details: %s' % error
+                retry = False
+            else:
+                self.count_download(wallpaper)
+
+                try:
+                    done = self.handle_submission(submission, wallpaper,
+                        keywords, partial(self.finish_image, progress,
+                            submission, image_url))
+                except Exception as error:
+                    self.metrics.increment('errors_total',
+                        self.labels('store'))
+                    print 'Unable to handle submission. Details: %s' % error
+                finally:
+                    wallpaper.release()
+
+            if done is not None:
+                self.finish_image(progress, submission, image_url, done,
+                    retry)
+
+        self.listing_counts = (len(listing), len(submissions) - len(deferred))
+        self.resolver.flush()
+
+        if self.seen_index:
+            self.seen_index.flush()
+
+        return progress['retry']
+
+    def finish_image(self, progress, submission, image_url, done,
+            retry=True):
+        """
+        Records that one of a submission's images has been handled. The image
+        is marked seen if it is done with, and the submission once all of its
+        images are. Called on the database writer thread for an image whose
+        record was queued, once the record has been committed or has failed.
 
-    def handle_submission(self, submission):
+        Arguments:
+            progress<dict>    -- Images still pending for each submission id,
+                                 and the ids of submissions with a failed
+                                 image and of those worth retrying.
+            submission        -- Single subreddit submission.
+            image_url<string> -- Absolute URL of the image.
+            done<bool>        -- True if the image is done with, else False.
+            retry<bool>       -- If the image failed, whether it is worth
+                                 retrying.
         """
-        Crawl an individual submission. Extract relevant information and
-        possibly save the wallpaper.
+        with self.progress_lock:
+            if not done:
+                progress['failed'].add(submission.id)
+
+                if retry:
+                    progress['retry'].add(submission.id)
+                    self.retry_ids.add(submission.id)
+
+            progress['pending'][submission.id] -= 1
+            finished = not progress['pending'][submission.id] and \
+                submission.id not in progress['failed']
+
+        if done:
+            self.mark_image_seen(image_url)
+
+        if finished:
+            self.mark_seen(submission)
+
+    def forget_retries(self):
+        """
+        Drops submissions whose images failed in a way worth retrying from the
+        submission cache, so they are crawled again. The failures are noted by
+        finish_image, possibly on the database writer thread, and dropped here
+        on the crawl thread, as the cache is not thread safe.
+        """
+        with self.progress_lock:
+            retry_ids, self.retry_ids = self.retry_ids, set()
+
+        for submission_id in retry_ids:
+            self.submission_cache.remove(submission_id)
+
+    def defer(self, submission, stage, error):
+        """
+        Leaves a submission that missed the deadline, that a throttling host
+        turned away, or whose URL failed transiently, to be crawled again by
+        dropping it from the submission cache. For a throttling host, notes
+        the host and when it reopens.
+
+        Arguments:
+            submission    -- Single subreddit submission.
+            stage<string> -- Stage that was not run.
+            error         -- DeadlinePassed, RateLimited, or TransientError
+                             raised for the submission.
+        """
+        self.submission_cache.remove(submission.id)
+
+        if not isinstance(error, RateLimited):
+            return
+
+        self.metrics.increment('throttled_total', self.labels(stage,
+            host=error.host))
+        self.throttled_hosts.add(error.host)
+
+        reopens = time() + error.retry_in
+
+        if self.throttled_until is None or reopens < self.throttled_until:
+            self.throttled_until = reopens
+
+    def crawler_name(self):
+        """
+        Names this crawler in metrics and profiles.
+
+        Returns:
+            The subreddit name.
+        """
+        return self.subreddit_name
+
+    def labels(self, stage, **extra):
+        """
+        Creates the metric labels for this crawler.
+
+        Arguments:
+            stage<string> -- Optional stage of the crawl, such as download.
+            extra         -- Any further labels.
+
+        Returns:
+            Dictionary of label names and values.
+        """
+        result = {'crawler': self.crawler_name()}
+
+        if stage:
+            result['stage'] = stage
+
+        result.update(extra)
+
+        return result
+
+    def count_download(self, wallpaper):
+        """
+        Records the time each stage of a finished download took, and its size.
+
+        Arguments:
+            wallpaper<Wallpaper> -- Downloaded wallpaper.
+        """
+        for stage, seconds in wallpaper.timings.items():
+            self.metrics.observe('stage_seconds', seconds, self.labels(stage))
+
+        self.metrics.increment('downloaded_bytes_total', self.labels(None),
+            wallpaper.bytes_read)
+
+    def count_rejection(self, reason):
+        """
+        Records an image turned down, and why.
+
+        Arguments:
+            reason<string> -- Why the image was turned down, such as
+                              'too small' or 'duplicate'.
+        """
+        self.metrics.increment('rejected_total', self.labels(None,
+            reason=reason))
+
+    def resolve(self, url):
+        """
+        Resolves a submission URL to its image URLs. Runs on a download pool
+        thread.
+
+        Arguments:
+            url<string> -- Absolute URL of the submission.
+
+        Returns:
+            List of direct image URLs.
+        """
+        with self.metrics.timer('stage_seconds', self.labels('resolve')):
+            return self.resolver.resolve(url)
+
+    def is_new_submission(self, submission):
+        """
+        Checks if the submission has not been crawled recently, and marks it as
+        crawled. Submissions and images handled before a restart are found in
+        the seen index, if there is one.
 
         Arguments:
             submission -- Single subreddit submission.
+
+        Returns:
+            True if the submission has not been crawled recently, else False.
         """
         submission_id = submission.id
 
         if self.submission_cache.has_item(submission_id):
-            return
+            return False
         else:
             self.submission_cache.add(submission_id)
 
-        wallpaper = Wallpaper(submission.url)
+        if self.seen_index:
+            for key in self.seen_keys(submission):
+                if self.seen_index.has_item(key):
+                    return False
+
+        return True
+
+    def seen_keys(self, submission):
+        """
+        Creates the seen index keys for a submission: its id, and the name of
+        the image at its URL.
+
+        Arguments:
+            submission -- Single subreddit submission.
+
+        Returns:
+            List of seen index keys.
+        """
+        return ['submission:%s' % submission.id,
+            self.image_key(submission.url)]
+
+    def is_new_image(self, image_url):
+        """
+        Checks if an image has not been handled before, according to the seen
+        index if there is one.
 
-        if wallpaper != None and self.good_size(wallpaper):
-            keywords = self.make_keywords(submission.title)
+        Arguments:
+            image_url<string> -- Absolute URL of the image.
+
+        Returns:
+            True if the image has not been handled, else False.
+        """
+        result = True
+
+        if self.seen_index:
+            result = not self.seen_index.has_item(self.image_key(image_url))
+
+        return result
+
+    def image_key(self, image_url):
+        """
+        Creates the seen index key for an image.
+
+        Arguments:
+            image_url<string> -- Absolute URL of the image.
+
+        Returns:
+            Seen index key.
+        """
+        name_stem = make_name_stem(image_url.encode('utf-8'), self.NAME_LENGTH)
+
+        return 'image:%s' % name_stem
+
+    def mark_image_seen(self, image_url):
+        """
+        Records a handled image in the seen index, if there is one, so it is
+        not downloaded again from another submission or album.
+
+        Arguments:
+            image_url<string> -- Absolute URL of the image.
+        """
+        if self.seen_index:
+            self.seen_index.add(self.image_key(image_url))
+
+    def mark_seen(self, submission):
+        """
+        Records a handled submission in the seen index, if there is one, so it
+        is not downloaded again after a restart.
+
+        Arguments:
+            submission -- Single subreddit submission.
+        """
+        if self.seen_index:
+            for key in self.seen_keys(submission):
+                self.seen_index.add(key)
+
+    def download(self, url):
+        """
+        Downloads the wallpaper at the given URL. Runs on a download pool
+        thread. Images with a poor size are abandoned as soon as their header
+        has been read.
+
+        Arguments:
+            url<string> -- Absolute URL of the image.
+
+        Returns:
+            The downloaded wallpaper.
+        """
+        return Wallpaper(url,
+            self.http_client,
+            self.size_problem,
+            self.image_processor,
+            self.resolver,
+            self.thumbnail_specs,
+            self.stream_path,
+            self.byte_budget)
+
+    def handle_submission(self, submission, wallpaper, keywords=None,
+            on_stored=None):
+        """
+        Handle an individual downloaded submission. Extract relevant information
+        and possibly save the wallpaper.
+
+        Arguments:
+            submission           -- Single subreddit submission.
+            wallpaper<Wallpaper> -- Wallpaper downloaded for the submission.
+            keywords<[string]>   -- Optional keywords already made from the
+                                    submission's title.
+            on_stored<function>  -- Optional function called with True or
+                                    False once a queued database write has
+                                    been committed or has failed.
+
+        Returns:
+            True if the submission is done with, else False. None if its
+            record was queued and on_stored will be called.
+        """
+        result = True
+
+        if wallpaper != None and not self.good_size(wallpaper):
+            self.count_rejection(self.size_problem(wallpaper.image_width,
+                wallpaper.image_height))
+        elif wallpaper != None:
+            if self.is_known_content(wallpaper):
+                self.count_rejection('identical')
+                print 'Skipped %s. Identical to a stored image.' % \
+                    submission.url
+                return result
+
+            duplicate = self.find_duplicate(wallpaper)
+
+            if duplicate:
+                self.count_rejection('duplicate')
+                print 'Skipped %s. Near duplicate of %s.' % (submission.url,
+                    duplicate)
+                return result
+
+            if keywords is None:
+                keywords = self.make_keywords(submission.title)
+
+            keywords = list(keywords)
             source = submission.permalink
 
             if submission.over_18:
                 keywords.append('nsfw')
 
-            self.store(wallpaper, keywords, source)
+            result = self.store(wallpaper, keywords, source, on_stored)
+
+        return result
+
+    def is_known_content(self, wallpaper):
+        """
+        Checks the seen index, if there is one, for an already stored image
+        with exactly the same bytes as the given one.
+
+        Arguments:
+            wallpaper<Wallpaper> -- Wallpaper to look up.
+
+        Returns:
+            True if the same bytes have been stored, else False.
+        """
+        result = False
 
-    def store(self, wallpaper, keywords, source):
+        if self.seen_index and wallpaper.content_hash:
+            result = self.seen_index.has_item('content:%s' %
+                wallpaper.content_hash)
+
+        return result
+
+    def find_duplicate(self, wallpaper):
         """
-        Stores the image and thumbnail to the filesystem, and the metadata to
-        the database.
+        Looks for an already stored wallpaper that is perceptually the same
+        image as the given one.
+
+        Arguments:
+            wallpaper<Wallpaper> -- Wallpaper to look up.
+
+        Returns:
+            Name of the stored wallpaper if one was found, else None.
+        """
+        result = None
+
+        if self.duplicate_index and wallpaper.phash is not None:
+            match = self.duplicate_index.find(wallpaper.phash)
+
+            if match:
+                result = match[0]
+
+        return result
+
+    def store(self, wallpaper, keywords, source, on_stored=None):
+        """
+        Stores the image and its thumbnails to the filesystem, and queues the
+        metadata to be written to the database. The metadata is queued even if
+        the files already exist, as a file left by an earlier crawl does not
+        mean its record was committed; a record already stored is skipped by
+        the database. Once the write is committed the wallpaper is added to the
+        duplicate and seen indexes. If the write fails, the files written by
+        this call are rolled back instead.
 
         Arguments:
             wallpaper<Wallpaper> -- The wallpaper to save.
             keywords<[string]>   -- List of keywords describing the image.
             source<string>       -- Absolute URL to the image source.
+            on_stored<function>  -- Optional function called with True or
+                                    False once the database write has been
+                                    committed or has failed.
+
+        Returns:
+            True if the metadata was queued, else False. None if it was queued
+            and on_stored will be called.
         """
+        result = False
+        written_image = None
+        written_thumbnails = []
+
         try:
-            wrote_image = self.write_blob(wallpaper.image,
-                self.wallpaper_path,
-                wallpaper.image_name)
-            wrote_thumbnail = self.write_blob(wallpaper.thumbnail,
-                self.thumbnail_path,
-                wallpaper.image_name)
-
-            if wrote_image and wrote_thumbnail:
-                self.db_connector.store(self.wallpaper_path,
-                    wallpaper.image_name,
-                    keywords,
-                    source,
-                    (wallpaper.image_width, wallpaper.image_height))
+            write_start = time()
+
+            if wallpaper.image_path:
+                wrote_image = self.write_blob_file(wallpaper.image_path,
+                    self.wallpaper_path,
+                    wallpaper.image_name)
+            else:
+                wrote_image = self.write_blob(wallpaper.image,
+                    self.wallpaper_path,
+                    wallpaper.image_name)
+
+            if wrote_image:
+                written_image = wallpaper.image_name
+
+            for thumbnail in wallpaper.thumbnails:
+                if self.write_blob(thumbnail['blob'],
+                        self.thumbnail_path,
+                        thumbnail['file'],
+                        self.thumbnail_writer):
+                    written_thumbnails.append(thumbnail['file'])
+
+            self.metrics.observe('stage_seconds', time() - write_start,
+                self.labels('file_write'))
+
+            thumbnails = [(t['name'], t['file'], t['width'], t['height'],
+                t['format']) for t in wallpaper.thumbnails]
+
+            self.db_connector.store(self.wallpaper_path,
+                wallpaper.image_name,
+                keywords,
+                source,
+                (wallpaper.image_width, wallpaper.image_height),
+                wallpaper.phash,
+                thumbnails,
+                partial(self.store_failed, written_image, written_thumbnails,
+                    on_stored),
+                partial(self.store_succeeded, wallpaper.image_name,
+                    wallpaper.phash, wallpaper.content_hash, on_stored))
+
+            result = None if on_stored else True
         except Exception as error:
+            self.metrics.increment('errors_total', self.labels('file_write'))
             print 'Unable to save wallpaper. Details: %s' % error
-            self.rollback_write(self.wallpaper_path, wallpaper.name)
-            self.rollback_write(self.thumbnail_path, wallpaper.name)
+            self.rollback_files(written_image, written_thumbnails)
 
-    def write_blob(self, blob, path, name):
+        return result
+
+    def store_succeeded(self, name, phash, content_hash, on_stored=None):
+        """
+        Adds a wallpaper whose record has been committed to the duplicate and
+        seen indexes. Called on the database writer thread.
+
+        Arguments:
+            name<string>         -- Image name.
+            phash<int>           -- Perceptual hash of the image, or None.
+            content_hash<string> -- MD5 of the image bytes, or None.
+            on_stored<function>  -- Optional function to call with True.
+        """
+        if self.duplicate_index and phash is not None:
+            self.duplicate_index.add(phash, name)
+
+        if self.seen_index and content_hash:
+            self.seen_index.add('content:%s' % content_hash)
+
+        self.metrics.increment('stored_total', self.labels(None))
+
+        if on_stored:
+            on_stored(True)
+
+    def store_failed(self, name, thumbnail_files, on_stored=None):
+        """
+        Rolls back the files of a wallpaper whose record could not be
+        committed. Called on the database writer thread.
+
+        Arguments:
+            name<string>              -- Image name, or None if the image file
+                                         was not written by this crawl.
+            thumbnail_files<[string]> -- File names of the thumbnails written
+                                         by this crawl.
+            on_stored<function>       -- Optional function to call with False.
+        """
+        self.rollback_files(name, thumbnail_files)
+
+        if on_stored:
+            on_stored(False)
+
+    def rollback_files(self, name, thumbnail_files=()):
+        """
+        Rollback the writes of an image and its thumbnails.
+
+        Arguments:
+            name<string>              -- Image name, or None to leave the
+                                         image file alone.
+            thumbnail_files<[string]> -- File names of the image's thumbnails.
+        """
+        if name:
+            self.rollback_write(self.wallpaper_path, name)
+
+        for thumbnail_file in thumbnail_files:
+            self.rollback_write(self.thumbnail_path, thumbnail_file,
+                self.thumbnail_writer)
+
+    def write_blob(self, blob, path, name, writer=None):
         """
         Write the image blob and a thumbnail to the filesystem.
 
         Arguments:
-            blob<string> -- Image blob.
-            path<string> -- Absolute filesystem path to write to.
-            name<string> -- Image name.
+            blob<string>       -- Image blob.
+            path<string>       -- Absolute filesystem path to write to.
+            name<string>       -- Image name.
+            writer<FileWriter> -- Optional writer or pack store to write with.
+                                  Defaults to the file writer.
+
+        Returns:
+            True if image was successfully written, else False.
+        """
+        result = False
+
+        writer = writer if writer else self.file_writer
+
+        if writer.write(blob, path, name):
+            print 'Wrote %s to %s.' % (name, path)
+            result = True
+        else:
+            print '%s already exists at %s. Skipping write.' % (name, path)
+
+        return result
+
+    def write_blob_file(self, source_path, path, name):
+        """
+        Write an image that was streamed to a temporary file to the
+        filesystem.
+
+        Arguments:
+            source_path<string> -- Filesystem path of the streamed image.
+            path<string>        -- Absolute filesystem path to write to.
+            name<string>        -- Image name.
 
         Returns:
             True if image was successfully written, else False.
         """
         result = False
 
-        writer = FileWriter()
-        if not writer.file_exists(path + name):
-            writer.write(blob, path, name)
+        if self.file_writer.write_file(source_path, path, name):
             print 'Wrote %s to %s.' % (name, path)
             result = True
         else:
@@ -172,22 +851,24 @@ class SubredditWallpaperCrawler(object):
 
         return result
 
-    def rollback_write(self, path, name):
+    def rollback_write(self, path, name, writer=None):
         """
         Rollback a filesystem write. If the file does not exist, fail silently.
 
         Arguments:
-            path<string> -- Absolute filesystem path to file.
-            name<string> -- Image name.
+            path<string>       -- Absolute filesystem path to file.
+            name<string>       -- Image name.
+            writer<FileWriter> -- Optional writer or pack store the file was
+                                  written with. Defaults to the file writer.
 
         Returns:
             True if image was successfully removed, else False.
         """
         result = False
 
-        writer = FileWriter()
-        if writer.file_exists(path + name):
-            writer.unwrite(path, name)
+        writer = writer if writer else self.file_writer
+
+        if writer.unwrite(path, name):
             print 'Rolled back write of %s at %s.' % (name, path)
             result = True
 
@@ -203,17 +884,7 @@ class SubredditWallpaperCrawler(object):
         Returns:
             List of strings, each string being a keyword or phrase.
         """
-        # TODO:
-        #   - Better way to get words, i.e. words with hyphens and apostrophes
-        #   - Get bigrams and trigrams, i.e. phrases
-        result = []
-
-        all_words = re.sub('\W', ' ', text.lower()).split()
-        meaningless = set(stopwords.words('english'))
-        meaningful = [w for w in all_words if w not in meaningless]
-        result = list(set(meaningful))
-
-        return result
+        return self.keyword_extractor.extract(text)
 
     def good_size(self, wallpaper):
         """
@@ -226,17 +897,33 @@ class SubredditWallpaperCrawler(object):
         Returns:
             True if image meets minimum width and height requirements.
         """
-        result = False
+        problem = self.size_problem(wallpaper.image_width,
+            wallpaper.image_height)
 
-        width, height = wallpaper.image_width, wallpaper.image_height
-        ratio = float(width) / height
+        return problem == None
 
-        if width >= self.MIN_IMAGE_WIDTH and height >= self.MIN_IMAGE_HEIGHT:
-            result = True
-        if ratio < 1.0:
-            result = False
-        if ratio > 2.0:
-            result = False
+    def size_problem(self, width, height):
+        """
+        Finds what, if anything, is wrong with the given image dimensions. An
+        image must meet the minimum width and height, and its width must be
+        between one and two times its height.
+
+        Arguments:
+            width<int>  -- Pixel width of the image.
+            height<int> -- Pixel height of the image.
+
+        Returns:
+            'too small' or 'bad ratio' if the size is poor, else None.
+        """
+        result = None
+
+        if width < self.MIN_IMAGE_WIDTH or height < self.MIN_IMAGE_HEIGHT:
+            result = 'too small'
+        else:
+            ratio = float(width) / height
+
+            if ratio < 1.0 or ratio > 2.0:
+                result = 'bad ratio'
 
         return result
 
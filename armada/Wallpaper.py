@@ -6,57 +6,143 @@
 # Imports
 # ------------------------------------------------------------------------------
 
+import errno
 import hashlib
-from PIL import Image
-import re
-import StringIO
-import urllib2
+import os
+from PIL import ImageFile
+import tempfile
+from time import time
+
+from HttpClient import HttpClient
+from ImageProcessor import process_image
+from ImgurResolver import ImgurResolver, is_direct_image
+
+
+# ------------------------------------------------------------------------------
+# Helper functions
+# ------------------------------------------------------------------------------
+
+def make_name_stem(url, length=10):
+    """
+    Creates the hashed part of an image's name from its source URL. The full
+    image name adds an extension once the image format is known.
+
+    Arguments:
+        url<string> -- Absolute URL to image.
+        length<int> -- Number of hash characters to keep.
+
+    Returns:
+        Hashed name without extension.
+    """
+    return hashlib.md5(url).hexdigest()[:length]
 
 
 # ------------------------------------------------------------------------------
-# Class
+# Classes
 # ------------------------------------------------------------------------------
 
+class ImageRejected(Exception):
+    """
+    Raised when an image is turned down before it has been fully downloaded.
+    """
+
+    def __init__(self, reason):
+        """
+        Arguments:
+            reason<string> -- Why the image was turned down.
+        """
+        Exception.__init__(self, 'Image rejected: %s' % reason)
+        self.reason = reason
+
+
 class Wallpaper(object):
     """
     A wallpaper, its thumbnail, and image metadata.
     """
 
-    def __init__(self, image_url):
+    def __init__(self, image_url, http_client=None, size_check=None,
+            processor=None, resolver=None, thumbnail_specs=None,
+            stream_path=None, byte_budget=None):
         """
         Creates a wallpaper from the given image URL. Throws an exception if the
         image data could not be extracted, or the object could not otherwise be
         created.
 
         Arguments:
-            image_url<string> -- Absolute URL to image.
+            image_url<string>         -- Absolute URL to image.
+            http_client<HttpClient>   -- Optional shared HTTP client.
+                                         Defaults to a private client.
+            size_check<function>      -- Optional check called as
+                                         size_check(width, height) as soon as
+                                         the image header has been read.
+                                         Returns a reason string to abandon
+                                         the download, or None to continue.
+            processor<ImageProcessor> -- Optional processor to decode and
+                                         thumbnail on. Defaults to processing
+                                         inline.
+            resolver<ImgurResolver>   -- Optional shared resolver used when
+                                         the URL is a page rather than an
+                                         image. Defaults to a private
+                                         resolver with no cache file.
+            thumbnail_specs<[tuple]>  -- Optional (name, width, height,
+                                         format, quality) tuples of the
+                                         thumbnails to make. Defaults to a
+                                         single 450x300 grid thumbnail in the
+                                         source format.
+            stream_path<string>       -- Optional directory to stream the
+                                         image into rather than holding it in
+                                         memory. Best on the same filesystem
+                                         as the wallpapers, so storing the
+                                         image is a hard link, not a copy.
+            byte_budget<ByteBudget>   -- Optional budget the image's bytes
+                                         are reserved from until release().
         """
         self.NAME_LENGTH = 10
-        self.supported_extensions = ['jpg', 'png']
+        self.CHUNK_SIZE = 16384
+        self.EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
 
         self.url = image_url
+        self.http_client = http_client if http_client else HttpClient()
+        self.size_check = size_check
+        self.processor = processor
+        self.resolver = resolver
+        self.stream_path = stream_path
+        self.byte_budget = byte_budget
+        self.reserved = 0
 
         self.image = None
+        self.image_path = None
+        self.content_hash = None
+        self.bytes_read = 0
+        self.timings = {}
         self.image_width = 0
         self.image_height = 0
         self.image_format = None
         self.image_name = None
+        self.phash = None
 
-        self.thumbnail_width = 450
-        self.thumbnail_height = 300
-        self.thumbnail = None
+        self.thumbnail_specs = thumbnail_specs if thumbnail_specs else \
+            [('grid', 450, 300, None, None)]
+        self.thumbnails = []
 
         self.create_image()
-        self.create_thumbnail()
 
     def create_image(self):
         """
-        Creates the full image and sets its metadata.
+        Creates the full image and its thumbnails, and sets their metadata.
+        Anything held for the image is released if this fails. The seconds
+        spent in each stage are kept in timings.
         """
-        self.get_image()
-        self.set_image_size()
-        self.set_image_format()
-        self.set_image_name()
+        try:
+            start = time()
+            self.get_image()
+            self.timings['download'] = time() - start
+
+            self.process_image()
+            self.set_image_name()
+        except Exception:
+            self.release()
+            raise
 
     def get_image(self, image_url=None, recurse=True):
         """
@@ -73,75 +159,163 @@ class Wallpaper(object):
         """
         url = self.url if not image_url else image_url
 
-        extension = url[-3:]
+        if is_direct_image(url):
+            response = self.http_client.open(url)
+
+            try:
+                if response.status != 200:
+                    raise Exception('HTTP %d from %s.' % (response.status,
+                        url))
 
-        if extension in self.supported_extensions:
-            self.image = urllib2.urlopen(url).read()
+                self.reserve(int(response.headers.get('content-length', 0)))
+                self.read_image(response)
+            finally:
+                response.close()
         elif recurse:
             hopeful_url = self.find_image_url(url)
             self.get_image(hopeful_url, False)
 
-        if not self.image:
+        if not self.image and not self.image_path:
             raise Exception('Unable to create wallpaper image from URL.')
 
-    def create_thumbnail(self):
-        """
-        Creates the thumbnail image and sets its metadata properties.
+    def read_image(self, response):
         """
-        self.make_thumbnail()
+        Reads the image from an open response in chunks, hashing it as it
+        goes. The image header is parsed as soon as enough bytes have arrived,
+        and the size check is applied before the rest of the image is read.
 
-    def make_thumbnail(self):
-        """
-        Create a thumbnail image from the full sized image.
+        The image is written to a temporary file under the stream path if
+        there is one, else kept in memory as a blob.
+
+        Arguments:
+            response -- Open response for an image URL.
         """
-        size = (self.thumbnail_width, self.thumbnail_height)
-        image_data = self.open_image(self.image)
-        image_data.thumbnail(size, Image.ANTIALIAS)
+        parser = ImageFile.Parser() if self.size_check else None
+        content_hash = hashlib.md5()
+        bytes_read = 0
+        chunks = []
+        handler = None
+
+        if self.stream_path:
+            descriptor, self.image_path = tempfile.mkstemp(suffix='.part',
+                dir=self.stream_path)
+            handler = os.fdopen(descriptor, 'wb')
+
+        try:
+            while True:
+                chunk = response.read(self.CHUNK_SIZE)
+
+                if not chunk:
+                    break
 
-        out_buffer = StringIO.StringIO()
-        image_data.save(out_buffer, image_data.format)
-        self.thumbnail = out_buffer.buflist[0]
+                content_hash.update(chunk)
+                bytes_read += len(chunk)
 
-    def open_image(self, image_blob):
+                if bytes_read > self.reserved:
+                    self.reserve(bytes_read - self.reserved, False)
+
+                if handler:
+                    handler.write(chunk)
+                else:
+                    chunks.append(chunk)
+
+                if parser:
+                    parser.feed(chunk)
+
+                    if parser.image:
+                        width, height = parser.image.size
+                        reason = self.size_check(width, height)
+                        parser = None
+
+                        if reason:
+                            raise ImageRejected(reason)
+        finally:
+            if handler:
+                handler.close()
+
+        self.content_hash = content_hash.hexdigest()
+        self.bytes_read = bytes_read
+
+        if not handler:
+            self.image = ''.join(chunks)
+
+    def reserve(self, size, wait=True):
         """
-        Opens the Image file open for the given blob.
+        Takes bytes for the image from the byte budget, if there is one.
 
         Arguments:
-            image_blob<string> -- Image blob.
+            size<int>  -- Bytes to take.
+            wait<bool> -- If True, wait until the bytes fit in the budget.
+        """
+        if not self.byte_budget or size < 1:
+            return
 
-        Returns:
-            Opened Image file for the blob.
+        if wait:
+            self.byte_budget.reserve(size)
+        else:
+            self.byte_budget.add(size)
+
+        self.reserved += size
+
+    def release(self):
+        """
+        Lets go of the image once it has been stored or turned down. Removes
+        any temporary file, drops the image and thumbnail blobs, and hands the
+        image's bytes back to the byte budget. Safe to call more than once.
         """
-        data_buffer = StringIO.StringIO()
-        data_buffer.write(image_blob)
-        data_buffer.seek(0)
-        image_data = Image.open(data_buffer)
+        if self.image_path:
+            try:
+                os.remove(self.image_path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+            self.image_path = None
 
-        return image_data
+        self.image = None
+        self.thumbnails = []
+
+        if self.byte_budget and self.reserved:
+            self.byte_budget.release(self.reserved)
+            self.reserved = 0
 
-    def set_image_format(self):
+    def process_image(self):
         """
-        Sets the image format.
+        Decodes the image once, setting its size, format, and perceptual hash
+        and creating every thumbnail. Runs on the image processor when one was
+        given. A streamed image is decoded from its file, so only the path is
+        sent to the processor.
         """
-        image_data = self.open_image(self.image)
-        self.image_format = image_data.format
+        if self.processor:
+            processed = self.processor.process(self.image,
+                self.thumbnail_specs, self.image_path)
+        else:
+            processed = process_image(self.image, self.thumbnail_specs,
+                self.image_path)
+
+        self.image_width = processed['width']
+        self.image_height = processed['height']
+        self.image_format = processed['format']
+        self.phash = processed['phash']
+        self.thumbnails = processed['thumbnails']
+        self.timings['decode'] = processed['decode_seconds']
+        self.timings['thumbnail'] = processed['thumbnail_seconds']
 
     def set_image_name(self):
         """
-        Creates a unique name for this image based on its source URL.
+        Creates a unique name for this image based on its source URL, and a
+        file name for each thumbnail made of the image name and the thumbnail
+        size name, such as 3fa9c01d2e-grid.webp.
         """
         extension = '.jpg' if self.image_format == 'JPEG' else '.png'
-        name = hashlib.md5(self.url).hexdigest()[:self.NAME_LENGTH]
-        name += extension
-        self.image_name = name
+        name = make_name_stem(self.url, self.NAME_LENGTH)
+        self.image_name = name + extension
 
-    def set_image_size(self):
-        """
-        Sets the dimensions of the full image.
-        """
-        image_data = self.open_image(self.image)
-        self.image_width = image_data.size[0]
-        self.image_height = image_data.size[1]
+        for thumbnail in self.thumbnails:
+            extension = self.EXTENSIONS.get(thumbnail['format'],
+                '.' + thumbnail['format'].lower())
+            thumbnail['file'] = '%s-%s%s' % (name, thumbnail['name'],
+                extension)
 
     def find_image_url(self, url):
         """
@@ -155,26 +329,12 @@ class Wallpaper(object):
         """
         result = None
 
-        if 'imgur.com' in url:
-            result = self.get_imgur_image_url(url)
+        if not self.resolver:
+            self.resolver = ImgurResolver(self.http_client)
 
-        return result
-
-    def get_imgur_image_url(self, url):
-        """
-        Look through an imgur page and try to find an image URL.
-
-        Arguments:
-            url<string> -- URL of imgur HTML page.
-
-        Returns:
-            The URL of an image if found, else None.
-        """
-        result = None
+        image_urls = self.resolver.resolve(url)
 
-        page_source = urllib2.urlopen(url).read()
-        image_re = '(?P<link>i\.imgur\.com/\w+\.\w+)"'
-        matches = re.search(image_re, page_source)
-        image_url = 'http://' + matches.group('link')
+        if image_urls:
+            result = image_urls[0]
 
         return result
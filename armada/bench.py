@@ -0,0 +1,385 @@
+# ==============================================================================
+# bench.py
+#
+# Runs a SubredditWallpaperCrawler end to end without Reddit, imgur, or MySQL,
+# and reports its throughput. Submissions come from a stand-in subreddit, images
+# from a local HTTP server, and metadata goes to an in-memory database. Save
+# the results of two runs and compare them to prove a pipeline change.
+#
+#     python bench.py --cycles 5 --output before.json
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+from PIL import Image
+import random
+import resource
+import shutil
+from SocketServer import ThreadingMixIn
+import StringIO
+import tempfile
+from threading import Lock, Thread
+from time import sleep, time
+
+from ByteBudget import ByteBudget
+from DatabaseWriter import DatabaseWriter
+from DownloadPool import DownloadPool
+from HttpClient import HttpClient
+from ImageProcessor import ImageProcessor
+from Metrics import Metrics
+from SubredditWallpaperCrawler import SubredditWallpaperCrawler
+
+
+# ------------------------------------------------------------------------------
+# Stand-ins
+# ------------------------------------------------------------------------------
+
+class FakeSubmission(object):
+    """
+    A synthetic submission with the attributes the crawler reads.
+    """
+
+    def __init__(self, submission_id, url, title, over_18=False):
+        self.id = submission_id
+        self.url = url
+        self.title = title
+        self.permalink = 'https://www.reddit.com/r/bench/comments/%s/' % \
+            submission_id
+        self.over_18 = over_18
+
+
+class FakeSubreddit(object):
+    """
+    Stands in for a praw subreddit. Every listing is a fresh page of new
+    submissions pointing at images on the local image server.
+    """
+
+    def __init__(self, base_url, corpus, seed=0):
+        """
+        Arguments:
+            base_url<string>  -- URL of the local image server.
+            corpus<[string]>  -- File names the image server serves.
+            seed<int>         -- Seed for the synthetic titles.
+        """
+        self.WORDS = ['mountain', 'lake', 'sunset', 'forest', 'city', 'night',
+            'snow', 'river', 'desert', 'ocean', 'aurora', 'valley', 'misty',
+            'autumn', 'skyline', 'canyon', 'glacier', 'coast', 'storm', 'road']
+
+        self.base_url = base_url
+        self.corpus = corpus
+        self.random = random.Random(seed)
+        self.count = 0
+
+    def get_hot(self, limit=25):
+        """
+        Yields a page of new synthetic submissions.
+
+        Arguments:
+            limit<int> -- Number of submissions.
+        """
+        for i in range(limit):
+            self.count += 1
+            image = self.corpus[self.count % len(self.corpus)]
+            url = '%s/%d/%s' % (self.base_url, self.count, image)
+            title = ' '.join(self.random.sample(self.WORDS, 4))
+            over_18 = self.random.random() < 0.05
+
+            yield FakeSubmission('b%d' % self.count, url, title, over_18)
+
+
+class MemoryConnector(object):
+    """
+    Stands in for the MySQLConnector, keeping records in memory. An optional
+    delay per batch imitates the round trip to a real server.
+    """
+
+    def __init__(self, batch_delay=0.0):
+        """
+        Arguments:
+            batch_delay<float> -- Seconds each batch takes to store.
+        """
+        self.batch_delay = batch_delay
+        self.records = []
+        self.lock = Lock()
+
+    def check_record(self, path, name, keywords, source, size, phash=None,
+            thumbnails=None):
+        if not name or not keywords or not size:
+            raise Exception('Incomplete record for %s.' % name)
+
+    def store_batch(self, records):
+        sleep(self.batch_delay)
+
+        with self.lock:
+            self.records.extend(records)
+
+    def load_hashes(self):
+        return []
+
+    def load_keyword_counts(self):
+        return {}
+
+
+class RecordingMetrics(Metrics):
+    """
+    A metrics registry that also keeps every observed value, so exact
+    percentiles can be reported.
+    """
+
+    def __init__(self):
+        Metrics.__init__(self)
+        self.samples = {}
+
+    def observe(self, name, value, labels=None):
+        Metrics.observe(self, name, value, labels)
+        key = (labels or {}).get('stage', name)
+
+        with self.lock:
+            self.samples.setdefault(key, []).append(value)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# ------------------------------------------------------------------------------
+# Helper functions
+# ------------------------------------------------------------------------------
+
+def make_corpus(count, seed=0):
+    """
+    Generates JPEG and PNG images at common wallpaper resolutions. Noise keeps
+    the encoded sizes close to real photos. A few images are too small or
+    the wrong shape, so the rejection paths are exercised too.
+
+    Arguments:
+        count<int> -- Number of images.
+        seed<int>  -- Seed for choosing sizes and formats.
+
+    Returns:
+        Dictionary of file name to image blob.
+    """
+    sizes = [(1920, 1080), (2560, 1440), (1920, 1200), (3840, 2160),
+        (2560, 1600), (800, 600), (1080, 1920)]
+    chooser = random.Random(seed)
+    result = {}
+
+    for i in range(count):
+        width, height = chooser.choice(sizes)
+        image_format = chooser.choice(['JPEG', 'JPEG', 'JPEG', 'PNG'])
+
+        noise = Image.effect_noise((width / 4, height / 4), 64)
+        image = Image.merge('RGB', (noise, noise.rotate(90, expand=False),
+            Image.linear_gradient('L').resize(noise.size)))
+        image = image.resize((width, height), Image.BILINEAR)
+
+        out_buffer = StringIO.StringIO()
+        image.save(out_buffer, image_format, quality=90)
+        extension = 'jpg' if image_format == 'JPEG' else 'png'
+        result['%03d.%s' % (i, extension)] = out_buffer.getvalue()
+
+    return result
+
+def serve_corpus(corpus):
+    """
+    Serves the image corpus over keep-alive HTTP on a local port. The last
+    part of the request path picks the image.
+
+    Arguments:
+        corpus<{string: string}> -- File name to image blob.
+
+    Returns:
+        The running server.
+    """
+    class ImageHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            blob = corpus.get(self.path.rsplit('/', 1)[-1])
+
+            if blob is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(blob)))
+            self.end_headers()
+            self.wfile.write(blob)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    return server
+
+def percentiles(values):
+    """
+    Summarises a list of latencies.
+
+    Arguments:
+        values<[float]> -- Observed seconds.
+
+    Returns:
+        Dictionary of count, p50, p90, p99, and max, in milliseconds.
+    """
+    ordered = sorted(values)
+
+    def pick(share):
+        return round(ordered[min(len(ordered) - 1,
+            int(share * len(ordered)))] * 1000, 2)
+
+    return {
+        'count': len(ordered),
+        'p50_ms': pick(0.5),
+        'p90_ms': pick(0.9),
+        'p99_ms': pick(0.99),
+        'max_ms': round(ordered[-1] * 1000, 2)
+    }
+
+def peak_rss():
+    """
+    Finds the peak resident memory of this process and, separately, of its
+    largest finished child, such as an image worker.
+
+    Returns:
+        Tuple of the two peaks in megabytes.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return round(own / 1024.0, 1), round(children / 1024.0, 1)
+
+def get_args():
+    """
+    Parses the command line.
+
+    Returns:
+        Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description='Offline ingest benchmark.')
+    parser.add_argument('--cycles', type=int, default=3,
+        help='crawl cycles to run')
+    parser.add_argument('--items', type=int, default=50,
+        help='submissions listed per cycle')
+    parser.add_argument('--corpus', type=int, default=24,
+        help='distinct images served')
+    parser.add_argument('--workers', type=int, default=8,
+        help='download pool workers')
+    parser.add_argument('--processes', type=int, default=None,
+        help='image worker processes, 0 for inline')
+    parser.add_argument('--stream', action='store_true',
+        help='stream downloads to temp files')
+    parser.add_argument('--byte-budget', type=int, default=0,
+        help='max image bytes in flight, 0 for no limit')
+    parser.add_argument('--db-delay', type=float, default=0.005,
+        help='seconds each database batch takes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+        help='file to save the results to as JSON')
+
+    return parser.parse_args()
+
+def run(args):
+    """
+    Runs the benchmark.
+
+    Arguments:
+        args -- Parsed arguments.
+
+    Returns:
+        Dictionary of results.
+    """
+    image_processor = ImageProcessor(args.processes)
+
+    print 'Generating %d images...' % args.corpus
+    corpus = make_corpus(args.corpus, args.seed)
+    server = serve_corpus(corpus)
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+
+    work_path = tempfile.mkdtemp(prefix='cutter-bench-')
+    metrics = RecordingMetrics()
+    connector = MemoryConnector(args.db_delay)
+    db_writer = DatabaseWriter(connector, metrics=metrics)
+    byte_budget = ByteBudget(args.byte_budget) if args.byte_budget else None
+
+    crawler = SubredditWallpaperCrawler('bench',
+        db_writer,
+        work_path + '/images/',
+        work_path + '/thumbnails/',
+        args.items,
+        cache_size=args.items * args.cycles,
+        download_pool=DownloadPool(args.workers),
+        image_processor=image_processor,
+        http_client=HttpClient(),
+        stream_path=work_path + '/incoming/' if args.stream else None,
+        byte_budget=byte_budget,
+        metrics=metrics,
+        subreddit=FakeSubreddit(base_url, sorted(corpus), args.seed))
+
+    try:
+        start = time()
+
+        for i in range(args.cycles):
+            crawler.crawl()
+
+        db_writer.close()
+        elapsed = time() - start
+    finally:
+        server.shutdown()
+        image_processor.close()
+        shutil.rmtree(work_path, True)
+
+    submissions = args.items * args.cycles
+    downloaded = sum(metrics.counters.get('downloaded_bytes_total',
+        {}).values())
+    rejected = {}
+
+    for key, count in metrics.counters.get('rejected_total', {}).items():
+        rejected[dict(key)['reason']] = count
+
+    own_rss, child_rss = peak_rss()
+
+    return {
+        'settings': vars(args),
+        'seconds': round(elapsed, 3),
+        'submissions': submissions,
+        'stored': len(connector.records),
+        'rejected': rejected,
+        'submissions_per_second': round(submissions / elapsed, 2),
+        'stored_per_second': round(len(connector.records) / elapsed, 2),
+        'bytes_downloaded': downloaded,
+        'peak_rss_mb': own_rss,
+        'peak_child_rss_mb': child_rss,
+        'peak_bytes_in_flight': byte_budget.peak if byte_budget else None,
+        'stages': dict((stage, percentiles(values))
+            for stage, values in metrics.samples.items())
+    }
+
+
+# ------------------------------------------------------------------------------
+# Entry point
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = get_args()
+    results = run(args)
+
+    print json.dumps(results, indent=4, sort_keys=True)
+
+    if args.output:
+        handler = open(args.output, 'w')
+        json.dump(results, handler, indent=4, sort_keys=True)
+        handler.close()
+        print 'Saved results to %s.' % args.output
@@ -0,0 +1,50 @@
+# ==============================================================================
+# compact_pack.py
+#
+# Reclaims the space of deleted thumbnails in a pack store. Stop the crawlers
+# writing to the store before running this.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from sys import exit, argv
+
+from PackStore import PackStore
+
+
+# ------------------------------------------------------------------------------
+# Helper functions
+# ------------------------------------------------------------------------------
+
+def usage():
+    """
+    Prints the usage string.
+    """
+    print 'python compact_pack.py <pack_directory> [min_dead_ratio]'
+
+def check_args(argv):
+    """
+    Check the args are as expected, if not, print usage and exit.
+    """
+    if len(argv) not in (2, 3):
+        usage()
+        exit()
+
+
+# ------------------------------------------------------------------------------
+# Entry point
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    check_args(argv)
+
+    try:
+        min_dead_ratio = float(argv[2]) if len(argv) == 3 else 0.5
+        store = PackStore(argv[1])
+        reclaimed = store.compact(min_dead_ratio)
+        store.close()
+        print 'Reclaimed %d bytes in %s.' % (reclaimed, argv[1])
+    except Exception as error:
+        print 'Unable to compact %s. Details: %s' % (argv[1], error)
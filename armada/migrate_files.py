@@ -0,0 +1,123 @@
+# ==============================================================================
+# migrate_files.py
+#
+# Moves image files from a flat directory, as written by older versions of the
+# FileWriter, into the sharded layout. Safe to run again if interrupted, and
+# safe to run while crawlers are writing.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+import errno
+import os
+from PIL import Image
+from sys import exit, argv
+
+from FileWriter import FileWriter
+
+
+# ------------------------------------------------------------------------------
+# Helper functions
+# ------------------------------------------------------------------------------
+
+def usage():
+    """
+    Prints the usage string.
+    """
+    print 'python migrate_files.py <directory> [<directory> ...]'
+
+def check_args(argv):
+    """
+    Check the args are as expected, if not, print usage and exit.
+    """
+    if len(argv) < 2:
+        usage()
+        exit()
+
+def is_whole_image(path):
+    """
+    Checks if a file is a complete image. Files cut short by a crash during
+    an old style write fail this check.
+
+    Arguments:
+        path<string> -- Absolute path including filename.
+
+    Returns:
+        True if the image decodes to the end, else False.
+    """
+    result = False
+
+    try:
+        image = Image.open(path)
+        image.load()
+        result = True
+    except Exception:
+        pass
+
+    return result
+
+def migrate(path, writer):
+    """
+    Moves every file at the top of a directory into its shard. Temporary files
+    left by interrupted writes are removed. Broken images and names already
+    taken in their shard are left where they are and reported.
+
+    Arguments:
+        path<string>       -- Absolute filesystem path of a flat directory.
+        writer<FileWriter> -- Writer that decides the layout.
+
+    Returns:
+        Tuple of the number of files moved and the number left behind.
+    """
+    moved = 0
+    left = 0
+
+    for name in sorted(os.listdir(path)):
+        source = os.path.join(path, name)
+
+        if not os.path.isfile(source):
+            continue
+
+        if name.startswith('.') and name.endswith('.tmp'):
+            os.remove(source)
+            continue
+
+        if not is_whole_image(source):
+            print 'Left %s in place. Not a whole image.' % source
+            left += 1
+            continue
+
+        writer.make_directory(writer.shard_path(path, name))
+
+        try:
+            os.link(source, writer.locate(path, name))
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+            print 'Left %s in place. Already in its shard.' % source
+            left += 1
+            continue
+
+        os.remove(source)
+        moved += 1
+
+    return moved, left
+
+
+# ------------------------------------------------------------------------------
+# Entry point
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    check_args(argv)
+    writer = FileWriter()
+
+    for path in argv[1:]:
+        try:
+            moved, left = migrate(path, writer)
+            print 'Moved %d files in %s, left %d.' % (moved, path, left)
+        except Exception as error:
+            print 'Unable to migrate %s. Details: %s' % (path, error)
@@ -10,10 +10,25 @@
 # ------------------------------------------------------------------------------
 
 import json
+import signal
 from sys import exit, argv
 
 from Armada import Armada
+from BackfillCrawler import BackfillCrawler
+from ByteBudget import ByteBudget
+from DatabaseWriter import DatabaseWriter
+from DownloadPool import DownloadPool
+from HttpClient import HttpClient
+from ImageProcessor import check_thumbnail_specs, ImageProcessor
+from ImgurResolver import ImgurResolver
+from KeywordExtractor import KeywordExtractor
+from Metrics import Metrics
 from MySQLConnector import MySQLConnector
+from PackStore import PackStore
+from PerceptualIndex import PerceptualIndex
+from Profiler import Profiler
+from RateLimiter import RateLimiter
+from SeenIndex import SeenIndex
 from SubredditWallpaperCrawler import SubredditWallpaperCrawler
 
 
@@ -56,12 +71,14 @@ def get_settings(config_file):
 
     return result
 
-def make_armada(settings):
+def make_armada(settings, profiler, rate_limiter):
     """
     Create and return an Armada instance.
 
     Arguments:
-        settings -- JSON blob of all config settings.
+        settings     -- JSON blob of all config settings.
+        profiler     -- Profiler for on demand crawl profiles, or None.
+        rate_limiter -- Rate limiter shared by the crawlers, or None.
 
     Returns:
         An Armada instance created with the given settings.
@@ -70,13 +87,44 @@ def make_armada(settings):
 
     try:
         armada_settings = settings['armada']
-        result = Armada(pause=armada_settings['crawl_pause'])
+        result = Armada(pause=armada_settings['crawl_pause'],
+            workers=armada_settings.get('workers', 4),
+            profiler=profiler,
+            rate_limiter=rate_limiter)
     except Exception as error:
         print 'Unable to create Armada instance. Details:\n%s' % error
         exit()
 
     return result 
 
+def make_profiler(settings):
+    """
+    Create the profiler crawls can be profiled with on demand, if one is
+    configured.
+
+    Arguments:
+        settings -- JSON blob of all config settings.
+
+    Returns:
+        A profiler with the config settings, or None if not configured.
+    """
+    result = None
+
+    try:
+        profile_settings = settings.get('profiling', {})
+
+        if profile_settings.get('output_path'):
+            result = Profiler(profile_settings['output_path'],
+                profile_settings.get('cycles', 1),
+                profile_settings.get('mode', 'cprofile'),
+                profile_settings.get('control_path'),
+                profile_settings.get('sample_interval', 0.01))
+    except Exception as error:
+        print 'Unable to create profiler. Details:\n%s' % error
+        exit()
+
+    return result
+
 def make_db_connector(settings):
     """
     Create a database connector.
@@ -96,17 +144,372 @@ def make_db_connector(settings):
             db_settings['password'],
             db_settings['wallpaper_table'],
             db_settings['keyword_table'],
-            db_settings['host'])
+            db_settings['host'],
+            db_settings.get('pool_size', 4),
+            db_settings.get('idle_check', 60),
+            db_settings.get('thumbnail_table', 'Thumbnails'))
     except Exception as error:
         print 'Unable to create DB connector. Details:\n%s' % error
         exit()
 
     return result
 
-def setup_crawlers(settings, armada, db_connector):
+def make_metrics(settings):
+    """
+    Create the metrics registry shared by all crawlers, and start serving or
+    dumping it if configured.
+
+    Arguments:
+        settings -- JSON blob of all config settings.
+
+    Returns:
+        A metrics registry with the config settings.
+    """
+    result = None
+
+    try:
+        metric_settings = settings.get('metrics', {})
+        result = Metrics()
+
+        result.describe('crawl_seconds', 'Seconds taken by a crawl cycle.')
+        result.describe('stage_seconds',
+            'Seconds taken by each stage of handling a wallpaper.')
+        result.describe('submissions_total',
+            'Submissions listed, and those not seen before.')
+        result.describe('downloaded_bytes_total', 'Image bytes downloaded.')
+        result.describe('rejected_total', 'Images turned down, by reason.')
+        result.describe('stored_total', 'Wallpapers stored.')
+        result.describe('errors_total', 'Failures, by stage.')
+        result.describe('throttled_total',
+            'Requests refused or deferred because a host was throttling.')
+        result.describe('db_records_total',
+            'Wallpaper records written to or failed by the database.')
+
+        if metric_settings.get('port'):
+            result.serve(metric_settings['port'],
+                metric_settings.get('host', '127.0.0.1'))
+
+        if metric_settings.get('dump_path'):
+            result.dump_every(metric_settings['dump_path'],
+                metric_settings.get('dump_interval', 60))
+    except Exception as error:
+        print 'Unable to create metrics. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_db_writer(settings, db_connector, metrics):
+    """
+    Create the write-behind database writer shared by all crawlers.
+
+    Arguments:
+        settings                     -- JSON blob of all config settings.
+        db_connector<MySQLConnector> -- Database to write to.
+        metrics<Metrics>             -- Metrics registry to record to.
+
+    Returns:
+        A database writer with the config settings.
+    """
+    result = None
+
+    try:
+        writer_settings = settings.get('db_writer', {})
+        result = DatabaseWriter(db_connector,
+            writer_settings.get('batch_size', 50),
+            writer_settings.get('flush_interval', 5),
+            writer_settings.get('max_queued', 0),
+            metrics)
+    except Exception as error:
+        print 'Unable to create DB writer. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_download_pool(settings):
+    """
+    Create the download pool shared by all crawlers.
+
+    Arguments:
+        settings -- JSON blob of all config settings.
+
+    Returns:
+        A download pool with the config settings.
+    """
+    result = None
+
+    try:
+        download_settings = settings.get('downloads', {})
+        result = DownloadPool(download_settings.get('workers', 8),
+            download_settings.get('host_limit', 4))
+    except Exception as error:
+        print 'Unable to create download pool. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_byte_budget(settings):
+    """
+    Create the budget of image bytes held at once by all crawlers, if one is
+    configured.
+
+    Arguments:
+        settings -- JSON blob of all config settings.
+
+    Returns:
+        A byte budget with the config settings, or None if not configured.
+    """
+    result = None
+
+    try:
+        download_settings = settings.get('downloads', {})
+
+        if download_settings.get('byte_budget'):
+            result = ByteBudget(download_settings['byte_budget'])
+    except Exception as error:
+        print 'Unable to create byte budget. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_rate_limiter(settings):
+    """
+    Create the per host rate limiter shared by all crawlers, if one is
+    configured.
+
+    Arguments:
+        settings -- JSON blob of all config settings.
+
+    Returns:
+        A rate limiter with the config settings, or None if not configured.
+    """
+    result = None
+
+    try:
+        limit_settings = settings.get('rate_limits')
+
+        if limit_settings:
+            result = RateLimiter(limit_settings.get('rate', 2.0),
+                limit_settings.get('burst', 10),
+                limit_settings.get('max_wait', 30),
+                limit_settings.get('base_backoff', 5),
+                limit_settings.get('max_backoff', 900),
+                limit_settings.get('hosts'),
+                limit_settings.get('max_retries', 3))
+    except Exception as error:
+        print 'Unable to create rate limiter. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_http_client(settings, rate_limiter):
+    """
+    Create the keep-alive HTTP client shared by all crawlers.
+
+    Arguments:
+        settings                  -- JSON blob of all config settings.
+        rate_limiter<RateLimiter> -- Rate limiter requests wait their turn
+                                     with, or None.
+
+    Returns:
+        An HTTP client with the config settings.
+    """
+    result = None
+
+    try:
+        http_settings = settings.get('http', {})
+        result = HttpClient(http_settings.get('connect_timeout', 10),
+            http_settings.get('read_timeout', 30),
+            http_settings.get('max_size', 52428800),
+            http_settings.get('max_idle', 8),
+            rate_limiter=rate_limiter)
+    except Exception as error:
+        print 'Unable to create HTTP client. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_resolver(settings, http_client):
+    """
+    Create the resolver of submission URLs to image URLs shared by all
+    crawlers.
+
+    Arguments:
+        settings                -- JSON blob of all config settings.
+        http_client<HttpClient> -- Client to fetch pages with.
+
+    Returns:
+        A resolver with the config settings.
+    """
+    result = None
+
+    try:
+        resolver_settings = settings.get('resolver', {})
+        result = ImgurResolver(http_client,
+            resolver_settings.get('cache_path'),
+            resolver_settings.get('max_age', 86400),
+            resolver_settings.get('max_images', 20))
+    except Exception as error:
+        print 'Unable to create resolver. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_image_processor(settings):
+    """
+    Create the image processor shared by all crawlers. Must be called before
+    any threads are started.
+
+    Arguments:
+        settings -- JSON blob of all config settings.
+
+    Returns:
+        An image processor with the config settings.
+    """
+    result = None
+
+    try:
+        image_settings = settings.get('images', {})
+        result = ImageProcessor(image_settings.get('processes'),
+            image_settings.get('timeout', 300))
+    except Exception as error:
+        print 'Unable to create image processor. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_seen_index(settings):
+    """
+    Open the seen index shared by all crawlers, if one is configured.
+
+    Arguments:
+        settings -- JSON blob of all config settings.
+
+    Returns:
+        A seen index with the config settings, or None if not configured.
+    """
+    result = None
+
+    try:
+        if 'seen_index' in settings:
+            index_settings = settings['seen_index']
+            result = SeenIndex(index_settings['path'],
+                index_settings.get('capacity', 1000000),
+                index_settings.get('error_rate', 0.001))
+    except Exception as error:
+        print 'Unable to open seen index. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_duplicate_index(settings, db_connector):
+    """
+    Create the near duplicate index shared by all crawlers, loaded with the
+    perceptual hashes of every stored wallpaper.
+
+    Arguments:
+        settings                     -- JSON blob of all config settings.
+        db_connector<MySQLConnector> -- Database to load hashes from.
+
+    Returns:
+        A perceptual hash index with the config settings.
+    """
+    result = None
+
+    try:
+        duplicate_settings = settings.get('duplicates', {})
+        result = PerceptualIndex(duplicate_settings.get('max_distance', 4))
+
+        for name, phash in db_connector.load_hashes():
+            result.add(phash, name)
+    except Exception as error:
+        print 'Unable to create duplicate index. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_keyword_extractor(settings, db_connector):
+    """
+    Create the keyword extractor shared by all crawlers, primed with how often
+    each stored keyword is used.
+
+    Arguments:
+        settings                     -- JSON blob of all config settings.
+        db_connector<MySQLConnector> -- Database to load keyword counts from.
+
+    Returns:
+        A keyword extractor with the config settings.
+    """
+    result = None
+
+    try:
+        keyword_settings = settings.get('keywords', {})
+        result = KeywordExtractor(db_connector.load_keyword_counts(),
+            keyword_settings.get('min_phrase_count', 2))
+    except Exception as error:
+        print 'Unable to create keyword extractor. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_thumbnail_store(settings):
+    """
+    Open the thumbnail pack store shared by all crawlers, if one is configured.
+
+    Arguments:
+        settings -- JSON blob of all config settings.
+
+    Returns:
+        A pack store with the config settings, or None if not configured.
+    """
+    result = None
+
+    try:
+        if 'thumbnail_store' in settings:
+            store_settings = settings['thumbnail_store']
+            result = PackStore(store_settings['path'],
+                store_settings.get('segment_size', 268435456))
+    except Exception as error:
+        print 'Unable to open thumbnail store. Details:\n%s' % error
+        exit()
+
+    return result
+
+def make_thumbnail_specs(settings):
+    """
+    Read and check the thumbnail sizes to make of every wallpaper.
+
+    Arguments:
+        settings -- JSON blob of all config settings.
+
+    Returns:
+        List of (name, width, height, format, quality) tuples, or None to use
+        the default single thumbnail.
+    """
+    result = None
+
+    try:
+        if 'thumbnails' in settings:
+            result = [(t['name'],
+                t['width'],
+                t['height'],
+                t.get('format'),
+                t.get('quality')) for t in settings['thumbnails']]
+            check_thumbnail_specs(result)
+    except Exception as error:
+        print 'Unable to read thumbnail sizes. Details:\n%s' % error
+        exit()
+
+    return result
+
+def setup_crawlers(settings, armada, db_writer, download_pool,
+        image_processor, seen_index, duplicate_index, keyword_extractor,
+        http_client, resolver, thumbnail_store, thumbnail_specs, byte_budget,
+        metrics):
     """
     Create and setup crawlers specified by the settings file and set them up to
-    run with the Armada and DB connector provided.
+    run with the Armada, DB writer, download pool, image processor, seen index,
+    duplicate index, keyword extractor, HTTP client, resolver, thumbnail
+    store, thumbnail sizes, byte budget, and metrics registry provided.
 
     Arguments:
         settings -- JSON blob of all config settings.
@@ -125,12 +528,61 @@ def setup_crawlers(settings, armada, db_connector):
                 thumbnail_path = crawler['thumbnail_path']
 
                 sub_crawler = SubredditWallpaperCrawler(subreddit,
-                    db_connector,
+                    db_writer,
                     wallpaper_path,
                     thumbnail_path,
                     item_limit,
-                    cache_size)
-                armada.add_crawler(sub_crawler)
+                    cache_size,
+                    download_pool,
+                    image_processor,
+                    crawler.get('cache_ttl'),
+                    seen_index,
+                    duplicate_index,
+                    keyword_extractor,
+                    http_client,
+                    resolver,
+                    thumbnail_store,
+                    thumbnail_specs,
+                    crawler.get('stream_path'),
+                    byte_budget,
+                    metrics)
+                armada.add_crawler(sub_crawler,
+                    crawler.get('crawl_interval'),
+                    crawler.get('crawl_deadline'),
+                    crawler.get('min_interval'),
+                    crawler.get('max_interval'),
+                    crawler.get('target_fill', 0.5))
+            elif crawler_type == 'backfill':
+                backfill_pool = download_pool
+
+                if crawler.get('workers'):
+                    backfill_pool = DownloadPool(crawler['workers'],
+                        crawler.get('host_limit', crawler['workers']))
+
+                sub_crawler = BackfillCrawler(crawler['subreddit'],
+                    db_writer,
+                    crawler['wallpaper_path'],
+                    crawler['thumbnail_path'],
+                    crawler['checkpoint_path'],
+                    crawler.get('listing', 'new'),
+                    crawler.get('window', 'all'),
+                    crawler.get('pages_per_crawl', 4),
+                    crawler.get('item_limit', 50),
+                    download_pool=backfill_pool,
+                    image_processor=image_processor,
+                    seen_index=seen_index,
+                    duplicate_index=duplicate_index,
+                    keyword_extractor=keyword_extractor,
+                    http_client=http_client,
+                    resolver=resolver,
+                    thumbnail_store=thumbnail_store,
+                    thumbnail_specs=thumbnail_specs,
+                    stream_path=crawler.get('stream_path'),
+                    byte_budget=byte_budget,
+                    metrics=metrics)
+                armada.add_crawler(sub_crawler,
+                    crawler.get('crawl_interval'),
+                    crawler.get('crawl_deadline'))
             else:
                 print 'Unknown crawler type: %s. Continuing...' % crawler_type
     except Exception as error:
@@ -145,9 +597,60 @@ def setup_crawlers(settings, armada, db_connector):
 if __name__ == '__main__':
     check_args(argv)
     settings = get_settings(argv[1])
+    image_processor = make_image_processor(settings)
 
-    armada = make_armada(settings)
+    profiler = make_profiler(settings)
+    rate_limiter = make_rate_limiter(settings)
+    armada = make_armada(settings, profiler, rate_limiter)
     db_connector = make_db_connector(settings)
-    setup_crawlers(settings, armada, db_connector)
+    download_pool = make_download_pool(settings)
+    http_client = make_http_client(settings, rate_limiter)
+    resolver = make_resolver(settings, http_client)
+    thumbnail_store = make_thumbnail_store(settings)
+    thumbnail_specs = make_thumbnail_specs(settings)
+    byte_budget = make_byte_budget(settings)
+    metrics = make_metrics(settings)
+    seen_index = make_seen_index(settings)
+    duplicate_index = make_duplicate_index(settings, db_connector)
+    keyword_extractor = make_keyword_extractor(settings, db_connector)
+    db_writer = make_db_writer(settings, db_connector, metrics)
+    setup_crawlers(settings,
+        armada,
+        db_writer,
+        download_pool,
+        image_processor,
+        seen_index,
+        duplicate_index,
+        keyword_extractor,
+        http_client,
+        resolver,
+        thumbnail_store,
+        thumbnail_specs,
+        byte_budget,
+        metrics)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit())
+
+    if profiler:
+        signal.signal(signal.SIGUSR1,
+            lambda signum, frame: profiler.request())
+        signal.signal(signal.SIGUSR2,
+            lambda signum, frame: profiler.cancel())
+
+    try:
+        armada.run()
+    finally:
+        print 'Shutting down, writing queued wallpapers to database.'
+        db_writer.close()
+        resolver.flush()
+
+        if seen_index:
+            seen_index.close()
+
+        if thumbnail_store:
+            thumbnail_store.close()
+
+        metrics.close()
 
-    armada.run()
+        if settings.get('metrics', {}).get('dump_path'):
+            metrics.dump(settings['metrics']['dump_path'])
@@ -0,0 +1,237 @@
+# ==============================================================================
+# test_backfill_crawler.py
+#
+# Tests that BackfillCrawler resumes a page cut short by the crawl deadline
+# without losing submissions. Images come from a local server and records go
+# to an in-memory database. Run from the armada directory:
+#
+#     python -m unittest discover tests
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from PIL import Image
+import shutil
+import StringIO
+import tempfile
+from threading import Thread
+from time import sleep, time
+import unittest
+
+from BackfillCrawler import BackfillCrawler
+from bench import FakeSubmission, MemoryConnector, ThreadingHTTPServer
+from DatabaseWriter import DatabaseWriter
+from DownloadPool import DownloadPool
+from SeenIndex import SeenIndex
+
+
+# ------------------------------------------------------------------------------
+# Stand-ins
+# ------------------------------------------------------------------------------
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """
+    Serves the server's images by the last part of the request path. The
+    server's slow image takes slow_seconds to serve.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        name = self.path.rsplit('/', 1)[-1]
+        blob = self.server.images.get(name)
+
+        if blob is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if name == self.server.slow_image:
+            sleep(self.server.slow_seconds)
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(blob)))
+        self.end_headers()
+        self.wfile.write(blob)
+
+    def log_message(self, *args):
+        pass
+
+
+class FailingConnector(MemoryConnector):
+    """
+    An in-memory database that fails every write while failing is set.
+    """
+
+    def __init__(self):
+        MemoryConnector.__init__(self)
+        self.failing = False
+
+    def store_batch(self, records):
+        if self.failing:
+            raise Exception('Database unavailable.')
+
+        MemoryConnector.store_batch(self, records)
+
+
+class PagedSubreddit(object):
+    """
+    Stands in for a praw subreddit with a fixed new listing, paged by the
+    fullname of the last submission seen.
+    """
+
+    def __init__(self, submissions):
+        """
+        Arguments:
+            submissions<list> -- Submissions of the listing, newest first.
+        """
+        self.submissions = submissions
+
+    def get_new(self, limit=25, params=None):
+        """
+        Gets the page of the listing after params['after'], if given.
+
+        Arguments:
+            limit<int>    -- Submissions per page.
+            params<dict>  -- Optional query parameters.
+        """
+        after = (params or {}).get('after')
+        start = 0
+
+        if after:
+            ids = ['t3_%s' % s.id for s in self.submissions]
+            start = ids.index(after) + 1
+
+        return self.submissions[start:start + limit]
+
+
+# ------------------------------------------------------------------------------
+# Helper functions
+# ------------------------------------------------------------------------------
+
+def make_images(count):
+    """
+    Generates distinct noise images large enough to be kept as wallpapers.
+
+    Arguments:
+        count<int> -- Number of images.
+
+    Returns:
+        Dictionary of file name to JPEG blob.
+    """
+    result = {}
+
+    for i in range(count):
+        noise = Image.effect_noise((320, 200), 64)
+        image = Image.merge('RGB', (noise, noise.rotate(90),
+            Image.linear_gradient('L').resize(noise.size)))
+        image = image.resize((1280, 800), Image.BILINEAR)
+
+        out_buffer = StringIO.StringIO()
+        image.save(out_buffer, 'JPEG', quality=90)
+        result['%03d.jpg' % i] = out_buffer.getvalue()
+
+    return result
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+
+class BackfillCrawlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+        self.server.images = make_images(10)
+        self.server.slow_image = '001.jpg'
+        self.server.slow_seconds = 1.0
+
+        server_thread = Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.submissions = [FakeSubmission('s%d' % i,
+            '%s/%d/%s' % (base_url, i, name), 'mountain lake sunset %d' % i)
+            for i, name in enumerate(sorted(self.server.images))]
+
+        self.work_path = tempfile.mkdtemp()
+        self.connector = FailingConnector()
+        self.db_writer = DatabaseWriter(self.connector)
+        self.seen_index = SeenIndex(self.work_path + '/seen.idx', 1000)
+
+        self.crawler = BackfillCrawler('test', self.db_writer,
+            self.work_path + '/images/', self.work_path + '/thumbnails/',
+            self.work_path + '/checkpoints/', pages=2, limit=4,
+            download_pool=DownloadPool(workers=1),
+            seen_index=self.seen_index,
+            subreddit=PagedSubreddit(self.submissions))
+
+    def tearDown(self):
+        self.db_writer.close()
+        self.seen_index.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_path, True)
+
+    def test_page_cut_at_deadline_is_resumed(self):
+        self.crawler.crawl(time() + 0.5)
+
+        self.assertEqual(self.crawler.checkpoint['after'], None)
+        self.assertEqual(self.crawler.checkpoint['pages'], 0)
+        self.assertEqual(self.crawler.listing_counts, (4, 2))
+
+        for i in range(3):
+            self.crawler.crawl()
+
+        self.assertTrue(self.crawler.checkpoint['done'])
+        self.assertEqual(self.crawler.checkpoint['items'], 10)
+        self.assertEqual(self.stored(), self.permalinks(self.submissions))
+
+    def test_checkpoint_waits_for_committed_records(self):
+        self.server.slow_image = None
+        self.crawler.crawl()
+
+        self.assertEqual(self.crawler.checkpoint['pages'], 2)
+        self.assertEqual(self.stored(),
+            self.permalinks(self.submissions[:8]))
+
+    def test_page_with_failed_store_is_retried(self):
+        self.server.slow_image = None
+        self.connector.failing = True
+        self.crawler.crawl()
+
+        self.assertEqual(self.crawler.checkpoint['pages'], 0)
+        self.assertEqual(self.stored(), [])
+
+        self.connector.failing = False
+
+        for i in range(2):
+            self.crawler.crawl()
+
+        self.assertTrue(self.crawler.checkpoint['done'])
+        self.assertEqual(self.stored(), self.permalinks(self.submissions))
+
+    def test_page_with_missing_image_is_passed(self):
+        self.server.slow_image = None
+        del self.server.images['002.jpg']
+        self.crawler.crawl()
+
+        self.assertEqual(self.crawler.checkpoint['pages'], 2)
+        self.assertEqual(self.stored(), self.permalinks(
+            self.submissions[:2] + self.submissions[3:8]))
+
+    def stored(self):
+        """
+        Lists the sources of the records committed so far.
+        """
+        return sorted(record[3] for record in self.connector.records)
+
+    def permalinks(self, submissions):
+        """
+        Lists the sources the given submissions are stored with.
+        """
+        return sorted(s.permalink for s in submissions)
@@ -0,0 +1,202 @@
+# ==============================================================================
+# test_imgur_resolver.py
+#
+# Tests ImgurResolver against a local stand-in for imgur. Run from the armada
+# directory:
+#
+#     python -m unittest discover tests
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import os
+import shutil
+from SocketServer import ThreadingMixIn
+import tempfile
+from threading import Thread
+import unittest
+
+from HttpClient import HttpClient
+from ImgurResolver import ImgurResolver, is_direct_image
+
+
+# ------------------------------------------------------------------------------
+# Stand-ins
+# ------------------------------------------------------------------------------
+
+PAGES = {
+    '/abc': ('<img src="//i.imgur.com/abc.jpg"><img src="//i.imgur.com/x.png">',
+        '"page-abc"'),
+    '/a/album': ('<a href="//i.imgur.com/one.jpg"></a>'
+        '<a href="//i.imgur.com/two.jpeg"></a>'
+        '<a href="//i.imgur.com/one.jpg"></a>'
+        '<a href="//i.imgur.com/three.png"></a>', '"page-album"'),
+    '/gallery/set': ('<a href="//i.imgur.com/g1.png"></a>'
+        '<a href="//i.imgur.com/g2.png"></a>', '"page-gallery"')
+}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ImgurHandler(BaseHTTPRequestHandler):
+    """
+    Serves the stand-in pages with ETags, answering a matching
+    If-None-Match with 304. Every request is recorded on the server.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        validator = self.headers.getheader('if-none-match')
+        self.server.requests.append((self.path, validator))
+
+        if self.path not in PAGES:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body, etag = PAGES[self.path]
+
+        if validator == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalClient(HttpClient):
+    """
+    An HTTP client that sends requests for imgur.com to the local server
+    instead.
+    """
+
+    def __init__(self, base_url):
+        HttpClient.__init__(self)
+        self.base_url = base_url
+
+    def request(self, url, headers):
+        return HttpClient.request(self,
+            url.replace('http://imgur.com', self.base_url), headers)
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+
+class ImgurResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImgurHandler)
+        self.server.requests = []
+
+        server_thread = Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        self.client = LocalClient('http://127.0.0.1:%d' %
+            self.server.server_port)
+        self.work_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_path, True)
+
+    def test_direct_image_resolves_to_itself(self):
+        resolver = ImgurResolver(self.client)
+
+        for url in ['http://i.redd.it/abc.jpg',
+                'https://example.com/photo.JPEG?width=1920',
+                'http://i.imgur.com/abc.png#top']:
+            self.assertTrue(is_direct_image(url))
+            self.assertEqual(resolver.resolve(url), [url])
+
+        self.assertFalse(is_direct_image('http://example.com/a.jpg/page'))
+        self.assertEqual(self.server.requests, [])
+
+    def test_other_sites_fall_through(self):
+        resolver = ImgurResolver(self.client)
+
+        self.assertEqual(resolver.resolve('http://example.com/abc'), [])
+        self.assertEqual(self.server.requests, [])
+
+    def test_page_resolves_to_first_image(self):
+        resolver = ImgurResolver(self.client)
+
+        self.assertEqual(resolver.resolve('http://imgur.com/abc'),
+            ['http://i.imgur.com/abc.jpg'])
+
+    def test_album_resolves_to_every_image(self):
+        resolver = ImgurResolver(self.client)
+
+        self.assertEqual(resolver.resolve('http://imgur.com/a/album'),
+            ['http://i.imgur.com/one.jpg', 'http://i.imgur.com/two.jpeg',
+                'http://i.imgur.com/three.png'])
+
+    def test_album_is_capped(self):
+        resolver = ImgurResolver(self.client, max_images=2)
+
+        self.assertEqual(len(resolver.resolve('http://imgur.com/a/album')), 2)
+
+    def test_gallery_resolves_to_every_image(self):
+        resolver = ImgurResolver(self.client)
+
+        self.assertEqual(resolver.resolve('http://imgur.com/gallery/set'),
+            ['http://i.imgur.com/g1.png', 'http://i.imgur.com/g2.png'])
+
+    def test_fresh_cache_skips_request(self):
+        resolver = ImgurResolver(self.client)
+
+        first = resolver.resolve('http://imgur.com/abc')
+        second = resolver.resolve('http://imgur.com/abc')
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_stale_cache_reused_on_304(self):
+        resolver = ImgurResolver(self.client, max_age=0)
+
+        first = resolver.resolve('http://imgur.com/a/album')
+        second = resolver.resolve('http://imgur.com/a/album')
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.requests, [('/a/album', None),
+            ('/a/album', '"page-album"')])
+
+    def test_missing_page_raises(self):
+        resolver = ImgurResolver(self.client)
+
+        self.assertRaises(Exception, resolver.resolve, 'http://imgur.com/gone')
+
+    def test_cache_file_survives_restart(self):
+        cache_path = os.path.join(self.work_path, 'resolver.json')
+
+        resolver = ImgurResolver(self.client, cache_path)
+        resolver.resolve('http://imgur.com/abc')
+        resolver.flush()
+
+        restarted = ImgurResolver(self.client, cache_path)
+
+        self.assertEqual(restarted.resolve('http://imgur.com/abc'),
+            ['http://i.imgur.com/abc.jpg'])
+        self.assertEqual(len(self.server.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()